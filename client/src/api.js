@@ -6,4 +6,9 @@ export const api = axios.create({
 
 export function get_entity(qid) {
     return api.get(`/entity/${qid}`).then(resp => resp.data)
+}
+
+export function get_entities(qids, budget) {
+    // with a budget (seconds) only the entities the service fetched in time are returned
+    return api.post('/entities', budget ? { qids, budget } : { qids }).then(resp => resp.data)
 }
\ No newline at end of file
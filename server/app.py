@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Flask app for running the essay service locally (essay_utils.py without a title).
+   Kept out of essay_utils so the Lambda handlers do not import Flask.'''
+
+import logging
+logger = logging.getLogger()
+
+import json
+
+from flask_cors import CORS
+from flask import Flask, request
+app = Flask(__name__)
+CORS(app)
+
+import requests
+
+import compression
+import timing
+from essay_utils import EssayUtils, PageNotFound
+
+@app.route('/healthcheck')
+def healthcheck():
+    return 'OK'        
+
+@app.route('/page', methods=['GET', 'POST'])
+def page():
+    kwargs = dict([(k, request.args.get(k)) for k in request.args])
+    accept = request.headers.get('Accept', 'application/json').split(',')
+    content_type = ([ct for ct in accept if ct in ('text/html', 'application/json', 'text/csv', 'text/tsv')] + ['application/json'])[0]
+    as_json = kwargs.pop('format', None) == 'json' or content_type == 'application/json'
+
+    with timing.request('page', title=kwargs.get('title')) as request_timing:
+        try:
+            essay = EssayUtils(**kwargs).render(fmt='json' if as_json else 'html', **kwargs)
+        except PageNotFound as e:
+            return app.response_class(json.dumps({'error': f'page not found: {e}'}), status=404, mimetype='application/json')
+        except requests.RequestException as e:
+            logger.warning(f'upstream error: {e}')
+            return app.response_class(json.dumps({'error': 'upstream service unavailable'}), status=503, mimetype='application/json')
+        if as_json and content_type == 'text/html':
+            essay = open('viewer.html', 'r').read().replace("'{{DATA}}'", essay)
+        status, headers, body = compression.respond(essay, request.headers, content_type)
+        if request_timing is not None:
+            headers['Server-Timing'] = request_timing.header()
+        return app.response_class(body, status=status, headers=headers)
+
+if __name__ == '__main__':
+    app.run(debug=True, host='0.0.0.0')
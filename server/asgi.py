@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''ASGI app serving the essay and entity APIs (app.py routes plus the Lambda handler paths).
+
+   Requests are handled on one event loop.  Entities are fetched with the async entity pipeline,
+   and blocking upstream calls (page, revision and entity data lookups) run in a bounded thread
+   pool, so a request waiting on upstream services does not hold up the others.  The CPU heavy
+   part of an essay render (HTML parsing, tagging, serialization) runs in a bounded process pool.
+
+   Concurrency is limited gracefully.  Requests beyond ASGI_MAX_IN_FLIGHT, and renders waiting
+   longer than RENDER_QUEUE_TIMEOUT for a render process, get a 503 with a Retry-After.
+
+   Run with any ASGI server, e.g. uvicorn asgi:app, or with python asgi.py (uvicorn).  Use one
+   server worker per node, since each worker has its own render pool.'''
+
+import logging
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+# The per-host connection pools (HTTP_POOL_SIZE) default to the number of I/O threads, set
+# before transport is imported
+os.environ.setdefault('HTTP_POOL_SIZE', os.environ.get('ASGI_IO_THREADS', '64'))
+
+import asyncio
+import concurrent.futures
+import functools
+import getopt
+import json
+import multiprocessing
+import re
+import sys
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qsl, unquote
+
+import requests
+
+import compression
+import timing
+import transport
+from caching import cache
+from handler import cors_headers
+
+# Max requests handled at a time, the rest are turned away with a 503
+ASGI_MAX_IN_FLIGHT = int(os.environ.get('ASGI_MAX_IN_FLIGHT', 512))
+# Max threads running blocking upstream calls, at most one per pooled connection
+ASGI_IO_THREADS = min(int(os.environ.get('ASGI_IO_THREADS', 64)), transport.POOL_SIZE)
+# Number of render processes, defaults to the number of CPUs
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', os.cpu_count() or 1))
+# Max renders queued per render process, waiting for one
+RENDER_QUEUE_SIZE = int(os.environ.get('RENDER_QUEUE_SIZE', 32))
+# Max seconds a render waits for a render process before it is turned away
+RENDER_QUEUE_TIMEOUT = float(os.environ.get('RENDER_QUEUE_TIMEOUT', 30))
+# Seconds clients turned away are asked to wait before retrying
+BUSY_RETRY_AFTER = 1
+
+_in_flight = 0
+_io_executor = None
+_render_pool = None
+_render_pool_lock = None
+_render_slots = None
+_index_refresher = None
+
+def io_executor():
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASGI_IO_THREADS)
+    return _io_executor
+
+def start_render_pool(context=None):
+    '''A render process pool with its processes started, forked unless another multiprocessing
+       start method (context) is given'''
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context(context) if context else None)
+    # the processes are started on the first submit, do it now
+    pool.submit(os.getpid).result()
+    return pool
+
+def render_pool():
+    '''The render process pool, started on server startup (or first use), before any other
+       thread: a process forked while other threads hold locks (logging, cache) can deadlock on them'''
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = start_render_pool()
+    return _render_pool
+
+async def restart_render_pool(broken):
+    '''Replaces a broken render pool.  The I/O threads are running by now, so the new processes
+       are started by a forkserver instead of forking this process, and off the event loop.'''
+    global _render_pool, _render_pool_lock
+    if _render_pool_lock is None:
+        _render_pool_lock = asyncio.Lock()
+    async with _render_pool_lock:
+        if _render_pool is broken:
+            broken.shutdown(wait=False)
+            _render_pool = await run_io(start_render_pool, 'forkserver')
+
+def render_slots():
+    '''Semaphore bounding the renders submitted to the pool, running and queued'''
+    global _render_slots
+    if _render_slots is None:
+        _render_slots = asyncio.Semaphore(RENDER_WORKERS * (1 + RENDER_QUEUE_SIZE))
+    return _render_slots
+
+async def run_io(func, *args, **kwargs):
+    '''Runs a blocking (upstream) call in the I/O thread pool'''
+    return await asyncio.get_event_loop().run_in_executor(io_executor(), timing.bind(functools.partial(func, *args, **kwargs)))
+
+def render_essay(title, site, revid, page_data, fmt, kwargs):
+    '''Renders an essay from its fetched page data (in a render process), caching it like
+       EssayUtils.render'''
+    from static_essay import StaticEssayUtils
+    return StaticEssayUtils({title: (revid, page_data)}, site=site).render(title, site=site, fmt=fmt, **kwargs)
+
+class ServiceBusy(Exception):
+    '''No capacity left for a request'''
+
+class Request(object):
+
+    def __init__(self, scope, body, params):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.params = params
+        self.headers = dict([(k.decode('latin-1').lower(), v.decode('latin-1')) for k, v in scope.get('headers', [])])
+        # query args and JSON body args, keys lower cased like the Lambda handlers
+        args = dict(parse_qsl(scope.get('query_string', b'').decode('utf-8')))
+        if body:
+            args.update(json.loads(body))
+        self.args = dict([(k.lower(), v) for k, v in args.items()])
+        self.args.pop('log', None)
+
+def response(request, body, content_type):
+    '''(status, headers, body) of a response, encoded per Accept-Encoding'''
+    status, headers, body = compression.respond(body, request.headers, content_type)
+    headers.update(cors_headers)
+    request_timing = timing.current()
+    if request_timing is not None:
+        headers['Server-Timing'] = request_timing.header()
+    return status, headers, body
+
+def error(status, message, retry_after=None):
+    headers = dict(cors_headers, **{'Content-Type': 'application/json'})
+    if retry_after is not None:
+        headers['Retry-After'] = str(int(retry_after) + 1)
+    request_timing = timing.current()
+    if request_timing is not None:
+        headers['Server-Timing'] = request_timing.header()
+    return status, headers, json.dumps({'error': message})
+
+def upstream_error(e):
+    logger.warning(f'upstream error: {e}')
+    return error(503, 'upstream service unavailable', retry_after=getattr(e, 'retry_after', transport.RETRY_BACKOFF_MAX))
+
+async def get_entity(request):
+    from entity import KnowledgeGraph
+    qid = request.params['qid']
+    args = request.args
+    with timing.request('get_entity', qid=qid):
+        try:
+            entity = await KnowledgeGraph(**args).aentity_cached(qid, args.get('language'), args.get('entity_type'))
+        except requests.RequestException as e:
+            return upstream_error(e)
+        if not entity:
+            return error(404, f'entity not found: {qid}')
+        return response(request, json.dumps(entity), 'application/json')
+
+async def post_entities(request):
+    # entities keyed by QID, {} when not found and null when the lookup failed
+    from entity import KnowledgeGraph
+    args = dict(request.args)
+    qids = args.pop('qids', [])
+    budget = args.pop('budget', None)
+    with timing.request('post_entities', qids=len(qids)):
+        try:
+            budget = float(budget) if budget is not None else None
+        except ValueError:
+            return error(400, f'invalid budget: {budget}')
+        kg = KnowledgeGraph(**args)
+        try:
+            if budget is not None:
+                entities = await run_io(kg.prefetch, qids, budget, args.get('language'), args.get('entity_type'))
+            else:
+                entities = await kg.aentities(qids, args.get('language'), args.get('entity_type'))
+        except requests.RequestException as e:
+            return upstream_error(e)
+        return response(request, json.dumps(entities), 'application/json')
+
+async def render(title, fmt, args):
+    '''EssayUtils.render with the upstream calls in the I/O threads and the rendering in the
+       render processes'''
+    from entity import KnowledgeGraph
+    from essay_utils import Essay, EssayUtils, ENTITY_PREFETCH_BUDGET, ESSAY_PREFETCH, prefetch_mode
+    from static_essay import QID_RE
+    client = EssayUtils(**args)
+    site = args.get('site') or client.default_site
+    prefetch = prefetch_mode(args.get('prefetch', ESSAY_PREFETCH))
+    revid = await run_io(client.revision, title, site=site)
+    if revid:
+        rendered = await run_io(cache.get, client.render_key(title, site, fmt, revid, prefetch, args.get('language')))
+        if rendered is not None:
+            return rendered
+    page_data = await run_io(client.page, title, site=site, revid=revid)
+    # the entity data is cached for the render process, and inline prefetched entities are passed
+    # in, so no render process waits on upstream calls
+    qids = list(dict.fromkeys(QID_RE.findall(page_data['html'])))
+    if qids:
+        fetches = [run_io(Essay.prefetch_entity_data, qids)]
+        if prefetch == 'inline':
+            fetches.append(run_io(KnowledgeGraph().prefetch, [f'wd:{qid}' for qid in qids], ENTITY_PREFETCH_BUDGET, args.get('language')))
+        fetched = await asyncio.gather(*fetches)
+        if prefetch == 'inline':
+            page_data['prefetched'] = fetched[1]
+    try:
+        await asyncio.wait_for(render_slots().acquire(), timeout=RENDER_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise ServiceBusy(f'no render process within {RENDER_QUEUE_TIMEOUT}s')
+    pool = render_pool()
+    try:
+        kwargs = dict([(k, v) for k, v in args.items() if k not in ('title', 'site', 'format')])
+        with timing.span('render'):
+            return await asyncio.get_event_loop().run_in_executor(pool, render_essay, title, site, revid, page_data, fmt, kwargs)
+    except BrokenProcessPool:
+        # a render process died (e.g. out of memory), the pool is replaced for the next renders
+        logger.error('render pool broken, restarting it')
+        await restart_render_pool(pool)
+        raise ServiceBusy('render process failed')
+    finally:
+        render_slots().release()
+
+async def essay(request, title, fmt, content_type):
+    from essay_utils import PageNotFound
+    with timing.request('page', title=title):
+        try:
+            rendered = await render(title, fmt, request.args)
+        except PageNotFound as e:
+            return error(404, f'page not found: {e}')
+        except requests.RequestException as e:
+            return upstream_error(e)
+        except ServiceBusy as e:
+            logger.warning(f'busy: {e}')
+            return error(503, 'server busy', retry_after=BUSY_RETRY_AFTER)
+        if fmt == 'json' and content_type == 'text/html':
+            with open(os.path.join(BASE_DIR, 'viewer.html'), 'r') as fp:
+                rendered = fp.read().replace("'{{DATA}}'", rendered)
+        return await run_io(response, request, rendered, content_type)
+
+async def get_page(request):
+    '''The app.py /page route, JSON or HTML per the format arg and Accept header'''
+    accept = request.headers.get('accept', 'application/json').split(',')
+    content_type = ([ct for ct in accept if ct in ('text/html', 'application/json', 'text/csv', 'text/tsv')] + ['application/json'])[0]
+    as_json = request.args.get('format') == 'json' or content_type == 'application/json'
+    if not request.args.get('title'):
+        return error(400, 'missing title')
+    return await essay(request, request.args['title'], 'json' if as_json else 'html', content_type)
+
+async def get_essay(request):
+    '''The Lambda essay/{title} path, the Vue app HTML'''
+    return await essay(request, request.params['title'], 'html', 'text/html')
+
+async def healthcheck(request):
+    return 200, {'Content-Type': 'text/plain'}, 'OK'
+
+ROUTES = [
+    ('GET', re.compile(r'^/healthcheck$'), healthcheck),
+    ('GET', re.compile(r'^/page$'), get_page),
+    ('POST', re.compile(r'^/page$'), get_page),
+    ('GET', re.compile(r'^/essay/(?P<title>[^/]+)$'), get_essay),
+    ('GET', re.compile(r'^/entity/(?P<qid>[^/]+)$'), get_entity),
+    ('POST', re.compile(r'^/entities$'), post_entities),
+]
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+async def dispatch(scope, receive):
+    if scope['method'] == 'OPTIONS':
+        return 204, dict(cors_headers, **{'Access-Control-Allow-Methods': 'GET, POST, OPTIONS', 'Access-Control-Allow-Headers': '*'}), ''
+    matched = [(method, match, handler) for method, match, handler in ((method, path.match(scope['path']), handler) for method, path, handler in ROUTES) if match]
+    route = next(((match, handler) for method, match, handler in matched if method == scope['method']), None)
+    if route is None:
+        return error(405 if matched else 404, f'{scope["method"]} {scope["path"]}')
+    match, handler = route
+    try:
+        request = Request(scope, await read_body(receive), dict([(k, unquote(v)) for k, v in match.groupdict().items()]))
+    except (TypeError, ValueError) as e:
+        return error(400, f'invalid request: {e}')
+    return await handler(request)
+
+async def send_response(send, status, headers, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items()]
+    })
+    await send({'type': 'http.response.body', 'body': body.encode('utf-8') if isinstance(body, str) else body})
+
+async def refresh_formatter_index():
+    '''Rebuilds the formatter URL index when stale, checked every FORMATTER_INDEX_RETRY seconds
+       (lookups do not rebuild it)'''
+    from entity import FORMATTER_INDEX_RETRY, formatter_index
+    while True:
+        await run_io(lambda: formatter_index().refresh_if_stale())
+        await asyncio.sleep(FORMATTER_INDEX_RETRY)
+
+async def lifespan(receive, send):
+    global _index_refresher
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # fork the render processes before any request starts threads
+            render_pool()
+            _index_refresher = asyncio.ensure_future(refresh_formatter_index())
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _index_refresher is not None:
+                _index_refresher.cancel()
+            if _render_pool is not None:
+                _render_pool.shutdown(wait=True)
+            if _io_executor is not None:
+                _io_executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    global _in_flight
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    if _in_flight >= ASGI_MAX_IN_FLIGHT:
+        logger.warning(f'busy: {_in_flight} requests in flight, turned away {scope["path"]}')
+        return await send_response(send, *error(503, 'server busy', retry_after=BUSY_RETRY_AFTER))
+    _in_flight += 1
+    try:
+        try:
+            result = await dispatch(scope, receive)
+        except Exception as e:
+            logger.exception(f'{scope["method"]} {scope["path"]}: {e}')
+            result = error(500, 'internal error')
+        await send_response(send, *result)
+    finally:
+        _in_flight -= 1
+
+def usage():
+    print(f'{sys.argv[0]} [hl:b:p:]')
+    print('   -h --help          Print help message')
+    print('   -l --loglevel      Logging level (default=warning)')
+    print('   -b --host          Host address to listen on (default=0.0.0.0)')
+    print('   -p --port          Port (default=8000)')
+
+if __name__ == '__main__':
+    kwargs = {'host': '0.0.0.0', 'port': 8000}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hl:b:p:', ['help', 'loglevel', 'host', 'port'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-l', '--loglevel'):
+            loglevel = a.lower()
+            if loglevel in ('error',): logger.setLevel(logging.ERROR)
+            elif loglevel in ('warn','warning'): logger.setLevel(logging.WARNING)
+            elif loglevel in ('info',): logger.setLevel(logging.INFO)
+            elif loglevel in ('debug',): logger.setLevel(logging.DEBUG)
+        elif o in ('-b', '--host'):
+            kwargs['host'] = a
+        elif o in ('-p', '--port'):
+            kwargs['port'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    try:
+        import uvicorn
+    except ImportError:
+        print('python asgi.py needs uvicorn (pip install uvicorn), or run asgi:app with another ASGI server')
+        sys.exit(1)
+    uvicorn.run('asgi:app', workers=1, loop='asyncio', **kwargs)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Drives the ASGI app (asgi.py) in process with many concurrent requests: cold essay renders
+   and entity lookups, served from the fixture recordings with the cache in a temporary
+   directory.  Reports the statuses, latency percentiles and throughput, and checks the
+   rendered essays are the same as EssayUtils.render output, and that no upstream call is made
+   on the event loop thread (where it would hold up every request).'''
+
+import os
+import sys
+import tempfile
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+os.environ['CACHE_DIR'] = tempfile.mkdtemp(prefix='essay-utils-bench-')
+os.environ.setdefault('HTTP_REPLAY_DIR', os.path.join(SERVER_DIR, 'benchmarks', 'fixtures', 'recordings'))
+
+import asyncio
+import getopt
+import logging
+import shutil
+import threading
+from time import perf_counter
+
+ESSAY_TITLE = 'Benchmark_essay'
+ENTITY_QID = 'Q100'
+
+async def call(app, method, path, query=''):
+    '''Returns (status, headers, body, seconds) of one request'''
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode('utf-8'), 'headers': []}
+    received = []
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+    async def send(message):
+        received.append(message)
+    start = perf_counter()
+    await app(scope, receive, send)
+    return received[0]['status'], dict(received[0]['headers']), received[1]['body'], perf_counter() - start
+
+class LoopThreadCalls(object):
+    '''Records the upstream calls of a transport made on this (the event loop) thread'''
+
+    def __init__(self, transport):
+        self.thread = threading.get_ident()
+        self.request = transport.request
+        self.calls = []
+        transport.request = self
+
+    def __call__(self, method, url, **kwargs):
+        if threading.get_ident() == self.thread:
+            self.calls.append(f'{method} {url[:120]}')
+        return self.request(method, url, **kwargs)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)] if values else 0
+
+async def load(app, requests):
+    start = perf_counter()
+    results = await asyncio.gather(*[call(app, 'GET', path, query) for path, query in requests])
+    return results, perf_counter() - start
+
+def report(name, results, elapsed):
+    statuses = {}
+    for status, _, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = [seconds * 1000 for _, _, _, seconds in results]
+    print(f'{name:16} {len(results):5} requests in {elapsed:6.2f}s ({len(results) / elapsed:7.1f}/s), '
+          f'p50 {percentile(latencies, 0.5):8.1f}ms, p99 {percentile(latencies, 0.99):8.1f}ms, statuses {statuses}')
+
+def run(concurrency=200, workers=None):
+    if workers:
+        os.environ['RENDER_WORKERS'] = str(workers)
+    import asgi
+    # the modules imported by the handlers reset the log levels
+    logging.disable(logging.CRITICAL)
+    import transport
+    from caching import cache
+    from entity import formatter_index
+    from essay_utils import EssayUtils
+    try:
+        # fork the render processes before any thread is started, as on server startup
+        asgi.render_pool()
+        formatter_index().refresh()
+        expected = EssayUtils().render(ESSAY_TITLE, fmt='json').encode('utf-8')
+        cache.clear()
+
+        loop_thread_calls = LoopThreadCalls(transport.default_transport())
+        mismatches = 0
+        for name, requests in (
+                ('essays, cold', [('/page', f'title={ESSAY_TITLE}&format=json')] * concurrency),
+                ('essays, cached', [('/page', f'title={ESSAY_TITLE}&format=json')] * concurrency),
+                ('entities', [(f'/entity/{ENTITY_QID}', '')] * concurrency)):
+            if name == 'essays, cold':
+                cache.clear()
+            results, elapsed = asyncio.run(load(asgi.app, requests))
+            report(name, results, elapsed)
+            if name.startswith('essays'):
+                mismatches += sum(1 for status, _, body, _ in results if status == 200 and body != expected)
+        print(f'output mismatches: {mismatches if mismatches else "none"}')
+        print(f'upstream calls on the event loop thread: {len(loop_thread_calls.calls) if loop_thread_calls.calls else "none"}')
+        for call in sorted(set(loop_thread_calls.calls))[:10]:
+            print(f'   {call}')
+        return 1 if mismatches or loop_thread_calls.calls else 0
+    finally:
+        asgi.render_pool().shutdown(wait=True)
+        shutil.rmtree(os.environ['CACHE_DIR'], ignore_errors=True)
+
+def usage():
+    print(f'{sys.argv[0]} [hc:w:]')
+    print('   -h --help          Print help message')
+    print('   -c --concurrency   Concurrent requests per run (default=200)')
+    print('   -w --workers       Render processes (default=number of CPUs)')
+
+if __name__ == '__main__':
+    kwargs = {}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hc:w:', ['help', 'concurrency', 'workers'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-c', '--concurrency'):
+            kwargs['concurrency'] = int(a)
+        elif o in ('-w', '--workers'):
+            kwargs['workers'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    sys.exit(run(**kwargs))
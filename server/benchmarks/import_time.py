@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Cold-start import budget for the Lambda handlers.  Imports the given modules (default: handler)
+   in fresh interpreters with -X importtime, prints the slowest imports and exits non-zero when
+   the median total import time exceeds the budget.'''
+
+import os
+import sys
+
+import getopt
+import statistics
+import subprocess
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Budget (ms) for `import handler`, the handlers import entity/essay_utils lazily
+DEFAULT_BUDGET_MS = float(os.environ.get('IMPORT_TIME_BUDGET_MS', 250))
+
+def profile(modules):
+    '''Returns {module: (self_us, cumulative_us)} and the total (us) for one cold import'''
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {", ".join(modules)}'],
+        cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    timings = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings, sum(timings[m][1] for m in modules if m in timings)
+
+def usage():
+    print(f'{sys.argv[0]} [hb:n:r:] [module ...]')
+    print('   -h --help          Print help message')
+    print(f'   -b --budget        Max median import time in ms (default={DEFAULT_BUDGET_MS})')
+    print('   -n --top           Number of slowest imports listed (default=15)')
+    print('   -r --runs          Number of cold imports measured (default=5)')
+
+if __name__ == '__main__':
+    kwargs = {'budget': DEFAULT_BUDGET_MS, 'top': 15, 'runs': 5}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hb:n:r:', ['help', 'budget', 'top', 'runs'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-b', '--budget'):
+            kwargs['budget'] = float(a)
+        elif o in ('-n', '--top'):
+            kwargs['top'] = int(a)
+        elif o in ('-r', '--runs'):
+            kwargs['runs'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    modules = args if args else ['handler']
+    runs = [profile(modules) for _ in range(kwargs['runs'])]
+    totals = [total / 1000 for _, total in runs]
+    timings = runs[totals.index(sorted(totals)[len(totals) // 2])][0]
+
+    print(f'{"self ms":>10} {"cumulative ms":>14}  module')
+    for name, (self_us, cumulative_us) in sorted(timings.items(), key=lambda item: -item[1][1])[:kwargs['top']]:
+        print(f'{self_us/1000:10.1f} {cumulative_us/1000:14.1f}  {name}')
+    median = statistics.median(totals)
+    print(f'import {", ".join(modules)}: median {median:.1f} ms (min {min(totals):.1f}, max {max(totals):.1f}) over {len(totals)} runs, budget {kwargs["budget"]:.0f} ms')
+    if median > kwargs['budget']:
+        print('FAIL: import time over budget')
+        sys.exit(1)
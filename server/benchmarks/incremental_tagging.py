@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Times re-rendering a synthetic essay after one paragraph edits, alternately adding a sentence
+   and declaring a new entity, with the tagged HTML of the unchanged sections served from the
+   cache, and checks the output is the same as a render with an empty cache.  The cache lives in
+   a temporary directory.'''
+
+import os
+import sys
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['CACHE_DIR'] = tempfile.mkdtemp(prefix='essay-utils-bench-')
+
+import getopt
+import logging
+import random
+import re
+import shutil
+from time import time as now
+
+import timing
+from caching import cache
+from essay_utils import mw_to_html5, add_vue_app
+from render_essay import OfflineEssay, make_essay
+
+def render(html):
+    with timing.request('render') as request_timing:
+        start = now()
+        essay = OfflineEssay(mw_to_html5(html))
+        tag_s = request_timing.spans['tag_entities'][0]
+        rendered = add_vue_app(essay.soup)
+        counters = dict(request_timing.counters)
+    return rendered, now() - start, tag_s, counters.get('sections_tagged', 0), counters.get('sections_reused', 0)
+
+def edit(html, rand, n):
+    '''Appends a sentence to one paragraph of the essay, or (odd n) declares a new entity in it'''
+    paragraphs = [m.end() for m in re.finditer(r'</p>', html)]
+    at = paragraphs[rand.randrange(len(paragraphs))] - len('</p>')
+    if n % 2:
+        return html[:at] + f' Garden {n} <span data-entity="" data-qid="Q{9000 + n}" data-label="Garden {n}"></span>' + html[at:]
+    return html[:at] + ' An edited sentence about the garden.' + html[at:]
+
+def run(size=200000, num_entities=40, edits=5):
+    logging.getLogger('timing').setLevel(logging.CRITICAL)
+    rand = random.Random(11)
+    html = make_essay(size, num_entities, rand)
+    try:
+        _, elapsed, tag_s, scanned, reused = render(html)
+        print(f'first render         {elapsed:.3f}s (tag_entities {tag_s:.3f}s, {scanned} sections tagged)')
+        mismatches = 0
+        for n in range(edits):
+            html = edit(html, rand, n)
+            rendered, elapsed, tag_s, scanned, reused = render(html)
+            print(f'render after edit    {elapsed:.3f}s (tag_entities {tag_s:.3f}s, {scanned} tagged, {reused} reused)')
+            cache.clear()
+            expected, elapsed, tag_s, scanned, reused = render(html)
+            print(f'render, empty cache  {elapsed:.3f}s (tag_entities {tag_s:.3f}s, {scanned} tagged)')
+            mismatches += 0 if rendered == expected else 1
+        print(f'output mismatches: {mismatches if mismatches else "none"}')
+        return 1 if mismatches else 0
+    finally:
+        shutil.rmtree(os.environ['CACHE_DIR'], ignore_errors=True)
+
+def usage():
+    print(f'{sys.argv[0]} [hs:e:n:]')
+    print('   -h --help          Print help message')
+    print('   -s --size          Essay size in bytes (default=200000)')
+    print('   -e --entities      Number of distinct entities (default=40)')
+    print('   -n --edits         Number of edits (default=5)')
+
+if __name__ == '__main__':
+    kwargs = {}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hs:e:n:', ['help', 'size', 'entities', 'edits'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-s', '--size'):
+            kwargs['size'] = int(a)
+        elif o in ('-e', '--entities'):
+            kwargs['num_entities'] = int(a)
+        elif o in ('-n', '--edits'):
+            kwargs['edits'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    sys.exit(run(**kwargs))
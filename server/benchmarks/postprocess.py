@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Times the fused entity post-processing (KnowledgeGraph._postprocess) and the copy-free merge
+   against the previous three pass (_filter_props, _link_values, _add_id_labels) and deepcopy
+   implementations, on a large synthetic entity shaped like a country, and checks both give
+   byte-identical output on the recorded fixtures.  Upstream calls are served from the fixture
+   recordings and the cache lives in a temporary directory.'''
+
+import os
+import sys
+import tempfile
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+os.environ['CACHE_DIR'] = tempfile.mkdtemp(prefix='essay-utils-bench-')
+os.environ.setdefault('HTTP_REPLAY_DIR', os.path.join(SERVER_DIR, 'benchmarks', 'fixtures', 'recordings'))
+
+import getopt
+import json
+import logging
+import random
+import shutil
+from copy import deepcopy
+from time import perf_counter
+
+from caching import cache
+from entity import GRAPHS, KnowledgeGraph, formatter_index
+
+ENTITY_QIDS = ('jstor:Q100', 'wd:Q1043')
+
+class LegacyKnowledgeGraph(KnowledgeGraph):
+    '''The post-processing passes and merge as they were before they were fused'''
+
+    def _postprocess(self, d, prefetch=True, **kwargs):
+        return self._legacy_add_id_labels(self._link_values(self._legacy_filter_props(d, **kwargs), **kwargs), prefetch=prefetch, **kwargs)
+
+    def _legacy_filter_props(self, d, **kwargs):
+        def exclude(prop):
+            if prop.startswith('p:P'): return True
+            if prop.startswith('wikibase:'): return True
+            if prop in ('rdfs:label', 'schema:description', 'schema:version', 'skos:altLabel'): return True
+            return False
+        if not isinstance(d, (dict, list)):
+            return d
+        elif isinstance(d, list):
+            return [v for v in (self._legacy_filter_props(v, **kwargs) for v in d) if v]
+        return {k: v for k, v in ((k, self._legacy_filter_props(v, **kwargs)) for k, v in d.items() if v and not exclude(k))}
+
+    def _legacy_add_id_labels(self, d, **kwargs):
+        if kwargs.pop('prefetch', True):
+            self._prefetch_labels(self._entity_ids(d), language=kwargs.get('language', 'en'))
+        if not isinstance(d, (dict, list, str)):
+            return d
+        if isinstance(d, str):
+            if self._is_entity_id(d):
+                d = {'id': d, 'value': self._label(d, language=kwargs.get('language', 'en')) or d}
+                if self._is_entity_id(d['id']):
+                    d['url'] = d['id'].replace(f'{self.ns}:', f'https://{GRAPHS[self.ns]["prefix"].split("/")[2]}/entity/').replace('wd:', 'https://www.wikidata.org/entity/')
+            return d
+        elif isinstance(d, list):
+            return [v for v in (self._legacy_add_id_labels(v, prefetch=False, **kwargs) for v in d) if v]
+        return {k: v for k, v in ((k, self._legacy_add_id_labels(v, prefetch=False, **kwargs)) for k, v in d.items()) if v}
+
+    def _merge(self, primary, secondary=None):
+        def _norm(v):
+            return set([json.dumps(d, sort_keys=True) for d in v]) if isinstance(v, list) else json.dumps(v, sort_keys=True)
+
+        merged = deepcopy(primary)
+        if secondary:
+            for k, v in secondary.items():
+                if k in merged:
+                    if isinstance(merged[k], list):
+                        mv = _norm(merged[k])
+                        for sv in v:
+                            if not _norm(sv) in mv:
+                                merged[k].append(sv)
+                else:
+                    merged[k] = deepcopy(v)
+            merged['id']['alt'] = secondary['id']['id']
+        if '@type' in merged:
+            merged['type'] = merged.pop('@type')
+        if 'described at URL' in merged:
+            del merged['described at URL']
+        if 'coords' in merged:
+            coords = []
+            for cs in merged['coords']:
+                coords.append([float(c) for c in cs.replace('Point(','').replace(')','').split()])
+            merged['coords'] = coords
+        return merged
+
+def raw_entity(kg, qid):
+    ns, _qid = qid.split(':')
+    return next(iter(kg._query_entities(kg._entity_sparql(_qid, kg.language, kg.entity_type), ns, kg.language, kg.entity_type).values()), {})
+
+def check_fixtures(kg, legacy):
+    '''Returns the number of fixture outputs that differ between the implementations'''
+    mismatches = 0
+    kwargs = {'context': kg._get_context(kg.ns, kg.language), 'entity_type': kg.entity_type, 'ns': kg.ns, 'language': kg.language}
+    for qid in ENTITY_QIDS:
+        raw = raw_entity(kg, qid)
+        _kwargs = dict(kwargs, ns=qid.split(':')[0], context=kg._get_context(qid.split(':')[0], kg.language))
+        if json.dumps(kg._postprocess(raw, **_kwargs)) != json.dumps(legacy._postprocess(raw, **_kwargs)):
+            print(f'postprocess mismatch: {qid}')
+            mismatches += 1
+    primary, secondary = kg._entity(ENTITY_QIDS[0]), kg._entity(ENTITY_QIDS[1])
+    if json.dumps(kg._merge(primary, secondary)) != json.dumps(legacy._merge(primary, secondary)):
+        print('merge mismatch')
+        mismatches += 1
+    # the whole pipeline, from an empty cache each time
+    outputs = []
+    for _kg in (kg, legacy):
+        cache.clear()
+        outputs.append(json.dumps(_kg.entity(ENTITY_QIDS[0])))
+    if outputs[0] != outputs[1]:
+        print(f'entity mismatch: {ENTITY_QIDS[0]}')
+        mismatches += 1
+    return mismatches
+
+def country(kg, raw, num_props, num_values, rand):
+    '''A large entity built from the properties of a fixture entity: many entity valued lists
+       (borders, subdivisions, memberships), external IDs and a few nested values'''
+    ns = kg.ns
+    entity = dict(raw)
+    keys = [k for k in raw if k not in ('id', '@type', 'label')]
+    linked = [k for k in keys if formatter_index().formatter_urls(k, ns=ns)]
+    unlinked = [k for k in keys if k not in linked]
+    eids = [f'{ns}:Q{n}' for n in range(100000, 100000 + num_values * 4)]
+    for eid in eids:
+        cache.set(KnowledgeGraph._label.cache_key(kg, eid, language=kg.language), f'Label of {eid}')
+    for i in range(num_props):
+        if linked and i % 4 == 0:
+            entity[linked[i % len(linked)]] = [str(rand.randrange(10**8)) for _ in range(rand.randrange(1, 4))]
+        else:
+            k = unlinked[i % len(unlinked)] if i < len(unlinked) else f'wdt:P{9000 + i}'
+            entity[k] = rand.sample(eids, rand.randrange(1, num_values))
+    entity['p:P31'] = [{'ps:P31': eid, 'pq:P580': '1900-01-01'} for eid in eids[:num_values]]
+    entity['aliases'] = [f'Alias {n}' for n in range(num_values)]
+    entity['coords'] = ['Point(10.5 51.2)']
+    return entity
+
+def timed(func, iterations):
+    func()
+    start = perf_counter()
+    for _ in range(iterations):
+        func()
+    return (perf_counter() - start) / iterations * 1000
+
+def run(iterations=20, num_props=150, num_values=60):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    try:
+        formatter_index().refresh()
+        kg, legacy = KnowledgeGraph(), LegacyKnowledgeGraph()
+        mismatches = check_fixtures(kg, legacy)
+        print(f'fixture mismatches: {mismatches if mismatches else "none"}')
+
+        rand = random.Random(7)
+        kwargs = {'context': kg._get_context(kg.ns, kg.language), 'entity_type': kg.entity_type, 'ns': kg.ns, 'language': kg.language}
+        entity = country(kg, raw_entity(kg, ENTITY_QIDS[0]), num_props, num_values, rand)
+        other = country(kg, entity, num_props, num_values, rand)
+        # formatter lookups of the synthetic properties are cached by the first calls
+        fused, passes = kg._postprocess(entity, **kwargs), legacy._postprocess(entity, **kwargs)
+        if json.dumps(fused) != json.dumps(passes):
+            print('synthetic postprocess mismatch')
+            mismatches += 1
+        primary, secondary = fused, dict(kg._postprocess(other, **kwargs), id={'id': 'wd:Q183'})
+        if json.dumps(kg._merge(primary, secondary)) != json.dumps(legacy._merge(primary, secondary)):
+            print('synthetic merge mismatch')
+            mismatches += 1
+        print(f'entity: {len(entity)} properties, {len(json.dumps(entity))} bytes')
+        print(f'three passes   {timed(lambda: legacy._postprocess(entity, **kwargs), iterations):8.3f} ms')
+        print(f'postprocess    {timed(lambda: kg._postprocess(entity, **kwargs), iterations):8.3f} ms')
+        print(f'deepcopy merge {timed(lambda: legacy._merge(primary, secondary), iterations):8.3f} ms')
+        print(f'merge          {timed(lambda: kg._merge(primary, secondary), iterations):8.3f} ms')
+        print(f'output mismatches: {mismatches if mismatches else "none"}')
+        return 1 if mismatches else 0
+    finally:
+        shutil.rmtree(os.environ['CACHE_DIR'], ignore_errors=True)
+
+def usage():
+    print(f'{sys.argv[0]} [hn:p:v:]')
+    print('   -h --help          Print help message')
+    print('   -n --iterations    Number of timed iterations (default=20)')
+    print('   -p --props         Number of properties of the synthetic entity (default=150)')
+    print('   -v --values        Max number of values per property (default=60)')
+
+if __name__ == '__main__':
+    kwargs = {}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:p:v:', ['help', 'iterations', 'props', 'values'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-n', '--iterations'):
+            kwargs['iterations'] = int(a)
+        elif o in ('-p', '--props'):
+            kwargs['num_props'] = int(a)
+        elif o in ('-v', '--values'):
+            kwargs['num_values'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    sys.exit(run(**kwargs))
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compares the direct N-Triples projection (projection.Projector) with the rdflib + pyld
+   framing path (KnowledgeGraph._frame) on the N-Triples fixtures in benchmarks/fixtures and on
+   synthetic entities generated from the context term maps, both in full and streamed (in
+   shuffled line order).  Both paths are also checked against the expected entity of each
+   fixture (fixture.json, written with --update).  Exits non-zero on any difference.'''
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import getopt
+import json
+import random
+from time import time as now
+
+from rdflib import ConjunctiveGraph as Graph
+
+from entity import KnowledgeGraph, GRAPHS, CONTEXT_EXCLUDE_IN_FRAME
+from projection import Projector, parse_ntriples
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+LITERALS = [
+    '"plain"', '"with \\"quotes\\" and \\\\ and \\u00E9"', '"Linné"@sv', '"label"@en', '"Label"@EN-gb',
+    f'"1707-05-23T00:00:00Z"^^<{XSD}dateTime>', f'"2020-01-01T10:00:00.5Z"^^<{XSD}dateTime>',
+    f'"-0350-01-01T00:00:00Z"^^<{XSD}dateTime>', f'"0000-01-01T00:00:00Z"^^<{XSD}dateTime>',
+    f'"1.50"^^<{XSD}decimal>', f'"+12"^^<{XSD}decimal>', f'"007"^^<{XSD}integer>', f'"1.0E2"^^<{XSD}double>',
+    f'"1"^^<{XSD}boolean>', f'"2020-01-01"^^<{XSD}date>', f'"bogus"^^<{XSD}dateTime>', f'"x"^^<{XSD}string>',
+    '"Point(17.6 59.8)"^^<http://www.opengis.net/ont/geosparql#wktLiteral>', '"Q1043"'
+]
+
+def frame(kg, nt, context, entity_type):
+    graph = Graph()
+    graph.parse(data=nt, format='nt')
+    _jsonld = json.loads(str(graph.serialize(format='json-ld', context=context, indent=None), 'utf-8'))
+    if '@graph' not in _jsonld:
+        _context = _jsonld.pop('@context')
+        _jsonld = {'@context': _context, '@graph': [_jsonld]}
+    return kg._frame(_jsonld, context=context, entity_type=entity_type)
+
+def project(projector, nt, entity_type):
+    projected = projector.project(parse_ntriples(nt), entity_type=entity_type)
+    return next(iter(projected.values()), {})
+
+def project_streamed(projector, nt, entity_type, rand):
+    '''Streams the lines in random order, so subjects are split over several runs and merged'''
+    lines = nt.splitlines() + [f'<https://example.org/other> <https://example.org/p> "{i}" .' for i in range(10)]
+    rand.shuffle(lines)
+    node = {}
+    for _, _node in projector.iter_project(lines, entity_type=entity_type):
+        node = projector.merge(node, _node) if node else _node
+    return node
+
+def normalized(d):
+    '''Lists and blank node labels are compared ignoring order, the framing path does not preserve triple order'''
+    if isinstance(d, str) and d.startswith('_:'):
+        return '_:'
+    elif isinstance(d, dict):
+        return {k: normalized(v) for k, v in d.items()}
+    elif isinstance(d, list):
+        return sorted([normalized(v) for v in d], key=lambda v: json.dumps(v, sort_keys=True))
+    return d
+
+def golden_path(path):
+    return f'{os.path.splitext(path)[0]}.json'
+
+def check_golden(name, path, framed, projected, update=False):
+    '''Returns the number of differences with the expected entity of a fixture (the projection,
+       in order, and the framed entity, ignoring order), writing it with update=True'''
+    if update:
+        with open(golden_path(path), 'w') as fp:
+            json.dump(projected, fp, indent=2, ensure_ascii=False)
+            fp.write('\n')
+        return 0
+    if not os.path.exists(golden_path(path)):
+        print(f'MISSING expected entity {golden_path(path)}, write it with --update')
+        return 1
+    with open(golden_path(path), 'r') as fp:
+        expected = json.load(fp)
+    mismatches = 0
+    for label, entity, matches in (('projected', projected, projected == expected), ('framed', framed, normalized(framed) == normalized(expected))):
+        if not matches:
+            mismatches += 1
+            print(f'GOLDEN MISMATCH {name} ({label})')
+            for k in sorted(set(expected) | set(entity)):
+                if normalized(expected.get(k)) != normalized(entity.get(k)) or label == 'projected' and expected.get(k) != entity.get(k):
+                    print(f'   {k}: expected={json.dumps(expected.get(k))} {label}={json.dumps(entity.get(k))}')
+    return mismatches
+
+def synthetic(context, ns, rand, num_props):
+    base = GRAPHS[ns]['prefix'][1:-1]
+    expand = Projector(context).expand
+    subject = f'<{base}Q{rand.randint(1, 100000)}>'
+    lines = [f'{subject} <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> "entity" .']
+    iris = sorted(set(expand(v if isinstance(v, str) else v.get('@id', k)) for k, v in context.items() if not (isinstance(v, str) and v.startswith('@'))))
+    iris = [iri for iri in iris if not iri.endswith(('/', '#'))] + [f'{base[:-len("entity/")]}prop/direct/P99999']
+    for _ in range(num_props):
+        predicate = rand.choice(iris)
+        for _ in range(rand.choice((1, 1, 1, 2, 3))):
+            kind = rand.random()
+            if kind < 0.5:
+                obj = rand.choice(LITERALS)
+            elif kind < 0.8:
+                obj = f'<{base}Q{rand.randint(1, 1000)}>'
+            elif kind < 0.95:
+                obj = f'<https://example.org/{rand.randint(1, 1000)}>'
+            else:
+                obj = f'_:b{rand.randint(1, 1000)}'
+            lines.append(f'{subject} <{predicate}> {obj} .')
+    return '\n'.join(sorted(set(lines))) + '\n'
+
+def usage():
+    print(f'{sys.argv[0]} [hl:n:r:u] [fixture.nt ...]')
+    print('   -h --help          Print help message')
+    print('   -u --update        Write the expected entities of the fixtures (fixture.json)')
+    print('   -l --language      Language (en)')
+    print('   -n --num           Number of synthetic entities per namespace (200)')
+    print('   -r --repeat        Timing repetitions per fixture (20)')
+
+if __name__ == '__main__':
+    kwargs = {'language': 'en', 'num': 200, 'repeat': 20, 'update': False}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hl:n:r:u', ['help', 'language', 'num', 'repeat', 'update'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-l', '--language'):
+            kwargs['language'] = a
+        elif o in ('-n', '--num'):
+            kwargs['num'] = int(a)
+        elif o in ('-r', '--repeat'):
+            kwargs['repeat'] = int(a)
+        elif o in ('-u', '--update'):
+            kwargs['update'] = True
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    kg = KnowledgeGraph()
+    rand = random.Random(42)
+    paths = args if args else sorted(os.path.join(FIXTURES_DIR, f) for f in os.listdir(FIXTURES_DIR) if f.endswith('.nt'))
+    cases = []
+    for path in paths:
+        ns = os.path.basename(path).split('_')[0]
+        cases.append((path, ns, open(path, 'r').read()))
+    golden_mismatches = 0
+    for path, ns, nt in cases:
+        context = kg._get_context(ns, kwargs['language'])
+        projector = Projector(context, exclude=CONTEXT_EXCLUDE_IN_FRAME)
+        golden_mismatches += check_golden(path, path, frame(kg, nt, context, 'entity'), project(projector, nt, 'entity'), update=kwargs['update'])
+    for ns in GRAPHS:
+        context = kg._get_context(ns, kwargs['language'])
+        cases += [(f'synthetic {ns} #{i}', ns, synthetic(context, ns, rand, rand.randint(1, 40))) for i in range(kwargs['num'])]
+
+    mismatches = 0
+    elapsed = {'frame': 0.0, 'project': 0.0}
+    for name, ns, nt in cases:
+        context = kg._get_context(ns, kwargs['language'])
+        projector = Projector(context, exclude=CONTEXT_EXCLUDE_IN_FRAME)
+        framed, projected = frame(kg, nt, context, 'entity'), project(projector, nt, 'entity')
+        if normalized(projected) == normalized(framed):
+            # same result when streamed in arbitrary order
+            projected = project_streamed(projector, nt, 'entity', rand)
+        if normalized(framed) != normalized(projected):
+            mismatches += 1
+            print(f'MISMATCH {name}')
+            for k in sorted(set(framed) | set(projected)):
+                if normalized(framed.get(k)) != normalized(projected.get(k)):
+                    print(f'   {k}: framed={json.dumps(framed.get(k))} projected={json.dumps(projected.get(k))}')
+            continue
+        if not name.startswith('synthetic'):
+            for label, func in (('frame', lambda: frame(kg, nt, context, 'entity')), ('project', lambda: project(projector, nt, 'entity'))):
+                start = now()
+                for _ in range(kwargs['repeat']):
+                    func()
+                elapsed[label] += now() - start
+
+    print(f'{len(paths)} fixtures, {golden_mismatches} expected entity mismatches')
+    print(f'{len(cases)} cases, {mismatches} mismatches')
+    print(f'rdflib + pyld frame: {elapsed["frame"]:.3f}s  projection: {elapsed["project"]:.3f}s  ({kwargs["repeat"]} repetitions of {len(paths)} fixtures)')
+    sys.exit(1 if mismatches or golden_mismatches else 0)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compares the single-parse essay rendering pipeline (mw_to_html5 -> Essay -> add_vue_app on one
+   tree) with the previous string round trips through html5lib on a synthetic MediaWiki essay.
+   Entity data is served from the essay's own entity tags, no SPARQL queries are made.'''
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import getopt
+import random
+import re
+from time import time as now
+
+from bs4 import BeautifulSoup
+
+import essay_utils
+from essay_utils import Essay, mw_to_html5, add_vue_app
+
+WORDS = ('the', 'of', 'and', 'a', 'in', 'was', 'garden', 'river', 'letter', 'plant', 'city', 'museum',
+         'collection', 'published', 'century', 'botanist', 'with', 'from', 'during', 'expedition')
+
+class OfflineEssay(Essay):
+
+    def _iter_entity_data(self, qids):
+        return ({'qid': qid, 'description': f'description of {qid}'} for qid in qids)
+
+def make_essay(size, num_entities, rand):
+    '''MediaWiki parser output of roughly size bytes'''
+    labels = [f'Entity{i}' for i in range(num_entities)]
+    parts = ['<div class="mw-parser-output">', '<div id="toc" class="toc"><ul><li>Contents</li></ul></div>']
+    section = 0
+    while sum(len(p) for p in parts) < size:
+        if rand.random() < 0.1:
+            section += 1
+            level = rand.choice((2, 2, 3))
+            parts.append(f'<h{level}><span class="mw-headline" id="Section_{section}">Section {section}</span>'
+                         f'<span class="mw-editsection">[<a href="#">edit</a>]</span></h{level}>')
+        words = [rand.choice(labels) if rand.random() < 0.03 else rand.choice(WORDS) for _ in range(rand.randint(40, 120))]
+        paragraph = ' '.join(words)
+        if rand.random() < 0.3:
+            qid = rand.randrange(num_entities)
+            paragraph += f' <span data-entity="" data-qid="Q{qid}" data-label="Entity{qid}" data-aliases="E{qid}"></span>'
+        if rand.random() < 0.1:
+            paragraph += f' <span class="entity" data-qid="Q{rand.randrange(num_entities)}">linked <i>text</i></span>'
+        parts.append(f'<p>{paragraph}</p>')
+        if rand.random() < 0.02:
+            parts.append('<div data-map="" data-center="38.9,-77.0" data-zoom="5"></div>')
+    parts.append('</div>')
+    body = '\n'.join(parts)
+    return f'<!doctype html><html lang="en">\n<head>\n<meta charset="utf-8">\n<title>Essay</title>\n</head>\n<body>\n{body}\n</body>\n</html>'
+
+def legacy_render(html):
+    '''Pipeline used by handler.get_essay before the single-parse change'''
+    essay_utils.HTML_PARSER = 'html5lib'
+    essay = OfflineEssay(str(mw_to_html5(html)))
+    return add_vue_app(essay.html)
+
+def render(html, parser):
+    essay_utils.HTML_PARSER = parser
+    return add_vue_app(OfflineEssay(mw_to_html5(html)).soup)
+
+def outline(html):
+    '''Normalized structure and text of a rendered essay, for comparison across parsers'''
+    soup = BeautifulSoup(html, 'html5lib')
+    article = soup.find('article')
+    tags = [(tag.name, tag.attrs.get('id'), tag.attrs.get('data-qid'), ' '.join(tag.attrs.get('class', [])) if isinstance(tag.attrs.get('class'), list) else tag.attrs.get('class'))
+            for tag in article.find_all(True) if tag.name != 'script']
+    text = re.sub(r'\s+', ' ', ''.join(s for s in article.find_all(string=True) if s.parent.name != 'script')).strip()
+    data = [s.string for s in article.find_all('script')]
+    return tags, text, data
+
+def usage():
+    print(f'{sys.argv[0]} [hs:e:r:]')
+    print('   -h --help          Print help message')
+    print('   -s --size          Essay size in bytes (default=200000)')
+    print('   -e --entities      Number of distinct entities (default=100)')
+    print('   -r --repeat        Timing repetitions (default=3)')
+
+if __name__ == '__main__':
+    kwargs = {'size': 200000, 'entities': 100, 'repeat': 3}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hs:e:r:', ['help', 'size', 'entities', 'repeat'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-s', '--size'):
+            kwargs['size'] = int(a)
+        elif o in ('-e', '--entities'):
+            kwargs['entities'] = int(a)
+        elif o in ('-r', '--repeat'):
+            kwargs['repeat'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    html = make_essay(kwargs['size'], kwargs['entities'], random.Random(42))
+    pipelines = [('html5lib, 3 parses', legacy_render)] + [(f'{parser}, 1 parse', lambda html, parser=parser: render(html, parser)) for parser in ('html5lib', 'lxml')]
+    results = {}
+    for name, pipeline in pipelines:
+        start = now()
+        for _ in range(kwargs['repeat']):
+            results[name] = pipeline(html)
+        print(f'{name:20} {(now() - start) / kwargs["repeat"]:.3f}s per essay ({len(html)} bytes in, {len(results[name])} bytes out)')
+
+    reference = outline(results[pipelines[0][0]])
+    mismatches = [name for name, _ in pipelines[1:] if outline(results[name]) != reference]
+    print(f'outline mismatches: {mismatches if mismatches else "none"}')
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compares the section index built by Essay._index_sections with the previous per-element
+   ancestor walks on a synthetic essay with deeply nested sections and markup.'''
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import getopt
+import random
+from time import time as now
+
+from bs4 import BeautifulSoup
+
+from essay_utils import Essay, HTML_PARSER
+
+class OfflineEssay(Essay):
+
+    def _iter_entity_data(self, qids):
+        return iter(())
+
+def legacy_parent_section_id(elem, default=None):
+    '''Essay._parent_section_id before the section index'''
+    parent_section = None
+    while elem.parent and parent_section is None:
+        if elem.name == 'section':
+            parent_section = elem
+        elem = elem.parent
+    return parent_section.attrs['id'] if parent_section and 'id' in parent_section.attrs else default
+
+def legacy_section_ids_for_elem(elem):
+    '''Essay._section_ids_for_elem before the section index'''
+    section_ids = set()
+    while elem:
+        if elem.name in('section', 'article') and 'id' in elem.attrs:
+            section_ids.add(elem.attrs['id'])
+        elem = elem.parent
+    return section_ids
+
+def make_essay(num_sections, section_depth, markup_depth, rand):
+    '''Sections nested section_depth deep, each paragraph wrapped in markup_depth nested elements'''
+    def section(sid, depth):
+        parts = [f'<section id="{sid}"><h2>{sid}</h2>']
+        for p in range(rand.randint(2, 6)):
+            wrappers = [rand.choice(('div', 'blockquote', 'span', 'b', 'i')) for _ in range(markup_depth)]
+            text = ' '.join(rand.choice(('a', 'garden', 'river', 'letter')) for _ in range(20))
+            inner = f'<span data-entity="" data-qid="Q{p}"></span>{text}'
+            for w in reversed(wrappers):
+                inner = f'<{w}>{inner} tail</{w}>'
+            parts.append(f'<p>{inner}</p>')
+        if depth < section_depth:
+            parts += [section(f'{sid}_{i}', depth + 1) for i in range(2)]
+        parts.append('</section>')
+        return ''.join(parts)
+    body = ''.join(section(f's{i}', 1) for i in range(num_sections))
+    return f'<!doctype html><html lang="en"><head><title>Essay</title></head><body><article id="essay">{body}</article></body></html>'
+
+def usage():
+    print(f'{sys.argv[0]} [hs:d:m:]')
+    print('   -h --help          Print help message')
+    print('   -s --sections      Number of top level sections (default=10)')
+    print('   -d --depth         Section nesting depth (default=6)')
+    print('   -m --markup        Markup nesting depth inside paragraphs (default=20)')
+
+if __name__ == '__main__':
+    kwargs = {'sections': 10, 'depth': 6, 'markup': 20}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hs:d:m:', ['help', 'sections', 'depth', 'markup'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-s', '--sections'):
+            kwargs['sections'] = int(a)
+        elif o in ('-d', '--depth'):
+            kwargs['depth'] = int(a)
+        elif o in ('-m', '--markup'):
+            kwargs['markup'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    html = make_essay(kwargs['sections'], kwargs['depth'], kwargs['markup'], random.Random(42))
+    essay = OfflineEssay(BeautifulSoup(html, HTML_PARSER))
+    soup = essay.soup
+    texts = [s for s in soup.find_all(string=True) if s.strip()]
+    elems = soup.find_all(True)
+    print(f'{len(elems)} elements, {len(texts)} text nodes')
+
+    start = now()
+    legacy = ([legacy_section_ids_for_elem(s) for s in texts], [legacy_parent_section_id(e, 'essay') for e in elems])
+    legacy_elapsed = now() - start
+
+    start = now()
+    essay._index_sections()
+    index_elapsed = now() - start
+    start = now()
+    indexed = ([essay._section_ids_for_elem(s) for s in texts], [essay._parent_section_id(e, 'essay') for e in elems])
+    lookup_elapsed = now() - start
+
+    print(f'ancestor walks: {legacy_elapsed:.3f}s  index: {index_elapsed:.3f}s build + {lookup_elapsed:.3f}s lookups')
+    mismatches = sum(1 for a, b in zip(legacy[0] + legacy[1], indexed[0] + indexed[1]) if a != b)
+    print(f'mismatches: {mismatches}')
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Offline benchmark suite for the entity and essay pipelines.
+
+   Upstream calls (SPARQL endpoints, MediaWiki, WB service, Wikipedia) are served from the
+   responses recorded in fixtures/recordings by transport.ReplayAdapter, and the cache lives
+   in a temporary directory, so runs are repeatable and make no network calls.  Each stage is
+   timed over a number of iterations and reports throughput, latency percentiles and the peak
+   memory (tracemalloc) of one iteration.  Results are compared with baselines.json, a stage
+   slower (or bigger) than its baseline by more than the tolerance fails the run.
+
+   Re-record the fixtures against the live services with --record.'''
+
+import os
+import sys
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+import getopt
+import json
+import logging
+import shutil
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+RECORDINGS_DIR = os.path.join(BENCHMARKS_DIR, 'fixtures', 'recordings')
+BASELINES_PATH = os.path.join(BENCHMARKS_DIR, 'baselines.json')
+
+ENTITY_QID = 'Q100'
+SECONDARY_QID = 'wd:Q1043'
+ESSAY_TITLE = 'Benchmark_essay'
+
+# Differences below these are noise, whatever the tolerance
+MIN_LATENCY_DELTA_MS = 1.0
+MIN_MEMORY_DELTA_KB = 64
+
+def stages():
+    '''Returns [(name, setup, func)], func(setup()) is timed'''
+    import handler
+    from caching import cache
+    from entity import KnowledgeGraph, formatter_index
+    from essay_utils import Essay, EssayUtils, mw_to_html5
+
+    # build the formatter index up front, lookups do not build it
+    formatter_index().refresh()
+
+    kg = KnowledgeGraph()
+    kwargs = {'context': kg._get_context(kg.ns, kg.language), 'entity_type': kg.entity_type, 'ns': kg.ns, 'language': kg.language}
+    sparql = kg._entity_sparql(ENTITY_QID, kg.language, kg.entity_type)
+    essay_event = {'queryStringParameters': None, 'body': None, 'pathParameters': {'title': ESSAY_TITLE}, 'headers': {'Accept-Encoding': 'gzip'}}
+
+    class UntaggedEssay(Essay):
+        def _tag_entities(self):
+            pass
+
+    # inputs of the single pass stages, fetched once with a warm cache
+    kg.entity(ENTITY_QID)
+    raw = next(iter(kg._query_entities(sparql, kg.ns, kg.language, kg.entity_type).values()))
+    filtered = kg._filter_props(raw, **kwargs)
+    linked = kg._link_values(filtered, **kwargs)
+    primary, secondary = kg._entity(kg._qualified(ENTITY_QID)), kg._entity(SECONDARY_QID)
+    client = EssayUtils()
+    page_html = client.page(ESSAY_TITLE, revid=client.revision(ESSAY_TITLE))['html']
+
+    def clear_cache():
+        cache.clear()
+
+    return [
+        ('entity_cold', clear_cache, lambda _: kg.entity(ENTITY_QID)),
+        ('entity_warm', None, lambda _: kg.entity(ENTITY_QID)),
+        ('query_entities', None, lambda _: kg._query_entities(sparql, kg.ns, kg.language, kg.entity_type)),
+        ('filter_props', None, lambda _: kg._filter_props(raw, **kwargs)),
+        ('link_values', None, lambda _: kg._link_values(filtered, **kwargs)),
+        ('add_id_labels', None, lambda _: kg._add_id_labels(linked, **kwargs)),
+        ('postprocess', None, lambda _: kg._postprocess(raw, **kwargs)),
+        ('merge', None, lambda _: kg._merge(primary, secondary)),
+        ('mw_to_html5', None, lambda _: mw_to_html5(page_html)),
+        ('tag_entities', lambda: UntaggedEssay(mw_to_html5(page_html)), lambda essay: Essay._tag_entities(essay)),
+        ('get_essay_cold', clear_cache, lambda _: handler.get_essay(essay_event, None)),
+        ('get_essay_warm', None, lambda _: handler.get_essay(essay_event, None)),
+    ]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+def measure(setup, func, iterations):
+    '''Returns latency percentiles (ms), throughput (ops/s) and peak memory (KB) of func'''
+    func(setup() if setup else None)  # warm up
+    latencies = []
+    for _ in range(iterations):
+        arg = setup() if setup else None
+        start = perf_counter()
+        func(arg)
+        latencies.append((perf_counter() - start) * 1000)
+    arg = setup() if setup else None
+    tracemalloc.start()
+    func(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p90_ms': round(percentile(latencies, 0.9), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'ops_per_s': round(len(latencies) / (sum(latencies) / 1000), 1),
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+def regressions(results, baselines, tolerance):
+    '''Returns [(stage, message)] for stages slower or bigger than their baseline'''
+    found = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if not baseline:
+            continue
+        if result['p50_ms'] > baseline['p50_ms'] * (1 + tolerance) and result['p50_ms'] - baseline['p50_ms'] > MIN_LATENCY_DELTA_MS:
+            found.append((name, f'p50 {result["p50_ms"]}ms, baseline {baseline["p50_ms"]}ms'))
+        if result['peak_kb'] > baseline['peak_kb'] * (1 + tolerance) and result['peak_kb'] - baseline['peak_kb'] > MIN_MEMORY_DELTA_KB:
+            found.append((name, f'peak {result["peak_kb"]}KB, baseline {baseline["peak_kb"]}KB'))
+    return found
+
+def run(iterations=20, only=None, record=False, save_baseline=False, tolerance=0.5):
+    cache_dir = tempfile.mkdtemp(prefix='essay-utils-bench-')
+    os.environ['CACHE_DIR'] = cache_dir
+    os.environ['HTTP_REPLAY_DIR'] = RECORDINGS_DIR
+    if record:
+        os.environ['HTTP_RECORD'] = 'true'
+    try:
+        selected = [stage for stage in stages() if not only or stage[0] in only]
+        logging.getLogger().setLevel(logging.CRITICAL)
+        logging.getLogger('timing').setLevel(logging.CRITICAL)
+        if record:
+            # one pass through every stage records the responses it needs
+            for name, setup, func in selected:
+                func(setup() if setup else None)
+            print(f'Recorded responses into {RECORDINGS_DIR}')
+            return 0
+
+        results = {}
+        print(f'{"stage":16} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"ops/s":>9} {"peak KB":>9}')
+        for name, setup, func in selected:
+            results[name] = measure(setup, func, iterations)
+            r = results[name]
+            print(f'{name:16} {r["p50_ms"]:9.3f} {r["p90_ms"]:9.3f} {r["p99_ms"]:9.3f} {r["ops_per_s"]:9.1f} {r["peak_kb"]:9.1f}')
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    if save_baseline:
+        baselines = {}
+        if os.path.exists(BASELINES_PATH):
+            with open(BASELINES_PATH, 'r') as fp:
+                baselines = json.load(fp)
+        baselines.update(dict([(name, {'p50_ms': r['p50_ms'], 'peak_kb': r['peak_kb']}) for name, r in results.items()]))
+        with open(BASELINES_PATH, 'w') as fp:
+            json.dump(baselines, fp, indent=2, sort_keys=True)
+        print(f'Saved baselines to {BASELINES_PATH}')
+        return 0
+
+    if not os.path.exists(BASELINES_PATH):
+        return 0
+    with open(BASELINES_PATH, 'r') as fp:
+        found = regressions(results, json.load(fp), tolerance)
+    for name, message in found:
+        print(f'REGRESSION {name}: {message}')
+    return 1 if found else 0
+
+def usage():
+    print(f'{sys.argv[0]} [hn:s:t:bR]')
+    print('   -h --help          Print help message')
+    print('   -n --iterations    Timed iterations per stage (default=20)')
+    print('   -s --stages        Comma separated stages to run (default=all)')
+    print('   -t --tolerance     Allowed slowdown over the baseline, as a fraction (default=0.5)')
+    print('   -b --baseline      Save the results as the new baselines')
+    print('   -R --record        Record upstream responses from the live services')
+
+if __name__ == '__main__':
+    kwargs = {}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:s:t:bR', ['help', 'iterations', 'stages', 'tolerance', 'baseline', 'record'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-n', '--iterations'):
+            kwargs['iterations'] = int(a)
+        elif o in ('-s', '--stages'):
+            kwargs['only'] = a.split(',')
+        elif o in ('-t', '--tolerance'):
+            kwargs['tolerance'] = float(a)
+        elif o in ('-b', '--baseline'):
+            kwargs['save_baseline'] = True
+        elif o in ('-R', '--record'):
+            kwargs['record'] = True
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    sys.exit(run(**kwargs))
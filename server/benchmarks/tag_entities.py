@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compares the trie-based EntityMatcher used by Essay._tag_entities with the
+   previous per-label regex scan on a synthetic essay.'''
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import getopt
+import random
+import re
+from time import time as now
+
+from essay_utils import Entity, EntityMatcher
+
+WORDS = ('the', 'of', 'and', 'a', 'in', 'was', 'garden', 'river', 'letter', 'plant', 'city', 'museum',
+         'collection', 'published', 'century', 'botanist', 'with', 'from', 'during', 'expedition')
+
+def make_entities(num_entities, rand):
+    entities = []
+    for i in range(num_entities):
+        label = ' '.join(rand.choice(('Saint', 'North', 'Royal', 'Old', 'New', 'Great')) for _ in range(rand.randint(0, 2)))
+        label = f'{label} Entity{i}'.strip()
+        aliases = [f'E{i} alias', f'Entity-{i}'] if i % 3 == 0 else None
+        entities.append(Entity(qid=f'Q{i}', label=label, aliases=aliases))
+    return entities
+
+def make_paragraphs(entities, num_words, words_per_paragraph, rand):
+    terms = [e.label for e in entities] + [a for e in entities if e.aliases for a in e.aliases]
+    paragraphs, words = [], []
+    for _ in range(num_words):
+        words.append(rand.choice(terms) if rand.random() < 0.05 else rand.choice(WORDS))
+        if len(words) == words_per_paragraph:
+            paragraphs.append(' '.join(words))
+            words = []
+    if words:
+        paragraphs.append(' '.join(words))
+    return paragraphs
+
+def legacy_find(entities, text):
+    '''Matching loop used by Essay._tag_entities before EntityMatcher'''
+    to_match = {}
+    for entity in entities:
+        to_match[entity.label.lower()] = entity
+        if entity.aliases:
+            for alias in entity.aliases:
+                to_match[alias.lower()] = entity
+    snorm = text.lower()
+    matches = []
+    for tm in sorted(to_match.keys(), key=len, reverse=True):
+        try:
+            for m in [m.start() for m in re.finditer(tm, snorm)]:
+                start, end = m, m + len(tm)
+                overlaps = False
+                for match in matches:
+                    mstart = match['idx']
+                    mend = mstart + len(match['matched'])
+                    if (start >= mstart and start <= mend) or (end >= mstart and end <= mend):
+                        overlaps = True
+                        break
+                if not overlaps:
+                    matches.append({'idx': m, 'matched': text[m:m+len(tm)], 'entity': to_match[tm]})
+        except:
+            pass
+    matches.sort(key=lambda x: x['idx'])
+    return [(m['idx'], m['idx'] + len(m['matched']), m['entity']) for m in matches]
+
+def run(num_entities=500, num_words=50000, words_per_paragraph=100, seed=1):
+    rand = random.Random(seed)
+    entities = make_entities(num_entities, rand)
+    paragraphs = make_paragraphs(entities, num_words, words_per_paragraph, rand)
+    print(f'entities={num_entities} words={num_words} text_nodes={len(paragraphs)}')
+
+    start = now()
+    legacy = [legacy_find(entities, p) for p in paragraphs]
+    legacy_secs = now() - start
+
+    start = now()
+    matcher = EntityMatcher(entities)
+    found = [matcher.find(p) for p in paragraphs]
+    matcher_secs = now() - start
+
+    legacy_count = sum(len(m) for m in legacy)
+    matcher_count = sum(len(m) for m in found)
+    differing = sum(1 for a, b in zip(legacy, found) if a != b)
+    print(f'legacy:  {legacy_secs:8.3f}s matches={legacy_count}')
+    print(f'matcher: {matcher_secs:8.3f}s matches={matcher_count} speedup={legacy_secs/matcher_secs:.1f}x')
+    print(f'text nodes with differing matches: {differing}')
+
+def usage():
+    print(f'{sys.argv[0]} [he:w:p:]')
+    print(f'   -h --help          Print help message')
+    print(f'   -e --entities      Number of synthetic entities (default=500)')
+    print(f'   -w --words         Number of words in synthetic essay (default=50000)')
+    print(f'   -p --paragraph     Words per text node (default=100)')
+
+if __name__ == '__main__':
+    kwargs = {}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'he:w:p:', ['help', 'entities', 'words', 'paragraph'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-e', '--entities'):
+            kwargs['num_entities'] = int(a)
+        elif o in ('-w', '--words'):
+            kwargs['num_words'] = int(a)
+        elif o in ('-p', '--paragraph'):
+            kwargs['words_per_paragraph'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+
+    run(**kwargs)
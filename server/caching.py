@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Two tier (in-process LRU + diskcache) cache shared by entity.py and essay_utils.py.
+
+   Memoized functions are keyed by their name and canonical (bound, defaults applied) arguments.
+   For methods, self is replaced by the object's _cache_identity() (when defined), so equal
+   KnowledgeGraph instances share entries across requests and invocations.  Each function has
+   its own TTL, and the disk tier is bounded to CACHE_SIZE_LIMIT bytes.
+
+   Concurrent misses on the same key are coalesced (single flight): one caller computes the
+   value while the others wait for it, threads on an in-process event, coroutines on a future
+   of their event loop and other processes on a lock entry in the disk tier.
+
+   A memoized function can return expiring(value, ttl) to store a result for less time than
+   its TTL (e.g. a "not found" answer), or uncached(value) to not store it at all (e.g. the
+   fallback value returned on an upstream error).'''
+
+import logging
+logger = logging.getLogger()
+
+import os
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+import asyncio
+import functools
+import inspect
+import threading
+import weakref
+from collections import OrderedDict
+from time import sleep, time as now
+
+import timing
+
+# Max size (bytes) of the disk tier, least recently stored entries are evicted beyond this
+CACHE_SIZE_LIMIT = int(os.environ.get('CACHE_SIZE_LIMIT', 256 * 1024 * 1024))
+# Max number of entries held in the in-process LRU tier
+CACHE_LRU_SIZE = int(os.environ.get('CACHE_LRU_SIZE', 4096))
+# Directory of the disk tier, defaults to the server directory (a temporary directory on Lambda)
+CACHE_DIR = os.environ.get('CACHE_DIR', BASE_DIR if BASE_DIR != '/var/task' else None)
+# Number of disk writes between eviction (cull) passes
+CACHE_CULL_INTERVAL = 100
+# Max seconds a caller waits for a coalesced computation before computing the value itself,
+# also the expiry of the cross-process lock of a crashed process
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 30))
+# Max seconds between polls of the cross-process lock
+SINGLE_FLIGHT_MAX_POLL = 0.05
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# Max age (seconds) of cached "not found" results, short so new data shows up soon
+NOT_FOUND_TTL = int(os.environ.get('NOT_FOUND_TTL', HOUR))
+
+MISSING = object()
+
+class Expiring(object):
+    '''A computed value stored with its own TTL instead of the function's, ttl=0 is not stored'''
+    __slots__ = ('value', 'ttl')
+
+    def __init__(self, value, ttl):
+        self.value = value
+        self.ttl = ttl
+
+def expiring(value, ttl=NOT_FOUND_TTL):
+    return Expiring(value, ttl)
+
+def uncached(value):
+    return Expiring(value, 0)
+
+class _Flight(object):
+    '''A computation in progress, shared by the callers missing the same key'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = MISSING
+        self.error = None
+
+    def result(self, timeout=SINGLE_FLIGHT_TIMEOUT):
+        '''Waits for the value, MISSING on timeout; re-raises the error of a failed computation'''
+        if not self.done.wait(timeout):
+            return MISSING
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class TieredCache(object):
+
+    def __init__(self, directory=None, size_limit=CACHE_SIZE_LIMIT, lru_size=CACHE_LRU_SIZE):
+        self._directory = directory
+        self.size_limit = size_limit
+        self._disk = None
+        self.lru_size = lru_size
+        self.ttls = {}
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._stats = {}
+        self._flights = {}
+        # event loop -> key -> future of the coroutine computing it
+        self._aflights = weakref.WeakKeyDictionary()
+
+    @property
+    def disk(self):
+        '''The diskcache tier, opened on first use'''
+        if self._disk is None:
+            with self._lock:
+                if self._disk is None:
+                    from diskcache import Cache
+                    # culling is done in set() so evictions can be counted
+                    self._disk = Cache(self._directory, size_limit=self.size_limit, cull_limit=0)
+        return self._disk
+
+    @property
+    def directory(self):
+        return self.disk.directory
+
+    def _count(self, name, stat):
+        timing.count(f'cache_{stat}')
+        with self._lock:
+            stats = self._stats.setdefault(name, {'lru_hits': 0, 'disk_hits': 0, 'misses': 0, 'sets': 0})
+            stats[stat] = stats.get(stat, 0) + 1
+
+    def _lru_put(self, key, value, expire_at):
+        with self._lock:
+            self._lru[key] = (value, expire_at)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+                self._stats.setdefault('_lru', {'evictions': 0})['evictions'] += 1
+
+    def get(self, key, default=None):
+        '''Returns the cached value for key, default if missing or expired.  Values are shared
+           between callers through the LRU tier and must not be modified.'''
+        name = key[0] if isinstance(key, tuple) else '_'
+        with self._lock:
+            entry = self._lru.get(key, MISSING)
+            if entry is not MISSING:
+                if entry[1] is None or entry[1] > now():
+                    self._lru.move_to_end(key)
+                else:
+                    del self._lru[key]
+                    entry = MISSING
+        if entry is not MISSING:
+            self._count(name, 'lru_hits')
+            return entry[0]
+        value, expire_at = self.disk.get(key, default=MISSING, expire_time=True)
+        if value is MISSING:
+            self._count(name, 'misses')
+            return default
+        self._count(name, 'disk_hits')
+        self._lru_put(key, value, expire_at)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def set(self, key, value, ttl=MISSING):
+        '''Stores value in both tiers, ttl defaults to the TTL of the function named by key[0]'''
+        name = key[0] if isinstance(key, tuple) else '_'
+        ttl = self.ttls.get(name) if ttl is MISSING else ttl
+        self.disk.set(key, value, expire=ttl)
+        self._lru_put(key, value, now() + ttl if ttl else None)
+        self._count(name, 'sets')
+        with self._lock:
+            self._writes += 1
+            cull = self._writes % CACHE_CULL_INTERVAL == 0
+        if cull:
+            self._cull()
+        return value
+
+    def _store(self, key, result, ttl=MISSING):
+        '''Stores a computed result, unwrapping (and honouring the TTL of) an Expiring result'''
+        if isinstance(result, Expiring):
+            return self.set(key, result.value, ttl=result.ttl) if result.ttl != 0 else result.value
+        return self.set(key, result, ttl)
+
+    def _cull(self):
+        evicted = self.disk.cull()
+        if evicted:
+            with self._lock:
+                self._stats.setdefault('_disk', {'evictions': 0})['evictions'] += evicted
+
+    def delete(self, key):
+        with self._lock:
+            self._lru.pop(key, None)
+        return self.disk.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+        return self.disk.clear()
+
+    def stats(self):
+        '''Returns per-function hit/miss counts and per-tier evictions and sizes'''
+        with self._lock:
+            stats = dict([(name, dict(stats)) for name, stats in self._stats.items()])
+            stats['_lru'] = dict(stats.get('_lru', {'evictions': 0}), entries=len(self._lru), max_entries=self.lru_size)
+        stats['_disk'] = dict(stats.get('_disk', {'evictions': 0}), volume=self.disk.volume(), size_limit=self.disk.size_limit)
+        return stats
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+    def _join(self, key):
+        '''Returns (flight, leader), leader is True for the caller that has to compute the value'''
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def _land(self, key, flight, value=MISSING, error=None):
+        flight.value, flight.error = value, error
+        with self._lock:
+            self._flights.pop(key, None)
+        flight.done.set()
+
+    def _ajoin(self, key):
+        '''_join for coroutines, the flight is a future of the running event loop'''
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            flights = self._aflights.setdefault(loop, {})
+        future = flights.get(key)
+        if future is not None:
+            return future, False
+        future = flights[key] = loop.create_future()
+        return future, True
+
+    def _aland(self, key, future, value=MISSING, error=None):
+        self._aflights.get(future.get_loop(), {}).pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+            # retrieved, so a flight without waiters is not reported
+            future.exception()
+        else:
+            future.set_result(value)
+
+    def _lock_disk(self, key, lock_key):
+        '''Takes the cross-process lock of key, returns (locked, value).  Gives up the wait when
+           another process stores the value (returned) or after SINGLE_FLIGHT_TIMEOUT.'''
+        deadline = now() + SINGLE_FLIGHT_TIMEOUT
+        delay = 0.001
+        while not self.disk.add(lock_key, os.getpid(), expire=SINGLE_FLIGHT_TIMEOUT):
+            value = self.disk.get(key, default=MISSING)
+            if value is not MISSING or now() > deadline:
+                return False, value
+            sleep(delay)
+            delay = min(delay * 2, SINGLE_FLIGHT_MAX_POLL)
+        return True, MISSING
+
+    def single_flight(self, key, compute, ttl=MISSING):
+        '''Returns the value of key, calling compute() and storing its result (see Expiring) on a
+           miss.  Only one thread (in this process) and one process compute a key at a time, the
+           others wait for and share its result.'''
+        name = key[0] if isinstance(key, tuple) else '_'
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        flight, leader = self._join(key)
+        if not leader:
+            self._count(name, 'coalesced')
+            value = flight.result()
+            return value if value is not MISSING else self._store(key, compute(), ttl)
+        try:
+            lock_key = ('single_flight',) + (key if isinstance(key, tuple) else (key,))
+            locked, value = self._lock_disk(key, lock_key)
+            try:
+                if value is MISSING and locked:
+                    # another process may have stored the value while this one waited for the lock
+                    value = self.disk.get(key, default=MISSING)
+                if value is MISSING:
+                    value = self._store(key, compute(), ttl)
+                else:
+                    self._count(name, 'coalesced')
+            finally:
+                if locked:
+                    self.disk.delete(lock_key)
+        except BaseException as e:
+            self._land(key, flight, error=e)
+            raise
+        self._land(key, flight, value)
+        return value
+
+    async def asingle_flight(self, key, compute, ttl=MISSING):
+        '''single_flight for a coroutine function, waiting without blocking the event loop (or
+           a thread).  Coalesces the callers within an event loop only.'''
+        name = key[0] if isinstance(key, tuple) else '_'
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        future, leader = self._ajoin(key)
+        if not leader:
+            self._count(name, 'coalesced')
+            try:
+                value = await asyncio.wait_for(asyncio.shield(future), SINGLE_FLIGHT_TIMEOUT)
+            except asyncio.TimeoutError:
+                value = MISSING
+            return value if value is not MISSING else self._store(key, await compute(), ttl)
+        try:
+            value = self._store(key, await compute(), ttl)
+        except asyncio.CancelledError:
+            # the waiters compute the value themselves
+            self._aland(key, future)
+            raise
+        except BaseException as e:
+            self._aland(key, future, error=e)
+            raise
+        self._aland(key, future, value)
+        return value
+
+    def memoize(self, ttl=None, name=None):
+        '''Memoizing decorator, ttl in seconds (None = no expiry).  Concurrent calls missing the
+           same key are coalesced into one call (see single_flight).  The decorated function gets
+           a cache_key(*args, **kwargs) attribute returning the key used for a call.'''
+        def decorator(func):
+            _name = name if name else func.__qualname__
+            signature = inspect.signature(func)
+            is_method = next(iter(signature.parameters), None) == 'self'
+            self.ttls[_name] = ttl
+
+            def cache_key(*args, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                key = [_name]
+                for param, value in bound.arguments.items():
+                    if is_method and param == 'self':
+                        identity = getattr(value, '_cache_identity', None)
+                        key.append(identity() if identity else None)
+                    elif signature.parameters[param].kind == inspect.Parameter.VAR_KEYWORD:
+                        key.append(tuple(sorted(value.items())))
+                    else:
+                        key.append(value)
+                return tuple(key)
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return self.single_flight(cache_key(*args, **kwargs), lambda: func(*args, **kwargs))
+
+            wrapper.cache_key = cache_key
+            wrapper.ttl = ttl
+            return wrapper
+        return decorator
+
+cache = TieredCache(CACHE_DIR)
+
+def stats():
+    return cache.stats()
+
+def reset_stats():
+    cache.reset_stats()
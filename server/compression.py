@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Conditional and compressed HTTP responses shared by the Lambda handlers and the Flask app.
+
+   Bodies are gzip or brotli (when the brotli module is installed) encoded per Accept-Encoding.
+   Each representation gets its own content hash ETag ("<hash>", "<hash>-gzip", "<hash>-br"),
+   and an If-None-Match matching the one selected gets a 304.  Encoded variants are cached by
+   content hash and encoding, so a rendered essay is compressed once per revision.'''
+
+import logging
+logger = logging.getLogger()
+
+import gzip
+import hashlib
+
+from caching import cache, DAY
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this (bytes) are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+# Max age (seconds) of cached compressed variants, keyed by content hash so never stale
+COMPRESSED_TTL = DAY
+
+# Supported encodings, in order of preference
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+def digest(body):
+    '''Content hash of a response body'''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha1(body).hexdigest()[:24]
+
+def etag(body, encoding=None, _digest=None):
+    '''Strong ETag of a response body as sent with encoding (None for identity)'''
+    _digest = _digest if _digest else digest(body)
+    return f'"{_digest}-{encoding}"' if encoding else f'"{_digest}"'
+
+def not_modified(if_none_match, _etag):
+    '''True if an If-None-Match header value matches the ETag'''
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # weak comparison (as required for If-None-Match), a proxy may have weakened the ETag
+    return any((tag[2:] if tag.startswith('W/') else tag) == _etag for tag in (tag.strip() for tag in if_none_match.split(',')))
+
+def accepted_encoding(accept_encoding):
+    '''Returns the preferred supported encoding in an Accept-Encoding header value, None for identity'''
+    if not accept_encoding:
+        return None
+    qvalues = {}
+    for coding in accept_encoding.lower().split(','):
+        name, _, params = coding.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        qvalues[name.strip()] = q
+    accepted = [(qvalues.get(encoding, qvalues.get('*', 0.0)), -rank, encoding) for rank, encoding in enumerate(ENCODINGS)]
+    best = max(accepted)
+    return best[2] if best[0] > 0 else None
+
+def compress(body, encoding, _digest=None):
+    '''Returns body (bytes) encoded with encoding, cached by content hash'''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    key = ('compression.compress', _digest if _digest else digest(body), encoding)
+    encoded = cache.get(key)
+    if encoded is None:
+        if encoding == 'br':
+            encoded = brotli.compress(body, quality=BROTLI_QUALITY)
+        else:
+            encoded = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        cache.set(key, encoded, ttl=COMPRESSED_TTL)
+    return encoded
+
+def respond(body, request_headers, content_type):
+    '''Returns (status, headers, body) for a response body given the request headers (a mapping
+       with lower case keys, or a case insensitive one).  The body is bytes when encoded, and
+       empty for a 304.'''
+    request_headers = request_headers or {}
+    encoding = accepted_encoding(request_headers.get('accept-encoding'))
+    if len(body) < COMPRESS_MIN_SIZE:
+        encoding = None
+    _digest = digest(body)
+    _etag = etag(body, encoding, _digest)
+    headers = {'ETag': _etag, 'Vary': 'Accept-Encoding'}
+    if not_modified(request_headers.get('if-none-match'), _etag):
+        return 304, headers, ''
+    headers['Content-Type'] = content_type
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        return 200, headers, compress(body, encoding, _digest)
+    return 200, headers, body
@@ -14,18 +14,21 @@ import sys
 import traceback
 from time import time as now
 from urllib.parse import quote
+import asyncio
 import concurrent.futures
-from copy import deepcopy
+import functools
+import threading
+import weakref
 
-from diskcache import Cache
 logger.error(f'BASE_DIR={BASE_DIR}')
-cache = Cache(BASE_DIR) if BASE_DIR != '/var/task' else Cache()
+from caching import cache, expiring, uncached, HOUR, DAY, NOT_FOUND_TTL
 
 import requests
-logging.getLogger('requests').setLevel(logging.INFO)
 
-from rdflib import ConjunctiveGraph as Graph
-from pyld import jsonld
+import summaries
+import timing
+import transport
+from projection import Projector, iter_jsonld_nodes
 
 SPARQL_DIR = os.path.join(BASE_DIR, 'sparql')
 
@@ -51,47 +54,255 @@ default_ns = 'jstor'
 default_language = 'en'
 default_entity_type = 'entity'
 
+# max number of IDs in the VALUES clause of a batched label query
+LABEL_BATCH_SIZE = 200
+
+# max number of entities in the VALUES clause of a batched entity query
+ENTITY_BATCH_SIZE = 50
+
+# Context terms (namespace prefixes) that are not entity properties
+CONTEXT_EXCLUDE_IN_FRAME = ['wd', 'wds', 'wdv', 'wdt', 'wdtn', 'p', 'ps', 'pq', 'prov', 'rdfs', 'schema', 'skos', 'wikibase', 'xsd']
+
+# Cache TTLs (seconds)
+ENTITY_TTL = int(os.environ.get('ENTITY_TTL', 6 * HOUR))
+LABEL_TTL = int(os.environ.get('LABEL_TTL', 7 * DAY))
+# Entities merged without their secondary entity (its lookup failed) are cached this long
+PARTIAL_TTL = int(os.environ.get('PARTIAL_TTL', 300))
+
+# Max number of entities per concurrent call of a budgeted prefetch (KnowledgeGraph.prefetch)
+PREFETCH_CHUNK_SIZE = 10
+# Max concurrent calls of a budgeted prefetch
+PREFETCH_CONCURRENCY = 4
+
+# Use the rdflib + pyld framing path instead of projecting N-Triples directly (projection.py)
+ENTITY_USE_PYLD = os.environ.get('ENTITY_USE_PYLD', '').lower() in ('1', 'true', 'yes')
+
+# Properties never linked to formatter URLs
+LINK_VALUES_EXCLUDE = ('id', 'label', 'type', 'description', 'date modified', 'coordinate location')
+
+# Max concurrent upstream lookups in the async entity pipeline, one per pooled connection
+ASYNC_CONCURRENCY = transport.POOL_SIZE
+
+# Property label -> PID -> formatter URL index, built at deploy time (npm run deploy runs entity.py --index)
+FORMATTER_INDEX_PATH = os.path.join(SPARQL_DIR, 'formatter_index.json')
+# Age (in seconds) after which the index is stale, and rebuilt by refresh_if_stale
+FORMATTER_INDEX_MAX_AGE = int(os.environ.get('FORMATTER_INDEX_MAX_AGE', 7 * 24 * 60 * 60))
+# Min seconds between rebuild attempts of a stale or missing index
+FORMATTER_INDEX_RETRY = 300
+
+_semaphores = weakref.WeakKeyDictionary()
+def _semaphore():
+    '''Per event loop semaphore bounding concurrent upstream lookups'''
+    loop = asyncio.get_event_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    return _semaphores[loop]
+
+# Projector per (ns, language) context
+_projectors = {}
+
+def _excluded_prop(prop):
+    '''Properties dropped from entities (statement nodes, wikibase internals, labels)'''
+    if prop.startswith('p:P'): return True
+    if prop.startswith('wikibase:'): return True
+    if prop in ('rdfs:label', 'schema:description', 'schema:version', 'skos:altLabel'): return True
+    return False
+
+def _structural_key(v):
+    '''Hashable key of a JSON value, equal for values with equal json.dumps(v, sort_keys=True)'''
+    if isinstance(v, dict):
+        return (dict, tuple(sorted([(k, _structural_key(_v)) for k, _v in v.items()])))
+    if isinstance(v, list):
+        return (list, tuple([_structural_key(_v) for _v in v]))
+    return (type(v), v)
+
+_lookup_executor = None
+def _executor():
+    global _lookup_executor
+    if _lookup_executor is None:
+        _lookup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_CONCURRENCY)
+    return _lookup_executor
+
 class KnowledgeGraph(object):
 
     def __init__(self, **kwargs):
         self.ns = kwargs.get('ns', default_ns)
         self.language = kwargs.get('language', default_language)
         self.entity_type = kwargs.get('entity_type', default_entity_type)
+        self.use_pyld = kwargs.get('use_pyld', ENTITY_USE_PYLD)
+
+    def _cache_identity(self):
+        '''Instance state memoized results depend on (defaults for ns/language/entity_type arguments)'''
+        return (self.ns, self.language, self.entity_type)
 
     @cache.memoize()
     def _get_context(self, ns, language):
         _context_template = open(os.path.join(SPARQL_DIR, f'{GRAPHS[ns]["prefix"].split("/")[2].replace(".","_")}_context.json'), 'r').read()
         return json.loads(_context_template.replace('"en"', f'"{language}"').replace('"wd"', f'"{ns}"').replace('wd:', f'{ns}:'))
 
-    @cache.memoize()
     def entity(self, qid, language=None, entity_type=None):
-        logger.info(f'entity: qid={qid} language={language} entity_type={entity_type}')
         language = language if language else self.language
         entity_type = entity_type if entity_type else self.entity_type
-        ns, qid = qid.split(':') if ':' in qid else (self.ns, qid)
-        primary = f'{ns}:{qid}'
-        secondary = self._secondary_qid(primary)
-        logger.info(f'entity: primary={primary} secondary={secondary}')
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-            by_qid = {}
-            futures = {}
-            for qid in [_qid for _qid in (secondary, primary) if _qid]:
-                futures[executor.submit(self._entity, qid, language, entity_type)] = qid
-
-            for future in concurrent.futures.as_completed(futures):
-                if future.result():
-                    by_qid[futures[future]] = future.result()
-        
-        entity = self._merge(by_qid.get(primary), by_qid.get(secondary))
+        return self._merged_entity(self._qualified(qid), language, entity_type)
+
+    @cache.memoize(ttl=ENTITY_TTL)
+    def _merged_entity(self, qid, language, entity_type):
+        return asyncio.run(self._amerged_entity(qid, language, entity_type))
+
+    async def aentity_cached(self, qid, language=None, entity_type=None):
+        '''Async equivalent of entity, sharing its cache entries.  Concurrent calls for the same
+           entity wait for the first one.'''
+        language = language if language else self.language
+        entity_type = entity_type if entity_type else self.entity_type
+        qid = self._qualified(qid)
+        key = KnowledgeGraph._merged_entity.cache_key(self, qid, language, entity_type)
+        return await cache.asingle_flight(key, functools.partial(self._amerged_entity, qid, language, entity_type))
+
+    async def _amerged_entity(self, qid, language, entity_type):
+        entity = await self.aentity(qid, language, entity_type)
+        if not entity:
+            return expiring(entity, NOT_FOUND_TTL)
+        return expiring(entity, PARTIAL_TTL) if entity.get('partial') else entity
+
+    def entities(self, qids, language=None, entity_type=None):
+        return asyncio.run(self.aentities(qids, language, entity_type))
+
+    def prefetch(self, qids, budget, language=None, entity_type=None):
+        '''Returns the merged entities of the QIDs fetched within budget seconds, keyed by QID
+           ({} when not found).  The QIDs are fetched in chunks, concurrently, chunks not done in
+           time and QIDs whose lookup failed are left out (chunks already started finish in the
+           background, filling the cache).'''
+        qids = list(dict.fromkeys(qids))
+        chunks = [qids[start:start+PREFETCH_CHUNK_SIZE] for start in range(0, len(qids), PREFETCH_CHUNK_SIZE)]
+        if not chunks:
+            return {}
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(PREFETCH_CONCURRENCY, len(chunks)))
+        futures = [executor.submit(timing.bind(self.entities), chunk, language, entity_type) for chunk in chunks]
+        done, not_done = concurrent.futures.wait(futures, timeout=max(budget, 0))
+        for future in not_done:
+            future.cancel()
+        executor.shutdown(wait=False)
+        prefetched = {}
+        for chunk, future in zip(chunks, futures):
+            if future in done:
+                if future.exception() is not None:
+                    logger.warning(f'prefetch: chunk failed: {future.exception()}')
+                else:
+                    prefetched.update([(qid, future.result()[qid]) for qid in chunk if future.result()[qid] is not None])
+        timing.count('entities_prefetched', len(prefetched))
+        logger.info(f'prefetch: qids={len(qids)} budget={budget} prefetched={len(prefetched)}')
+        return prefetched
+
+    async def aentities(self, qids, language=None, entity_type=None):
+        '''Returns merged entities for many QIDs keyed by the requested QID, {} for those not found
+           and None for those whose lookup failed (not cached).  Cached entities are served from the
+           cache, the rest are fetched with batched (VALUES) queries.'''
+        language = language if language else self.language
+        entity_type = entity_type if entity_type else self.entity_type
+        by_qid = {}
+        missing = {}
+        for qid in qids:
+            primary = self._qualified(qid)
+            key = KnowledgeGraph._merged_entity.cache_key(self, primary, language, entity_type)
+            if key in cache:
+                by_qid[qid] = cache[key]
+            else:
+                missing.setdefault(primary, []).append(qid)
+        logger.info(f'aentities: qids={len(qids)} cached={len(by_qid)} missing={len(missing)}')
+        if not missing:
+            return by_qid
+
+        try:
+            secondaries = await self._arun(self._secondary_qids, sorted(missing))
+            partial = False
+        except requests.RequestException as e:
+            logger.warning(f'aentities: secondary QID lookup failed, merging primaries only: {e}')
+            secondaries, partial = {}, True
+        results = await self._aentities_batch(set(missing) | set(secondaries.values()), language, entity_type)
+        merged = {}
+        for primary in missing:
+            if results.get(primary):
+                secondary = secondaries.get(primary)
+                merged[primary] = self._merge(results[primary], results.get(secondary))
+                merged[primary]['language'] = language
+                if partial or (secondary and secondary not in results):
+                    merged[primary]['partial'] = True
+        # summaries were prefetched with the labels, these are cache hits
+        found = await self._arun(summaries.summaries, [page for entity in merged.values() for page in self._wikipedia_pages(entity)[:1]])
+        for primary, entity in merged.items():
+            summary = found.get(next(iter(self._wikipedia_pages(entity)), None))
+            if summary:
+                entity['wikipedia summary'] = summary
+        for primary, qids in missing.items():
+            key = KnowledgeGraph._merged_entity.cache_key(self, primary, language, entity_type)
+            if primary in merged:
+                entity = merged[primary]
+                cache.set(key, entity, ttl=PARTIAL_TTL if entity.get('partial') else ENTITY_TTL)
+            elif primary in results:
+                entity = {}
+                cache.set(key, entity, ttl=NOT_FOUND_TTL)
+            else:
+                # its batch failed, looked up again on the next call
+                entity = None
+            for qid in qids:
+                by_qid[qid] = entity
+        return by_qid
+
+    async def aentity(self, qid, language=None, entity_type=None):
+        logger.info(f'aentity: qid={qid} language={language} entity_type={entity_type}')
+        language = language if language else self.language
+        entity_type = entity_type if entity_type else self.entity_type
+        primary = self._qualified(qid)
+
+        # the primary entity query does not depend on the secondary QID, start both right away
+        primary_task = asyncio.ensure_future(self._aentity(primary, language, entity_type))
+        secondary_qid_task = asyncio.ensure_future(self._asecondary_qid(primary))
+        pending = {primary_task: primary, secondary_qid_task: None}
+        by_qid = {}
+        secondary = None
+        summary = None
+        partial = False
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    _qid = pending.pop(task)
+                    if task is not primary_task and task.exception() is not None:
+                        # the primary entity is still served, without what the secondary adds
+                        logger.warning(f'aentity: primary={primary} secondary lookup failed: {task.exception()}')
+                        partial = True
+                    elif task is secondary_qid_task:
+                        secondary = task.result()
+                        logger.info(f'aentity: primary={primary} secondary={secondary}')
+                        if secondary:
+                            pending[asyncio.ensure_future(self._aentity(secondary, language, entity_type))] = secondary
+                    elif task.result():
+                        by_qid[_qid] = task.result()
+                # look the summary up as soon as the page that will survive the merge is known (it
+                # was prefetched with the entity, so this is a cache hit unless the prefetch failed)
+                if summary is None and primary_task.done():
+                    page = next(iter(self._wikipedia_pages(by_qid.get(primary, {}))), None)
+                    if not page and not pending:
+                        page = next(iter(self._wikipedia_pages(by_qid.get(secondary, {}))), None)
+                    if page:
+                        summary = asyncio.ensure_future(self._asummary(page))
+        except BaseException:
+            for task in list(pending) + ([summary] if summary else []):
+                task.cancel()
+            raise
+
+        if primary not in by_qid:
+            return {}
+        entity = self._merge(by_qid[primary], by_qid.get(secondary))
         entity['language'] = language
-        self._add_summary_text(entity)
+        if summary and await summary:
+            entity['wikipedia summary'] = summary.result()
+        if partial:
+            entity['partial'] = True
         return entity
 
-    @cache.memoize()
-    def _entity(self, qid, language='en', entity_type='entity'):
-        ns, qid = qid.split(':') if ':' in qid else (self.ns, qid)
-        sparql = '''
+    def _entity_sparql(self, qid, language='en', entity_type='entity'):
+        return '''
         CONSTRUCT {
             wd:%s a "%s" .
             wd:%s ?p ?o .
@@ -103,18 +314,125 @@ class KnowledgeGraph(object):
                 FILTER(STRSTARTS(STR(?wikipedia_page), 'https://%s.wikipedia.org'))
             }
         }''' % (qid, entity_type, qid, qid, qid, qid, language)
+
+    @cache.memoize(ttl=ENTITY_TTL)
+    def _entity(self, qid, language='en', entity_type='entity'):
+        ns, qid = qid.split(':') if ':' in qid else (self.ns, qid)
         context = self._get_context(ns, language)
-        _jsonld = self._do_jsonld_sparql_query(sparql, context, GRAPHS[ns]['sparql_endpoint'])
+        _jsonld = next(iter(self._query_entities(self._entity_sparql(qid, language, entity_type), ns, language, entity_type).values()), {})
         # post process returned jsonld
-        for func in (self._frame, self._filter_props, self._link_values, self._add_id_labels):
-            _jsonld = func(_jsonld, context=context, entity_type=entity_type, ns=ns)
-        return _jsonld
-    
+        _jsonld = self._postprocess(_jsonld, context=context, entity_type=entity_type, ns=ns, language=language)
+        return _jsonld if _jsonld else expiring(_jsonld, NOT_FOUND_TTL)
+
+    def _entities_sparql(self, qids, language='en', entity_type='entity'):
+        return '''
+        CONSTRUCT {
+            ?item a "%s" .
+            ?item ?p ?o .
+            ?item schema:isPartOf ?wikipedia_page .
+        } WHERE {
+            VALUES ?item { %s }
+            ?item ?p ?o .
+            OPTIONAL {
+                ?wikipedia_page schema:about ?item .
+                FILTER(STRSTARTS(STR(?wikipedia_page), 'https://%s.wikipedia.org'))
+            }
+        } ORDER BY ?item''' % (entity_type, ' '.join(f'wd:{qid}' for qid in qids), language)
+
+    async def _aentities_batch(self, qids, language='en', entity_type='entity'):
+        '''Batched equivalent of _entity for many (ns qualified) QIDs, returns results keyed by QID'''
+        results = {}
+        by_ns = {}
+        for qid in qids:
+            key = KnowledgeGraph._entity.cache_key(self, qid, language, entity_type)
+            if key in cache:
+                results[qid] = cache[key]
+            else:
+                ns, _qid = qid.split(':')
+                by_ns.setdefault(ns, []).append(_qid)
+        batches = [(ns, _qids[start:start+ENTITY_BATCH_SIZE]) for ns, _qids in by_ns.items() for start in range(0, len(_qids), ENTITY_BATCH_SIZE)]
+        responses = await asyncio.gather(*[
+            self._arun(self._query_entities, self._entities_sparql(_qids, language, entity_type), ns, language, entity_type)
+            for ns, _qids in batches], return_exceptions=True)
+
+        fetched = {}
+        for (ns, _qids), nodes in zip(batches, responses):
+            if isinstance(nodes, Exception):
+                # the entities of a failed batch are left out (and uncached), the others are returned
+                logger.warning(f'_aentities_batch: ns={ns} qids={len(_qids)} failed: {nodes}')
+                continue
+            kwargs = {'context': self._get_context(ns, language), 'entity_type': entity_type, 'ns': ns, 'language': language}
+            for _qid in _qids:
+                fetched[f'{ns}:{_qid}'] = (nodes.get(f'{ns}:{_qid}', {}), kwargs)
+
+        # fan out the formatter, label and summary lookups for all entities at once
+        keys, eids = {}, set()
+        for node, kwargs in fetched.values():
+            self._scan(node, keys.setdefault(kwargs['ns'], set()), eids)
+        await asyncio.gather(
+            self._aprefetch_labels(eids, language=language),
+            self._arun(summaries.summaries, [page for node, _ in fetched.values() for page in self._wikipedia_pages(node)]),
+            *[self._aprefetch_formatter_urls(keys[ns], ns=ns, language=language) for ns in keys])
+        # post-processed in the executor, it is CPU bound (and any lookup the prefetch missed blocks)
+        processed = await asyncio.gather(*[self._arun(self._postprocess, node, prefetch=False, **kwargs) for node, kwargs in fetched.values()])
+        for qid, _jsonld in zip(fetched, processed):
+            results[qid] = _jsonld
+            cache.set(KnowledgeGraph._entity.cache_key(self, qid, language, entity_type), results[qid],
+                      ttl=ENTITY_TTL if results[qid] else NOT_FOUND_TTL)
+        return results
+
+    async def _aentity(self, qid, language='en', entity_type='entity'):
+        '''Async equivalent of _entity, sharing its cache entries.  Concurrent calls for the same
+           entity wait for the first one.'''
+        key = KnowledgeGraph._entity.cache_key(self, qid, language, entity_type)
+        return await cache.asingle_flight(key, functools.partial(self._afetch_entity, qid, language, entity_type))
+
+    async def _afetch_entity(self, qid, language, entity_type):
+        ns, _qid = qid.split(':') if ':' in qid else (self.ns, qid)
+        context = self._get_context(ns, language)
+        kwargs = {'context': context, 'entity_type': entity_type, 'ns': ns, 'language': language}
+        nodes = await self._arun(self._query_entities, self._entity_sparql(_qid, language, entity_type), ns, language, entity_type)
+        node = next(iter(nodes.values()), {})
+        keys, eids = self._scan(node)
+        # fan out the formatter, label and summary lookups, the post-processing below (and the
+        # summary of the merged entity) is then served from the cache
+        await asyncio.gather(
+            self._aprefetch_formatter_urls(keys, ns=ns, language=language),
+            self._aprefetch_labels(eids, language=language),
+            self._arun(summaries.summaries, self._wikipedia_pages(node)))
+        # post-processed in the executor, it is CPU bound (and any lookup the prefetch missed blocks)
+        _jsonld = await self._arun(self._postprocess, node, prefetch=False, **kwargs)
+        return _jsonld if _jsonld else expiring(_jsonld, NOT_FOUND_TTL)
+
+    @timing.timed('query_entities')
+    def _query_entities(self, sparql, ns, language, entity_type):
+        '''Runs an entity CONSTRUCT query, returns the framed entities keyed by (ns qualified) ID'''
+        context = self._get_context(ns, language)
+        endpoint = GRAPHS[ns]['sparql_endpoint']
+        lines = self._do_sparql_construct(sparql, endpoint, stream=True)
+        projector = self._projector(ns, language)
+        if self.use_pyld:
+            # frame each subject on its own, a multi-entity graph frames to one entity only
+            framed = (self._frame({'@context': context, '@graph': [node]}, context=context, entity_type=entity_type) for node in iter_jsonld_nodes(lines, context))
+        else:
+            framed = (node for _, node in projector.iter_project(lines, entity_type=entity_type))
+        nodes = {}
+        for node in framed:
+            if node:
+                nodes[node['id']] = projector.merge(nodes[node['id']], node) if node['id'] in nodes else node
+        return nodes
+
+    def _projector(self, ns, language):
+        key = (ns, language)
+        if key not in _projectors:
+            _projectors[key] = Projector(self._get_context(ns, language), exclude=CONTEXT_EXCLUDE_IN_FRAME)
+        return _projectors[key]
+
     '''
         Methods for post-processing jsonld returned in sparql query
     '''
+    @timing.timed('frame')
     def _frame(self, _jsonld, context, entity_type='entity', **kwargs):
-        CONTEXT_EXCLUDE_IN_FRAME = ['wd', 'wds', 'wdv', 'wdt', 'wdtn', 'p', 'ps', 'pq', 'prov', 'rdfs', 'schema', 'skos', 'wikibase', 'xsd']
         _frame = {
             '@explicit': True,
             '@requireAll': False,
@@ -125,26 +443,37 @@ class KnowledgeGraph(object):
             _frame[prop] = {}
         # print(json.dumps(_jsonld))
         # print(json.dumps(_frame))
+        from pyld import jsonld
         framed = jsonld.frame(_jsonld, frame=_frame)
         return framed['@graph'][0] if '@graph' in framed and framed['@graph'] else {}
 
     def _add_id_labels(self, d, **kwargs):
+        if kwargs.pop('prefetch', True):
+            # resolve labels for all IDs in the tree up front so the per-ID lookups below are cache hits
+            self._prefetch_labels(self._entity_ids(d), language=kwargs.get('language', 'en'))
         if not isinstance(d, (dict, list, str)):
             return d
         if isinstance(d, str):
-            if self._is_entity_id(d):
-                self._label(d, language=kwargs.get('language', 'en'))
-                d = {'id': d, 'value': self._label(d, language=kwargs.get('language', 'en'))}
-                if self._is_entity_id(d['id']):
-                    d['url'] = d['id'].replace(f'{self.ns}:', f'https://{GRAPHS[self.ns]["prefix"].split("/")[2]}/entity/').replace('wd:', 'https://www.wikidata.org/entity/')
-            return d
+            return self._id_label(d, language=kwargs.get('language', 'en')) if self._is_entity_id(d) else d
         elif isinstance(d, list):
-            return [v for v in (self._add_id_labels(v, **kwargs) for v in d) if v]
-        return {k: v for k, v in ((k, self._add_id_labels(v, **kwargs)) for k, v in d.items()) if v}
+            return [v for v in (self._add_id_labels(v, prefetch=False, **kwargs) for v in d) if v]
+        return {k: v for k, v in ((k, self._add_id_labels(v, prefetch=False, **kwargs)) for k, v in d.items()) if v}
+
+    def _id_label(self, eid, language='en'):
+        return {
+            'id': eid,
+            'value': self._label(eid, language=language) or eid,
+            'url': eid.replace(f'{self.ns}:', f'https://{GRAPHS[self.ns]["prefix"].split("/")[2]}/entity/').replace('wd:', 'https://www.wikidata.org/entity/')
+        }
 
     def _link_values(self, d, **kwargs):
         def to_url(k, v):
-            formatters = self._formatter_urls(k, ns=kwargs.get('ns', self.ns), language=kwargs.get('language', 'en')) if k not in ('id', 'label', 'type', 'description', 'date modified', 'coordinate location') else None                
+            if k in LINK_VALUES_EXCLUDE:
+                formatters = None
+            else:
+                formatters = formatter_index().formatter_urls(k, ns=kwargs.get('ns', self.ns))
+                if formatters is None:
+                    formatters = self._formatter_urls(k, ns=kwargs.get('ns', self.ns), language=kwargs.get('language', 'en'))
             if formatters:
                 if isinstance(v, list):
                     v = [{'value': val, 'url': f.replace('$1', val)} for f in formatters for val in v]
@@ -159,67 +488,162 @@ class KnowledgeGraph(object):
         return {k: to_url(k,v) for k, v in ((k, self._link_values(v, **kwargs)) for k, v in d.items())}
 
     def _filter_props(self, d, **kwargs):
-        def exclude(prop):
-            if prop.startswith('p:P'): return True
-            if prop.startswith('wikibase:'): return True
-            if prop in ('rdfs:label', 'schema:description', 'schema:version', 'skos:altLabel'): return True
-            return False
         if not isinstance(d, (dict, list)):
             return d
         elif isinstance(d, list):
             return [v for v in (self._filter_props(v, **kwargs) for v in d) if v]
-        return {k: v for k, v in ((k, self._filter_props(v, **kwargs)) for k, v in d.items() if v and not exclude(k))}
+        return {k: v for k, v in ((k, self._filter_props(v, **kwargs)) for k, v in d.items() if v and not _excluded_prop(k))}
+
+    @timing.timed('postprocess')
+    def _postprocess(self, d, prefetch=True, **kwargs):
+        '''_filter_props, _link_values and _add_id_labels in one traversal, building one new tree
+           rather than one per pass.  Only the (small) values of properties with formatter URLs go
+           through the separate passes.  With prefetch the labels are resolved up front, and each
+           distinct ID is labelled once.'''
+        ns = kwargs.get('ns', self.ns)
+        language = kwargs.get('language', 'en')
+        if prefetch:
+            self._prefetch_labels(self._scan(d)[1], language=language)
+        formatters = {}
+        labels = {}
+
+        def linked(k):
+            if k not in formatters:
+                if k in LINK_VALUES_EXCLUDE:
+                    formatters[k] = None
+                else:
+                    formatters[k] = formatter_index().formatter_urls(k, ns=ns)
+                    if formatters[k] is None:
+                        formatters[k] = self._formatter_urls(k, ns=ns, language=language)
+            return bool(formatters[k])
+
+        def walk(d):
+            if isinstance(d, dict):
+                processed = {}
+                for k, v in d.items():
+                    if not v or _excluded_prop(k):
+                        continue
+                    if isinstance(v, (str, list)) and linked(k):
+                        v = self._add_id_labels(self._link_values({k: self._filter_props(v)}, **kwargs)[k], prefetch=False, **kwargs)
+                    else:
+                        v = walk(v)
+                    if v:
+                        processed[k] = v
+                return processed
+            elif isinstance(d, list):
+                return [v for v in (walk(v) for v in d) if v]
+            elif isinstance(d, str) and self._is_entity_id(d):
+                # IDs recur within an entity, each label is looked up once
+                if d not in labels:
+                    labels[d] = self._id_label(d, language=language)
+                return dict(labels[d])
+            return d
+
+        return walk(d)
 
+    def _scan(self, d, keys=None, eids=None):
+        '''Returns the keys of the properties that may be linked to formatter URLs and the entity
+           IDs in _filter_props(d), without building the filtered tree'''
+        keys = set() if keys is None else keys
+        eids = set() if eids is None else eids
+        if isinstance(d, str):
+            if self._is_entity_id(d):
+                eids.add(d)
+        elif isinstance(d, list):
+            for v in d:
+                self._scan(v, keys, eids)
+        elif isinstance(d, dict):
+            for k, v in d.items():
+                if v and not _excluded_prop(k):
+                    if k not in LINK_VALUES_EXCLUDE:
+                        keys.add(k)
+                    self._scan(v, keys, eids)
+        return keys, eids
 
     '''
         Various helper methods
     '''
     
-    def _do_jsonld_sparql_query(self, sparql, context, endpoint):
-        # Perform SPARQL CONSTRUCT query and request results returned in N-Triples format
-        resp = requests.post(
+    def _do_sparql_construct(self, sparql, endpoint, stream=False):
+        '''Performs a SPARQL CONSTRUCT query returning N-Triples, as text or, when streaming, as an
+           iterator over the (utf-8) lines read so far.  Raises requests.HTTPError on an error status.'''
+        resp = transport.post(
             endpoint,
             headers={
                 'Accept': 'text/plain',
                 'Content-type': 'application/x-www-form-urlencoded'},
-            data='query=%s' % quote(sparql)
+            data='query=%s' % quote(sparql),
+            stream=stream,
+            idempotent=True
         )
-        if resp.status_code == 200:
-            # Convert N-Triples to json-ld using json-ld context
-            graph = Graph()
-            graph.parse(data=resp.text, format='nt')
-            _jsonld = json.loads(str(graph.serialize(format='json-ld', context=context, indent=None), 'utf-8'))
-            if '@graph' not in _jsonld:
-                _context = _jsonld.pop('@context')
-                _jsonld = {'@context': _context, '@graph': [_jsonld]}
-            return _jsonld
+        if resp.status_code != 200:
+            resp.close()
+            resp.raise_for_status()
+        return transport.iter_lines(resp) if stream else resp.text
+
+    async def _arun(self, func, *args, **kwargs):
+        '''Runs a blocking lookup in the shared executor, bounded by the per-loop semaphore'''
+        async with _semaphore():
+            return await asyncio.get_event_loop().run_in_executor(_executor(), timing.bind(functools.partial(func, *args, **kwargs)))
+
+    async def _alabel(self, eid, language=None):
+        return await self._arun(self._label, eid, language=language)
+
+    async def _aformatter_urls(self, eid, ns=None, language=None):
+        return await self._arun(self._formatter_urls, eid, ns=ns, language=language)
+
+    async def _asecondary_qid(self, primary):
+        return await self._arun(self._secondary_qid, primary)
+
+    async def _asummary(self, page):
+        return await self._arun(summaries.summary, page)
+
+    async def _aprefetch_formatter_urls(self, props, ns=None, language=None):
+        to_lookup = [prop for prop in props if formatter_index().formatter_urls(prop, ns=ns) is None]
+        await asyncio.gather(*[self._aformatter_urls(prop, ns=ns, language=language) for prop in to_lookup])
+
+    def _qualified(self, qid):
+        ns, qid = qid.split(':') if ':' in qid else (self.ns, qid)
+        return f'{ns}:{qid}'
 
     def _is_entity_id(self, s, **kwargs):
         if not s or not isinstance(s, str): return False
         eid = s.split(':', 1)[1] if ':' in s else s
         return len(s) > 1 and eid[0] in ('Q', 'P') and eid[1:].isdecimal()
 
-    @cache.memoize()
+    @cache.memoize(ttl=LABEL_TTL)
+    @timing.timed('eid_from_label')
     def _eid_from_label(self, label, ns=None, language=None):
+        '''Returns the PID of a property label from the WB service, None if not found (cached for
+           NOT_FOUND_TTL) or on a service error (not cached)'''
         ns = ns if ns else self.ns
         language = language if language else self.language
         try:
-            eid = requests.post(
+            resp = transport.post(
                 f'{WB_SERVICE_ENDPOINT}/find',
-                json = {'ns': ns, 'text': label, 'type': 'property', 'language': language}
-            ).json()['id']
-        except:
-            eid = None
+                json = {'ns': ns, 'text': label, 'type': 'property', 'language': language},
+                idempotent=True
+            )
+            if resp.status_code == 404:
+                return expiring(None, NOT_FOUND_TTL)
+            resp.raise_for_status()
+            eid = resp.json().get('id')
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f'eid_from_label: ns={ns} text="{label}" language={language} error={e}')
+            return uncached(None)
         logger.debug(f'eid_from_label: ns={ns} text="{label}" language={language} eid={eid}')
-        return eid
+        return eid if eid else expiring(None, NOT_FOUND_TTL)
 
-    @cache.memoize()
+    @cache.memoize(ttl=LABEL_TTL)
+    @timing.timed('formatter_urls')
     def _formatter_urls(self, eid, ns=None, language=None):
         ns = ns if ns else self.ns
         language = language if language else self.language
         formatter_urls = []
         _eid = eid if self._is_entity_id(eid) else self._eid_from_label(eid, ns, language)
-        if _eid and _eid[0] == 'P':
+        if not _eid:
+            return expiring(formatter_urls, NOT_FOUND_TTL)
+        if _eid[0] == 'P':
             endpoint = GRAPHS[ns]['sparql_endpoint']
             prefix = GRAPHS[ns]['prefix'].split('/')[2]
             if ns == 'wd':
@@ -235,23 +659,117 @@ class KnowledgeGraph(object):
                         ?wdItem <http://www.wikidata.org/prop/direct/P1630> ?formatterUrl .
                     }
                 }''' % (prefix, _eid, prefix)
-            resp = requests.get(
-                    '{}?query={}'.format(endpoint, quote(query)),
-                    headers={'Accept': 'application/sparql-results+json'},
-                ).json()
+            try:
+                resp = transport.get(
+                        '{}?query={}'.format(endpoint, quote(query)),
+                        headers={'Accept': 'application/sparql-results+json'},
+                    )
+                resp.raise_for_status()
+                resp = resp.json()
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f'formatter_urls: ns={ns} eid="{eid}" error={e}')
+                return uncached(formatter_urls)
             formatter_urls = [item['formatterUrl']['value'] for item in resp['results']['bindings']]
             logger.debug('formatter_urls: ns=%s eid="%s" _eid=%s formatter_urls=%s', ns, eid, _eid, formatter_urls)
         return formatter_urls
 
-    @cache.memoize()
+    def _entity_ids(self, d, found=None):
+        found = set() if found is None else found
+        if isinstance(d, str):
+            if self._is_entity_id(d):
+                found.add(d)
+        elif isinstance(d, list):
+            for v in d:
+                self._entity_ids(v, found)
+        elif isinstance(d, dict):
+            for v in d.values():
+                self._entity_ids(v, found)
+        return found
+
+    def _prefetch_labels(self, eids, language=None):
+        '''Resolves labels for many IDs with batched SPARQL queries, storing each in the _label cache'''
+        language = language if language else self.language
+        for ns, keys in self._label_batches(eids, language):
+            self._fetch_label_batch(ns, keys, language)
+
+    async def _aprefetch_labels(self, eids, language=None):
+        '''Async equivalent of _prefetch_labels, the IDs the batched queries leave unresolved are
+           then looked up one by one (concurrently), so post-processing finds every label cached'''
+        language = language if language else self.language
+        await asyncio.gather(*[self._arun(self._fetch_label_batch, ns, keys, language) for ns, keys in self._label_batches(eids, language)])
+        unresolved = [eid for eid in eids if KnowledgeGraph._label.cache_key(self, eid, language=language) not in cache]
+        await asyncio.gather(*[self._alabel(eid, language=language) for eid in unresolved])
+
+    def _label_batches(self, eids, language):
+        '''Groups IDs without a cached label into (ns, {eid: cache key}) batches of at most LABEL_BATCH_SIZE'''
+        by_ns = {}
+        for eid in eids:
+            key = KnowledgeGraph._label.cache_key(self, eid, language=language)
+            if key not in cache:
+                ns, _eid = eid.split(':') if ':' in eid else (self.ns, eid)
+                by_ns.setdefault(ns, {})[_eid] = key
+        batches = []
+        for ns, keys in by_ns.items():
+            _eids = sorted(keys)
+            for start in range(0, len(_eids), LABEL_BATCH_SIZE):
+                batches.append((ns, dict([(_eid, keys[_eid]) for _eid in _eids[start:start+LABEL_BATCH_SIZE]])))
+        return batches
+
+    @timing.timed('label_batch')
+    def _fetch_label_batch(self, ns, keys, language):
+        prefix = GRAPHS[ns]['prefix'].split('/')[2]
+        values = ' '.join(f'<http://{prefix}/entity/{_eid}>' for _eid in keys)
+        query = '''
+        SELECT ?item ?label WHERE {
+            VALUES ?item { %s }
+            ?item <http://www.w3.org/2000/01/rdf-schema#label> ?label .
+            FILTER(LANG(?label) = '%s')
+        }''' % (values, language)
+        try:
+            resp = transport.post(
+                GRAPHS[ns]['sparql_endpoint'],
+                headers={
+                    'Accept': 'application/sparql-results+json;charset=UTF-8',
+                    'Content-type': 'application/x-www-form-urlencoded'},
+                data='query=%s' % quote(query),
+                idempotent=True
+            )
+        except requests.RequestException as e:
+            logger.warning(f'_fetch_label_batch: ns={ns} error={e}')
+            return
+        if resp.status_code != 200:
+            logger.warning(f'_fetch_label_batch: ns={ns} status={resp.status_code}')
+            return
+        for item in resp.json()['results']['bindings']:
+            _eid = item['item']['value'].split('/')[-1]
+            if _eid in keys:
+                cache.set(keys[_eid], item['label']['value'])
+        # IDs without a label in the graph are left to the per-ID _label lookup
+        logger.debug(f'_fetch_label_batch: ns={ns} language={language} eids={len(keys)}')
+
+    @cache.memoize(ttl=LABEL_TTL)
+    @timing.timed('label')
     def _label(self, eid, language=None):
+        '''Returns the label of an ID from the WB service, None if not found (cached for
+           NOT_FOUND_TTL) or on a service error (not cached)'''
         language = language if language else self.language
         ns, eid = eid.split(':') if ':' in eid else (self.ns, eid)
-        url = f'{WB_SERVICE_ENDPOINT}/label/{ns}:{eid}?language={language}'
-        label = requests.get(f'{WB_SERVICE_ENDPOINT}/label/{ns}:{eid}?language={language}').text
+        try:
+            resp = transport.get(f'{WB_SERVICE_ENDPOINT}/label/{ns}:{eid}?language={language}')
+        except requests.RequestException as e:
+            logger.warning(f'_label: eid={eid} ns={ns} error={e}')
+            return uncached(None)
+        if resp.status_code == 404 or (resp.status_code == 200 and not resp.text):
+            return expiring(None, NOT_FOUND_TTL)
+        if resp.status_code != 200:
+            logger.warning(f'_label: eid={eid} ns={ns} status={resp.status_code}')
+            return uncached(None)
+        label = resp.text
         logger.debug(f'_label: eid={eid} ns={ns} label="{label}"')
         return label
 
+    @cache.memoize(ttl=ENTITY_TTL)
+    @timing.timed('secondary_qid')
     def _secondary_qid(self, primary):
         primary_ns, primary_qid = primary.split(':')
         if primary_ns == self.ns:
@@ -262,32 +780,68 @@ class KnowledgeGraph(object):
             secondary_ns = self.ns
             jstorqid = '?qid'
             wdqid = f'<http://www.wikidata.org/entity/{primary_qid}>'
-        resp = requests.post(
+        resp = transport.post(
             GRAPHS[self.ns]['sparql_endpoint'],
             headers={
                 'Accept': 'application/sparql-results+json;charset=UTF-8',
                 'Content-type': 'application/x-www-form-urlencoded'},
-            data='query=%s' % quote(f'SELECT ?qid WHERE {{{jstorqid} wdt:P4 {wdqid}}}')
-        ).json()
+            data='query=%s' % quote(f'SELECT ?qid WHERE {{{jstorqid} wdt:P4 {wdqid}}}'),
+            idempotent=True
+        )
+        resp.raise_for_status()
+        resp = resp.json()
         secondary_qid = resp['results']['bindings'][0]['qid']['value'].split('/')[-1] if resp['results']['bindings'] else None
-        return f'{secondary_ns}:{secondary_qid}' if secondary_qid else None
+        return f'{secondary_ns}:{secondary_qid}' if secondary_qid else expiring(None, NOT_FOUND_TTL)
 
-    def _merge(self, primary, secondary=None):
-        def _norm(v):
-            return set([json.dumps(d, sort_keys=True) for d in v]) if isinstance(v, list) else json.dumps(v, sort_keys=True)
+    @timing.timed('secondary_qids')
+    def _secondary_qids(self, primaries):
+        '''Batched equivalent of _secondary_qid, returns secondary QIDs keyed by primary QID'''
+        secondaries = {}
+        local = [qid.split(':')[1] for qid in primaries if qid.split(':')[0] == self.ns]
+        remote = [qid.split(':')[1] for qid in primaries if qid.split(':')[0] != self.ns]
+        queries = []
+        for start in range(0, len(local), ENTITY_BATCH_SIZE):
+            values = ' '.join(f'wd:{qid}' for qid in local[start:start+ENTITY_BATCH_SIZE])
+            queries.append((self.ns, 'wd', f'SELECT ?item ?qid WHERE {{VALUES ?item {{{values}}} ?item wdt:P4 ?qid}}'))
+        for start in range(0, len(remote), ENTITY_BATCH_SIZE):
+            values = ' '.join(f'<http://www.wikidata.org/entity/{qid}>' for qid in remote[start:start+ENTITY_BATCH_SIZE])
+            queries.append(('wd', self.ns, f'SELECT ?item ?qid WHERE {{VALUES ?item {{{values}}} ?qid wdt:P4 ?item}}'))
+        for primary_ns, secondary_ns, query in queries:
+            resp = transport.post(
+                GRAPHS[self.ns]['sparql_endpoint'],
+                headers={
+                    'Accept': 'application/sparql-results+json;charset=UTF-8',
+                    'Content-type': 'application/x-www-form-urlencoded'},
+                data='query=%s' % quote(query),
+                idempotent=True
+            )
+            resp.raise_for_status()
+            for item in resp.json()['results']['bindings']:
+                primary = f'{primary_ns}:{item["item"]["value"].split("/")[-1]}'
+                secondaries.setdefault(primary, f'{secondary_ns}:{item["qid"]["value"].split("/")[-1]}')
+        return secondaries
 
-        merged = deepcopy(primary)
+    @timing.timed('merge')
+    def _merge(self, primary, secondary=None):
+        '''Returns the primary entity with the values of the secondary added, list values get the
+           secondary's values not already in them.  The inputs are not modified, the result shares
+           their (unmodified) values.'''
+        merged = dict(primary)
         if secondary:
             for k, v in secondary.items():
                 if k in merged:
                     if isinstance(merged[k], list):
-                        mv = _norm(merged[k])
+                        seen = set([_structural_key(mv) for mv in merged[k]])
+                        added = []
                         for sv in v:
-                            if not _norm(sv) in mv:
-                                merged[k].append(sv)
+                            key = _structural_key(sv)
+                            if key not in seen:
+                                added.append(sv)
+                        if added:
+                            merged[k] = merged[k] + added
                 else:
-                    merged[k] = deepcopy(v)
-            merged['id']['alt'] = secondary['id']['id']
+                    merged[k] = v
+            merged['id'] = dict(merged['id'], alt=secondary['id']['id'])
         if '@type' in merged:
             merged['type'] = merged.pop('@type')
         if 'described at URL' in merged:
@@ -300,11 +854,153 @@ class KnowledgeGraph(object):
 
         return merged
 
-    def _add_summary_text(self, entity):
-        if 'wikipedia page' in entity:
-            resp = requests.get(f'https://en.wikipedia.org/api/rest_v1/page/summary/{entity["wikipedia page"].split("/")[-1]}')
-            entity['wikipedia summary'] = resp.json()
-        return entity
+    def _wikipedia_pages(self, entity):
+        pages = entity.get('wikipedia page') or []
+        return [pages] if isinstance(pages, str) else [page for page in pages if isinstance(page, str)]
+
+class FormatterIndex(object):
+    '''Property label -> PID -> formatter URLs (P1630) for the properties in each namespace context.
+       Loaded from the index shipped with the deployment or the more recent copy refreshed into the
+       cache directory.  Lookups never rebuild the index: long-running servers call refresh_if_stale
+       (asgi.py checks it periodically), while on Lambda, where a background thread is frozen
+       between invocations, the index shipped with the deployment is used as is.  A stale index
+       keeps serving lookups while it is rebuilt.'''
+
+    def __init__(self, path=FORMATTER_INDEX_PATH, max_age=FORMATTER_INDEX_MAX_AGE):
+        self.path = path
+        self.refresh_path = os.path.join(cache.directory, 'formatter_index.json')
+        self.max_age = max_age
+        self.updated = 0
+        self._index = ({}, {})
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._last_refresh = 0
+        self.load()
+
+    def load(self):
+        updated, namespaces = self.updated, self.namespaces
+        for path in (self.path, self.refresh_path):
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r') as fp:
+                        index = json.load(fp)
+                except ValueError:
+                    logger.warning(f'FormatterIndex: ignoring unreadable index {path}')
+                    continue
+                if index.get('updated', 0) > updated:
+                    updated, namespaces = index['updated'], index['namespaces']
+        by_pid = dict([(ns, dict([(prop['pid'], prop['formatter_urls']) for prop in props.values() if prop['pid']]))
+                       for ns, props in namespaces.items()])
+        # swapped in one step, lookups running during a background refresh see the old or new index
+        self._index = (namespaces, by_pid)
+        self.updated = updated
+        return self
+
+    @property
+    def namespaces(self):
+        return self._index[0]
+
+    @property
+    def stale(self):
+        return now() - self.updated > self.max_age
+
+    def formatter_urls(self, label, ns):
+        '''Returns formatter URLs for a property label or PID, None if the index cannot answer'''
+        namespaces, by_pid = self._index
+        if ns not in namespaces:
+            return None
+        if label.startswith('@'):
+            return []
+        if label in namespaces[ns]:
+            return namespaces[ns][label]['formatter_urls']
+        pid = label.split(':', 1)[1] if ':' in label else label
+        return by_pid.get(ns, {}).get(pid)
+
+    def build(self, namespaces=None):
+        kg = KnowledgeGraph()
+        index = {'updated': now(), 'namespaces': {}}
+        for ns in (namespaces if namespaces else GRAPHS):
+            props = {}
+            for label, term in kg._get_context(ns, default_language).items():
+                _id = term if isinstance(term, str) else term.get('@id', '') if isinstance(term, dict) else ''
+                pid = _id.split(':', 1)[1] if _id.startswith('wdt:P') else None
+                props[label] = {'pid': pid, 'formatter_urls': []}
+            by_pid = dict([(prop['pid'], prop) for prop in props.values() if prop['pid']])
+            for pid, formatter_url in self._query_formatter_urls(ns, sorted(by_pid)):
+                by_pid[pid]['formatter_urls'].append(formatter_url)
+            index['namespaces'][ns] = props
+            logger.info(f'FormatterIndex.build: ns={ns} props={len(by_pid)} with_formatters={len([p for p in by_pid.values() if p["formatter_urls"]])}')
+        return index
+
+    def _query_formatter_urls(self, ns, pids):
+        if not pids:
+            return []
+        prefix = GRAPHS[ns]['prefix'].split('/')[2]
+        values = ' '.join(f'<http://{prefix}/entity/{pid}>' for pid in pids)
+        if ns == 'wd':
+            query = '''
+            SELECT ?prop ?formatterUrl WHERE {
+                VALUES ?prop { %s }
+                ?prop <http://%s/prop/direct/P1630> ?formatterUrl .
+            }''' % (values, prefix)
+        else:
+            query = '''
+            SELECT ?prop ?formatterUrl WHERE {
+                VALUES ?prop { %s }
+                ?prop <http://%s/prop/direct/P4> ?wdItem .
+                SERVICE <https://query.wikidata.org/sparql> {
+                    ?wdItem <http://www.wikidata.org/prop/direct/P1630> ?formatterUrl .
+                }
+            }''' % (values, prefix)
+        resp = transport.post(
+            GRAPHS[ns]['sparql_endpoint'],
+            headers={
+                'Accept': 'application/sparql-results+json;charset=UTF-8',
+                'Content-type': 'application/x-www-form-urlencoded'},
+            data='query=%s' % quote(query),
+            idempotent=True
+        )
+        resp.raise_for_status()
+        return [(item['prop']['value'].split('/')[-1], item['formatterUrl']['value']) for item in resp.json()['results']['bindings']]
+
+    def write(self, index, path=None):
+        path = path if path else self.path
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(index, fp, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+        return path
+
+    def refresh_if_stale(self, background=False):
+        '''Rebuilds a stale or missing index, at most once every FORMATTER_INDEX_RETRY seconds'''
+        if self.stale and now() - self._last_refresh > FORMATTER_INDEX_RETRY:
+            self.refresh(background=background)
+
+    def refresh(self, background=False):
+        def _refresh():
+            try:
+                self.write(self.build(list(self.namespaces) if self.namespaces else None), self.refresh_path)
+                self.load()
+            except Exception:
+                logger.warning(f'FormatterIndex.refresh: failed\n{traceback.format_exc()}')
+            finally:
+                self._refreshing = False
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self._last_refresh = now()
+        if background:
+            threading.Thread(target=_refresh, daemon=True).start()
+        else:
+            _refresh()
+
+_formatter_index = None
+def formatter_index():
+    global _formatter_index
+    if _formatter_index is None:
+        _formatter_index = FormatterIndex()
+    return _formatter_index
 
 def as_html(entity):
     return open('viewer.html', 'r').read().replace("'{{DATA}}'", json.dumps(entity))
@@ -315,13 +1011,14 @@ def usage():
     print('   -l --loglevel      Logging level (default=warning)')
     print('   -e --language      Language (default="en")')
     print('   -f --format        Format (json, html) (default=json)')
+    print('   -x --index         Build formatter URL index (%s)' % FORMATTER_INDEX_PATH)
 
 if __name__ == '__main__':
     logger.setLevel(logging.WARNING)
     kwargs = {}
     try:
         opts, args = getopt.getopt(
-            sys.argv[1:], 'hl:e:f:r', ['help', 'loglevel', 'language', 'format'])
+            sys.argv[1:], 'hl:e:f:rx', ['help', 'loglevel', 'language', 'format', 'index'])
     except getopt.GetoptError as err:
         # print help information and exit:
         print(str(err))  # will print something like "option -a not recognized"
@@ -339,12 +1036,19 @@ if __name__ == '__main__':
             kwargs['language'] = a
         elif o in ('-f', '--format'):
             kwargs['content_type'] = 'text/html' if a == 'html' else 'application/json'
+        elif o in ('-x', '--index'):
+            kwargs['index'] = True
         elif o in ('-h', '--help'):
             usage()
             sys.exit()
         else:
             assert False, "unhandled option"
 
+    if kwargs.pop('index', False):
+        index = FormatterIndex(max_age=0)
+        print(index.write(index.build()))
+        sys.exit()
+
     kg = KnowledgeGraph(**kwargs)
 
     if args:
@@ -6,35 +6,25 @@ logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(messa
 logger = logging.getLogger()
 
 import os
-import re
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
-from flask_cors import CORS
-from flask import Flask, request
-app = Flask(__name__)
-CORS(app)
-
 import json
 import getopt
+import hashlib
 import sys
-import traceback
-from time import time as now
 from urllib.parse import quote
 import concurrent.futures
-from copy import deepcopy
 
 from bs4 import BeautifulSoup
-from bs4.element import Comment, NavigableString, Tag
-
-from diskcache import Cache
-cache = Cache(BASE_DIR) if BASE_DIR != '/var/task' else Cache()
+from bs4.dammit import EntitySubstitution
+from bs4.element import Comment, PreformattedString, Tag
 
-import requests
-logging.getLogger('requests').setLevel(logging.INFO)
+from caching import cache, DAY
 
-from rdflib import ConjunctiveGraph as Graph
-from pyld import jsonld
+import timing
+import transport
+from projection import iter_jsonld_nodes
 
 SPARQL_DIR = os.path.join(BASE_DIR, 'sparql')
 
@@ -42,6 +32,35 @@ WB_SERVICE_ENDPOINT = 'https://lo7kh865s6.execute-api.us-east-1.amazonaws.com/pr
 
 DEFAULT_SITE = 'kg.jstor.org'
 
+# Bump when a change to the rendering pipeline invalidates cached essays
+RENDER_VERSION = 1
+# Max age (seconds) of a cached rendered essay, bounds how stale its Wikidata entity data gets
+ESSAY_TTL = int(os.environ.get('ESSAY_TTL', DAY))
+# Max number of QIDs in the VALUES clause of one entity data query (entities.rq)
+ENTITY_DATA_CHUNK_SIZE = int(os.environ.get('ENTITY_DATA_CHUNK_SIZE', 50))
+# Max concurrent entity data queries per essay
+ENTITY_DATA_CONCURRENCY = int(os.environ.get('ENTITY_DATA_CONCURRENCY', 4))
+# Max age (seconds) of cached per-QID entity data
+ENTITY_DATA_TTL = int(os.environ.get('ENTITY_DATA_TTL', DAY))
+# Max age (seconds) of the cached entity terms and tagged HTML of a section's text
+SECTION_TAGS_TTL = int(os.environ.get('SECTION_TAGS_TTL', 7 * DAY))
+# Entity prefetch of rendered essays (opt-in, the prefetch request arg overrides it): 'inline'
+# embeds the full entities in the page, 'sidecar' has the client fetch them in one request
+ESSAY_PREFETCH = os.environ.get('ESSAY_PREFETCH', '')
+PREFETCH_MODES = ('inline', 'sidecar')
+# Max seconds an inline prefetch adds to an essay render, entities not fetched in time are
+# fetched by the client when opened
+ENTITY_PREFETCH_BUDGET = float(os.environ.get('ENTITY_PREFETCH_BUDGET', 3))
+# Max age (seconds) of a cached essay rendered without all its inline prefetched entities
+ESSAY_PARTIAL_TTL = int(os.environ.get('ESSAY_PARTIAL_TTL', 300))
+
+# bs4 tree builder for essay HTML, lxml when installed (several times faster than html5lib)
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html5lib'
+
 DEFAULT_STYLESHEET = '''
     .toc {
         display: none;
@@ -57,6 +76,9 @@ DEFAULT_STYLESHEET = '''
     }
 '''
 
+class PageNotFound(Exception):
+    '''The requested page (or revision) does not exist on the site'''
+
 class Entity(object):
 
     lists = ('aliases', 'images', 'coords')
@@ -158,15 +180,68 @@ class Map(object):
     def __str__(self):
         return self.__repr__()
 
+class EntityMatcher(object):
+    '''Trie over lowercased entity labels and aliases.  Finds leftmost-longest,
+       non-overlapping matches in a single left-to-right scan of the text.'''
+
+    _END = None
+
+    def __init__(self, entities=()):
+        self._root = {}
+        # term -> QID, the entity a term matches
+        self.terms = {}
+        for entity in entities:
+            for term in [entity.label] + (entity.aliases or []):
+                if term:
+                    self.add(term, entity)
+
+    def add(self, term, entity):
+        self.terms[term.lower()] = entity.qid
+        node = self._root
+        for ch in term.lower():
+            node = node.setdefault(ch, {})
+        node[self._END] = entity
+
+    def __bool__(self):
+        return bool(self._root)
+
+    def signature(self):
+        '''Digest of the terms (and the QIDs they map to), equal matchers find the same matches'''
+        return hashlib.sha1(json.dumps(sorted(self.terms.items())).encode('utf-8')).hexdigest()
+
+    def find(self, text):
+        '''Returns list of (start, end, entity) tuples, ordered by start'''
+        matches = []
+        snorm = text.lower()
+        root = self._root
+        pos, size = 0, len(snorm)
+        while pos < size:
+            node = root.get(snorm[pos])
+            longest = None
+            cursor = pos
+            while node is not None:
+                cursor += 1
+                if self._END in node:
+                    longest = (cursor, node[self._END])
+                node = node.get(snorm[cursor]) if cursor < size else None
+            if longest:
+                matches.append((pos, longest[0], longest[1]))
+                pos = longest[0]
+            else:
+                pos += 1
+        return matches
+
+@timing.timed('mw_to_html5')
 def mw_to_html5(html):
-    '''Transforms mediawiki generated HTML to semantic HTML'''
-    _input = BeautifulSoup(html, 'html5lib')
+    '''Transforms mediawiki generated HTML to semantic HTML.  Returns the parsed document, which
+       Essay and add_vue_app update in place, so the essay is parsed and serialized only once.'''
+    _input = html if isinstance(html, BeautifulSoup) else BeautifulSoup(html, HTML_PARSER)
     for elem in _input.find_all('span', {'class': 'mw-editsection'}):
         elem.decompose()
     for elem in _input.find_all(id='toc'):
         elem.decompose()
     base_html = '<!doctype html><html lang="en"><head><meta charset="utf-8"><title></title></head><body></body></html>'
-    html5 = BeautifulSoup(base_html, 'html5lib')
+    html5 = BeautifulSoup(base_html, HTML_PARSER)
 
     article = html5.new_tag('article', id='essay')
     article.attrs['data-app'] = 'true'
@@ -207,7 +282,10 @@ def mw_to_html5(html):
         parent = sections[section['parent']]['tag'] if section['parent'] else article
         parent.append(section['tag'])
     
-    return str(html5)
+    return html5
+
+class TaggedHTML(PreformattedString):
+    '''Text node holding the (already formatted) HTML of an entity tagged text node'''
 
 def _remove_empty_tags(soup):
     for elem in soup.findAll(lambda tag: tag.name in ('p',)):
@@ -219,16 +297,53 @@ def _remove_empty_tags(soup):
 class Essay(object):
 
     def __init__(self, html, **kwargs):
-        self._soup = BeautifulSoup(html, 'html5lib')
+        self._soup = html if isinstance(html, BeautifulSoup) else BeautifulSoup(html, HTML_PARSER)
+        self._index_sections()
         self.entities = self._find_entities()
         self.custom_components = self._find_custom_components()
         self._update_entities()
+        self.prefetch = prefetch_mode(kwargs.get('prefetch'))
+        # inline prefetched entities (KnowledgeGraph.prefetch results) may be passed in, fetched
+        # ahead of rendering, otherwise they are fetched while the essay is tagged
+        prefetched = kwargs.get('prefetched') if self.prefetch == 'inline' else {}
+        prefetching = self._prefetch_entities(kwargs.get('language')) if prefetched is None and self.entities else None
         self._tag_entities()
         self.maps = self._find_maps()
         #self._add_stylesheet(**kwargs)
+        prefetched = prefetching.result() if prefetching else prefetched or {}
+        self.entity_data = dict([(qid, prefetched[f'wd:{qid}']) for qid in self.entities if prefetched.get(f'wd:{qid}')])
+        self.prefetch_complete = self.prefetch != 'inline' or all(f'wd:{qid}' in prefetched for qid in self.entities)
         self._add_data()
 
+    @timing.timed('index_sections')
+    def _index_sections(self):
+        '''Maps each element to its section context in a single traversal: the ID of the nearest
+           enclosing section and the (interned) set of IDs of all enclosing sections and article'''
+        index = {}
+        interned = {}
+        stack = [(self._soup, frozenset(), None)]
+        while stack:
+            elem, section_ids, parent_section_id = stack.pop()
+            if elem.name in ('section', 'article') and 'id' in elem.attrs:
+                section_ids = section_ids | {elem.attrs['id']}
+                section_ids = interned.setdefault(section_ids, section_ids)
+            if elem.name == 'section':
+                parent_section_id = elem.attrs.get('id')
+            index[id(elem)] = (elem, section_ids, parent_section_id)
+            stack.extend([(child, section_ids, parent_section_id) for child in elem.contents if isinstance(child, Tag)])
+        self._section_index = index
+
+    def _section_context(self, elem):
+        # text nodes share their parent's context
+        elem = elem if isinstance(elem, Tag) else elem.parent
+        entry = self._section_index.get(id(elem))
+        # elements added after indexing are not in the index (and may reuse an ID)
+        return entry if entry and entry[0] is elem else None
+
     def _parent_section_id(self, elem, default=None):
+        context = self._section_context(elem)
+        if context:
+            return context[2] if context[2] is not None else default
         parent_section = None
         while elem.parent and parent_section is None:
             if elem.name == 'section':
@@ -236,6 +351,7 @@ class Essay(object):
             elem = elem.parent
         return parent_section.attrs['id'] if parent_section and 'id' in parent_section.attrs else default
 
+    @timing.timed('find_entities')
     def _find_entities(self):
         entities = {}
         for de in self._soup.html.body.article.find_all('span'):
@@ -258,13 +374,24 @@ class Essay(object):
                     de.decompose()
         return entities
 
+    def _prefetch_entities(self, language=None):
+        '''Starts fetching the full (KnowledgeGraph.entity) data of the essay entities, returns
+           a future of those fetched within ENTITY_PREFETCH_BUDGET (see KnowledgeGraph.prefetch)'''
+        from entity import KnowledgeGraph
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(timing.bind(KnowledgeGraph().prefetch), [f'wd:{qid}' for qid in self.entities], ENTITY_PREFETCH_BUDGET, language)
+        executor.shutdown(wait=False)
+        return future
+
+    @timing.timed('update_entities')
     def _update_entities(self):
-        for attrs in self._get_entity_data([qid for qid in self.entities])['@graph']:
+        for attrs in self._iter_entity_data([qid for qid in self.entities]):
             entity = next((self.entities[qid] for qid in self.entities if qid == attrs['qid']), None)
             if entity:
                 for k, v in attrs.items():
                     entity[k] = v
 
+    @timing.timed('find_maps')
     def _find_maps(self):
         maps = {}
         for de in self._soup.find_all('div'):
@@ -281,6 +408,7 @@ class Essay(object):
                     de.name = 'figure'
         return maps
 
+    @timing.timed('find_custom_components')
     def _find_custom_components(self):
         components = {}
         for de in self._soup.html.body.article.find_all('span'):
@@ -297,17 +425,26 @@ class Essay(object):
                 self._soup.html.head.append(self._soup.new_tag('style'))
             self._soup.html.head.style.string = kwargs.pop('style')
 
+    @timing.timed('add_data')
     def _add_data(self):
         data = self._soup.new_tag('script')
         data.attrs["type"] = "application/ld+json"
-        data.append('\nwindow.data = ' + json.dumps({
+        _data = {
             'entities': dict([(qid, entity.json()) for qid, entity in self.entities.items()]),
             'maps': dict([(mapid, _map.json()) for mapid, _map in self.maps.items()]),
             'customComponents': self.custom_components
-        }, indent=2) + '\n')
+        }
+        if self.prefetch:
+            _data['prefetch'] = self.prefetch
+        if self.entity_data:
+            _data['entityData'] = self.entity_data
+        data.append('\nwindow.data = ' + json.dumps(_data, indent=2) + '\n')
         self._soup.html.body.article.append(data)
 
     def _section_ids_for_elem(self, elem):
+        context = self._section_context(elem)
+        if context:
+            return context[1]
         section_ids = set()
         while elem:
             if elem.name in('section', 'article') and 'id' in elem.attrs:
@@ -315,6 +452,7 @@ class Essay(object):
             elem = elem.parent
         return section_ids
 
+    @timing.timed('tag_entities')
     def _tag_entities(self):
         def tag_visible(element):
             '''Returns true if text element is visible and not a comment.'''
@@ -324,93 +462,118 @@ class Essay(object):
                 return False
             return True
 
-        to_match = {}
-        for entity in self.entities.values():
-            to_match[entity.label.lower()] = entity
-            if entity.aliases:
-                for alias in entity.aliases:
-                    to_match[alias.lower()] = entity
-
-        for e in [e for e in filter(tag_visible, self._soup.findAll(text=True)) if e.strip() != '']:
-            context = self._section_ids_for_elem(e)
-            snorm = e.string.lower()
-            matches = []
-            for tm in sorted(to_match.keys(), key=len, reverse=True):
-                try:
-                    for m in [m.start() for m in re.finditer(tm, snorm)]:
-                        start = m
-                        end = start + len(tm)
-                        logger.info(f'{tm} "{to_match[tm].label}" start={start} end={end} apply_to={to_match[tm].apply_to}')
-                        overlaps = False
-                        for match in matches:
-                            mstart = match['idx']
-                            mend = mstart + len(match['matched'])
-                            if (start >= mstart and start <= mend) or (end >= mstart and end <= mend):
-                                # logger.info(f'{tm} overlaps with {match["matched"]} {match["idx"]}')
-                                overlaps = True
-                                break
-                        if not overlaps:
-                            matches.append({'idx': m, 'matched': e.string[m:m+len(tm)], 'entity': to_match[tm]})
-                except:
-                    pass
-            matches.sort(key=lambda x: x['idx'], reverse=False)
-            if matches:
-                p = e.parent
-                s = e.string
-                for idx, child in enumerate(p.children):
-                    if child == e:
-                        break
+        matcher = EntityMatcher(self.entities.values())
+        if not matcher:
+            _remove_empty_tags(self._soup)
+            return
 
-                cursor = 0
-                replaced = []
-                for rec in matches:
-                    m = rec['idx']
-                    entity = rec['entity']
-                    if m > cursor:
-                        seg = s[cursor:m]
-                        if replaced:
-                            p.insert(idx+len(replaced), seg)
-                        else:
-                            e.replace_with(seg)
-                        replaced.append(seg)
-                        cursor = m
-
-                    # logger.info(f'{rec["matched"]} {entity.apply_to} {context} {entity.apply_to.intersection(context)}')
-                    if entity.apply_to.intersection(context):
-                        # make tag for matched item
-                        seg = self._soup.new_tag('span')
-                        seg.string = rec['matched']
-                        seg.attrs['title'] = entity.label
-                        seg.attrs['class'] = 'entity'
-                        seg.attrs['data-qid'] = entity.qid
-                    else:
-                        seg = s[cursor:cursor+len(rec['matched'])]
-                    if replaced:
-                        p.insert(idx+len(replaced), seg)
-                    else:
-                        e.replace_with(seg)
-                    replaced.append(rec['matched'])
-                    cursor += len(rec['matched'])
-
-                if cursor < len(s):
-                    seg = s[cursor:]
-                    p.insert(idx+len(replaced), seg)
-                    replaced.append(seg)
+        texts = [e for e in filter(tag_visible, self._soup.findAll(text=True)) if e.strip() != '']
+        for elems, tagged in self._section_tags(matcher, texts):
+            for e, html in zip(elems, tagged):
+                if html is not None:
+                    e.replace_with(TaggedHTML(html))
         _remove_empty_tags(self._soup)
-    
-    def _get_entity_data(self, qids):
+
+    def _section_tags(self, matcher, texts):
+        '''Yields (text nodes, tagged HTML of each node, None without matches) per section.  The
+           tagged HTML is cached by the section's text, the terms that can match in it and, for
+           their entities, the label and whether the entity applies to the section.  Re-rendering
+           an edited essay only scans and tags the sections that changed (or whose entities did).'''
+        sections = {}
+        for e in texts:
+            context = self._section_ids_for_elem(e)
+            sections.setdefault((self._parent_section_id(e), context if isinstance(context, frozenset) else frozenset(context)), []).append(e)
+        signature = matcher.signature()
+        cache.set(('Essay.matcher_terms', signature), matcher.terms, ttl=SECTION_TAGS_TTL)
+        added_terms = {}
+        tags = {}
+        for (_, context), elems in sections.items():
+            text = '\0'.join([e.string for e in elems])
+            text_digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            terms = self._section_terms(matcher, signature, text, text_digest, added_terms)
+            entities = sorted([(term, qid, self.entities[qid].label, bool(self.entities[qid].apply_to.intersection(context))) for term, qid in terms.items()])
+            key = ('Essay.section_tags', RENDER_VERSION, text_digest, hashlib.sha1(json.dumps(entities).encode('utf-8')).hexdigest())
+            tagged = cache.get(key)
+            if tagged is None:
+                tagged = [self._tagged_html(e.string, matcher.find(e.string), context, tags) for e in elems]
+                cache.set(key, tagged, ttl=SECTION_TAGS_TTL)
+                timing.count('sections_tagged')
+            else:
+                timing.count('sections_reused')
+            yield elems, tagged
+
+    def _section_terms(self, matcher, signature, text, text_digest, added_terms):
+        '''Returns the matcher terms (term -> QID) occurring in a section's text, only terms
+           occurring in the text can match in it.  The terms found for the text with an earlier
+           matcher are updated with the terms added since, without checking every term.'''
+        key = ('Essay.section_terms', text_digest)
+        cached = cache.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        lowered = text.lower()
+        if cached is not None and cached[0] not in added_terms:
+            previous = cache.get(('Essay.matcher_terms', cached[0]))
+            added_terms[cached[0]] = [(term, qid) for term, qid in matcher.terms.items() if term not in previous] if previous is not None else None
+        if cached is not None and added_terms[cached[0]] is not None:
+            terms = dict([(term, matcher.terms[term]) for term in cached[1] if term in matcher.terms])
+            terms.update([(term, qid) for term, qid in added_terms[cached[0]] if term in lowered])
+        else:
+            terms = dict([(term, qid) for term, qid in matcher.terms.items() if term in lowered])
+        cache.set(key, (signature, terms), ttl=SECTION_TAGS_TTL)
+        return terms
+
+    def _tagged_html(self, s, matches, context, tags):
+        '''HTML of a text node with entity tags for the matches applying to its section, None
+           without matches.  Text is escaped as by the (minimal) formatter used serializing the
+           essay, the entity tags made once per matched text and entity are kept in tags.'''
+        if not matches:
+            return None
+        escape = EntitySubstitution.substitute_xml
+        html = []
+        cursor = 0
+        for start, end, entity in matches:
+            if start > cursor:
+                html.append(escape(s[cursor:start]))
+            if entity.apply_to.intersection(context):
+                matched = s[start:end]
+                if (matched, entity.qid) not in tags:
+                    # make tag for matched item
+                    seg = self._soup.new_tag('span')
+                    seg.string = matched
+                    seg.attrs['title'] = entity.label
+                    seg.attrs['class'] = 'entity'
+                    seg.attrs['data-qid'] = entity.qid
+                    tags[(matched, entity.qid)] = seg.decode()
+                html.append(tags[(matched, entity.qid)])
+            else:
+                html.append(escape(s[start:end]))
+            cursor = end
+        if cursor < len(s):
+            html.append(escape(s[cursor:]))
+        return ''.join(html)
+
+    @classmethod
+    def _get_entity_data(cls, qids, stream=False):
         sparql = open(os.path.join(SPARQL_DIR, 'entities.rq'), 'r').read()
         sparql = sparql.replace('VALUES (?item) {}', f'VALUES (?item) {{ (wd:{") (wd:".join(qids)}) }}')
         context = json.loads(open(os.path.join(SPARQL_DIR, 'entities_context.json'), 'r').read())
-        resp = requests.post(
+        resp = transport.post(
             'https://query.wikidata.org/sparql',
             headers={
                 'Accept': 'text/plain',
                 'Content-type': 'application/x-www-form-urlencoded'},
-            data='query=%s' % quote(sparql)
+            data='query=%s' % quote(sparql),
+            stream=stream,
+            idempotent=True
         )
-        if resp.status_code == 200:
+        if resp.status_code != 200:
+            resp.close()
+        elif stream:
+            # Convert N-Triples to json-ld one subject at a time, as they are read (the query orders by ?item)
+            return {'@context': context, '@graph': iter_jsonld_nodes(transport.iter_lines(resp), context)}
+        else:
             # Convert N-Triples to json-ld using json-ld context
+            from rdflib import ConjunctiveGraph as Graph
             graph = Graph()
             graph.parse(data=resp.text, format='nt')
             _jsonld = json.loads(str(graph.serialize(format='json-ld', context=context, indent=None), 'utf-8'))
@@ -419,6 +582,52 @@ class Essay(object):
                 _jsonld = {'@context': _context, '@graph': [_jsonld]}
             return _jsonld
 
+    @classmethod
+    def prefetch_entity_data(cls, qids):
+        '''Caches entity data for QIDs ahead of rendering the essays using them, returns the
+           number of QIDs with data'''
+        return sum(1 for _ in cls._iter_entity_data(qids))
+
+    @classmethod
+    def _iter_entity_data(cls, qids):
+        '''Yields entity data for each QID, cached QIDs first, then the rest as their chunked
+           queries complete'''
+        version = entity_data_version()
+        uncached = []
+        for qid in dict.fromkeys(qids):
+            attrs = cache.get(('Essay.entity_data', qid, version))
+            if attrs is None:
+                uncached.append(qid)
+            elif attrs:
+                yield attrs
+        chunks = [uncached[start:start+ENTITY_DATA_CHUNK_SIZE] for start in range(0, len(uncached), ENTITY_DATA_CHUNK_SIZE)]
+        if len(chunks) == 1:
+            yield from cls._fetch_entity_data(chunks[0], version)
+        elif chunks:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(ENTITY_DATA_CONCURRENCY, len(chunks))) as executor:
+                futures = [executor.submit(timing.bind(cls._fetch_entity_data), chunk, version) for chunk in chunks]
+                for future in concurrent.futures.as_completed(futures):
+                    yield from future.result()
+
+    @classmethod
+    @timing.timed('entity_data')
+    def _fetch_entity_data(cls, qids, version):
+        '''Queries entity data for a chunk of QIDs and caches it per QID.  QIDs missing from a
+           successful response are cached as empty, a failed chunk is logged and not cached.'''
+        try:
+            _jsonld = cls._get_entity_data(qids, stream=True)
+            if _jsonld is None:
+                logger.warning(f'Entity data query failed for {len(qids)} QIDs')
+                return []
+            nodes = [node for node in _jsonld['@graph'] if node.get('qid') in qids]
+        except Exception as e:
+            logger.warning(f'Entity data query failed for {len(qids)} QIDs: {e}')
+            return []
+        by_qid = dict([(node['qid'], node) for node in nodes])
+        for qid in qids:
+            cache.set(('Essay.entity_data', qid, version), by_qid.get(qid, {}), ttl=ENTITY_DATA_TTL)
+        return nodes
+
     def _add_leaflet(self):
         '''Add Leaflet CSS and JS links'''
         self._soup.html.head.append(BeautifulSoup('<link rel="stylesheet" href="https://unpkg.com/leaflet@1.6.0/dist/leaflet.css" integrity="sha512-xwE/Az9zrjBIphAcBb3F6JVqxf46+CDLwfLMHloNu6KEQCAWi6HcDUbeOfBIptF7tcCzusKFjFw2yuvEpDL9wQ==" crossorigin=""/>', 'html5lib'))
@@ -446,14 +655,21 @@ class Essay(object):
 
     @property
     def json(self):
-        return {
+        _json = {
             'html': str(self._soup),
             'entities': [entity.json() for entity in self.entities.values()]
         }
+        if self.entity_data:
+            _json['entity_data'] = self.entity_data
+        return _json
 
     def __repr__(self):
         return json.dumps(self.json, sort_keys=True)
 
+    @property
+    def soup(self):
+        return self._soup
+
     @property
     def html(self):
         #return self._soup.prettify()
@@ -462,29 +678,113 @@ class Essay(object):
     def __str__(self):
         return self.html
 
+def prefetch_mode(prefetch):
+    '''The entity prefetch mode of an essay render arg, None when off'''
+    return prefetch if prefetch in PREFETCH_MODES else None
+
+def render_variant(prefetch, language=None):
+    '''Render cache key suffix of the prefetch mode, inline prefetched entity data is per language'''
+    if prefetch == 'inline':
+        return (prefetch, language)
+    return (prefetch,) if prefetch else ()
+
+_entity_data_version = None
+def entity_data_version():
+    '''Version of the entity data query and rendering code, part of the rendered essay cache key'''
+    global _entity_data_version
+    if _entity_data_version is None:
+        digest = hashlib.sha1(str(RENDER_VERSION).encode('utf-8'))
+        for fname in ('entities.rq', 'entities_context.json'):
+            with open(os.path.join(SPARQL_DIR, fname), 'rb') as fp:
+                digest.update(fp.read())
+        _entity_data_version = digest.hexdigest()[:12]
+    return _entity_data_version
+
 class EssayUtils(object):
 
     def __init__(self, site=False, **kwargs):
         self.default_site = site if site else DEFAULT_SITE
 
-    def page(self, title, site=None, wikitext=False, **kwargs):
+    @timing.timed('revision')
+    def revision(self, title, site=None):
+        '''Returns the current revision ID of a page, None if it cannot be determined'''
         site = site if site else self.default_site
-        logger.info(f'page: title={title} site={site} wikitext={wikitext}')
+        url = f'https://{site}/w/api.php?action=query&prop=revisions&rvprop=ids&format=json&formatversion=2&titles={quote(title)}'
         try:
-            if wikitext:
-                url = f'https://{site}/w/api.php?action=query&prop=revisions&rvprop=content&format=json&formatversion=2&titles={quote(title)}'
-                resp = requests.get(url, headers={'Accept': 'application/json'}).json()
-                return resp['query']['pages'][0]['revisions'][0]['content']
-            else:
-                url = f'https://{site}/w/api.php?action=parse&format=json&page={quote(title)}'
-                resp = requests.get(url, headers={'Accept': 'application/json'}).json()
-                resp ['html'] = f'<!doctype html><html lang="en">\n<head>\n<meta charset="utf-8">\n<title>{title}</title>\n</head>\n<body>\n' + resp.pop('parse')['text']['*'] + '\n</body>\n</html>'
-                return resp
-        except:
+            resp = transport.get(url, headers={'Accept': 'application/json'}).json()
+            return resp['query']['pages'][0]['revisions'][0]['revid']
+        except Exception as e:
+            logger.warning(f'revision: title={title} site={site} error={e}')
             return None
 
+    def render(self, title, site=None, fmt='html', **kwargs):
+        '''Returns the rendered essay, as the Vue app HTML or (fmt='json') the Essay JSON.  Renderings
+           are cached by (site, title, revision, entity data version), so an unchanged page costs
+           one revision lookup.  Re-rendering a new revision evicts the previous one.  With prefetch
+           ('inline' or 'sidecar', see ESSAY_PREFETCH) the full entity data is prefetched.'''
+        site = site if site else self.default_site
+        prefetch = prefetch_mode(kwargs.get('prefetch', ESSAY_PREFETCH))
+        revid = self.revision(title, site=site)
+        key = self.render_key(title, site, fmt, revid, prefetch, kwargs.get('language'))
+        if revid:
+            rendered = cache.get(key)
+            if rendered is not None:
+                logger.info(f'render: title={title} site={site} revid={revid} cached')
+                return rendered
+
+        page_data = self.page(title, site=site, revid=revid, **kwargs)
+        page_data['style'] = DEFAULT_STYLESHEET
+        page_data['html'] = mw_to_html5(page_data['html'])
+        page_data.update(prefetch=prefetch, language=kwargs.get('language'))
+        essay = Essay(**page_data)
+        rendered = json.dumps(essay.json) if fmt == 'json' else add_vue_app(essay.soup)
+
+        if revid:
+            latest_key = ('EssayUtils.render.latest', site, title, fmt) + render_variant(prefetch, kwargs.get('language'))
+            previous_key = cache.get(latest_key)
+            if previous_key and previous_key != key:
+                cache.delete(previous_key)
+            # a render missing prefetched entities is replaced soon by one with them (from the cache)
+            cache.set(key, rendered, ttl=ESSAY_TTL if essay.prefetch_complete else ESSAY_PARTIAL_TTL)
+            cache.set(latest_key, key, ttl=None)
+        return rendered
+
+    def render_key(self, title, site, fmt, revid, prefetch=None, language=None):
+        '''Cache key of a rendered essay'''
+        return ('EssayUtils.render', site, title, fmt, revid, entity_data_version()) + render_variant(prefetch, language)
+
+    @timing.timed('page')
+    def page(self, title, site=None, wikitext=False, revid=None, **kwargs):
+        '''Returns the page wikitext, or the parsed page data.  Raises PageNotFound for a missing
+           page and requests.RequestException when the site cannot be reached or fails.'''
+        site = site if site else self.default_site
+        logger.info(f'page: title={title} site={site} wikitext={wikitext} revid={revid}')
+        if wikitext:
+            url = f'https://{site}/w/api.php?action=query&prop=revisions&rvprop=content&format=json&formatversion=2&titles={quote(title)}'
+        else:
+            # parse the revision the cache key was made for, the page may have changed since
+            url = f'https://{site}/w/api.php?action=parse&format=json&oldid={revid}' if revid else f'https://{site}/w/api.php?action=parse&format=json&page={quote(title)}'
+        resp = transport.get(url, headers={'Accept': 'application/json'})
+        resp.raise_for_status()
+        resp = resp.json()
+        if 'error' in resp:
+            # missingtitle, nosuchrevid, ...
+            raise PageNotFound(f'{title} ({site}): {resp["error"].get("info", resp["error"].get("code"))}')
+        if wikitext:
+            page = resp['query']['pages'][0]
+            if page.get('missing') or not page.get('revisions'):
+                raise PageNotFound(f'{title} ({site})')
+            return page['revisions'][0]['content']
+        resp['html'] = page_html(title, resp.pop('parse')['text']['*'])
+        return resp
+
+def page_html(title, parser_output):
+    '''Wraps the HTML generated by the MediaWiki parser in a document'''
+    return f'<!doctype html><html lang="en">\n<head>\n<meta charset="utf-8">\n<title>{title}</title>\n</head>\n<body>\n' + parser_output + '\n</body>\n</html>'
+
+@timing.timed('add_vue_app')
 def add_vue_app(arg):
-    soup = arg if isinstance(arg, BeautifulSoup) else BeautifulSoup(arg, 'html5lib')
+    soup = arg if isinstance(arg, BeautifulSoup) else BeautifulSoup(arg, HTML_PARSER)
 
     # http_vue_loader = soup.new_tag('script')
     # http_vue_loader.attrs['src'] = 'https://unpkg.com/http-vue-loader'
@@ -510,30 +810,6 @@ def add_vue_app(arg):
 
     return str(soup)
 
-@app.route('/healthcheck')
-def healthcheck():
-    return 'OK'        
-
-@app.route('/page', methods=['GET', 'POST'])
-def page():
-    kwargs = dict([(k, request.args.get(k)) for k in request.args])
-    accept = request.headers.get('Accept', 'application/json').split(',')
-    content_type = ([ct for ct in accept if ct in ('text/html', 'application/json', 'text/csv', 'text/tsv')] + ['application/json'])[0]
-    as_json = kwargs.pop('format', None) == 'json' or content_type == 'application/json'
-
-    page_data = client.page(**kwargs)
-    page_data['style'] = DEFAULT_STYLESHEET
-    page_data['html'] = mw_to_html5(page_data['html'])
-    essay = Essay(**page_data)
-
-    if as_json:
-        essay = json.dumps(essay.json)
-        if content_type == 'text/html':
-            essay = open('viewer.html', 'r').read().replace("'{{DATA}}'", essay)
-    else:
-        essay = add_vue_app(essay.html)
-    return app.response_class(essay, status=200, mimetype=content_type)
-
 def usage():
     print(f'{sys.argv[0]} [hl:s:e:f:w] title')
     print(f'   -h --help          Print help message')
@@ -586,4 +862,5 @@ if __name__ == '__main__':
         #print(json.dumps([entity.json() for entity in essay.entities.values()]))
         print(essay.html)
     else:
+        from app import app
         app.run(debug=True, host='0.0.0.0')
\ No newline at end of file
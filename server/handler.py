@@ -2,11 +2,18 @@ import logging
 logger = logging.getLogger()
 logger.setLevel(logging.WARNING)
 
+import base64
 import json
-import os
 
-from entity import KnowledgeGraph
-from essay_utils import EssayUtils, Essay, mw_to_html5, add_vue_app
+import requests
+
+import caching
+import compression
+import timing
+import transport
+
+# entity and essay_utils are imported by the handlers using them, so each function's cold start
+# only loads what it needs (essay_utils pulls in BeautifulSoup and its parser)
 
 cors_headers = {
     'Access-Control-Allow-Origin': '*',
@@ -17,7 +24,11 @@ def _lambda_args(event, body_key=None, multiValue_qargs=False, normalize_keys=Tr
     args = event['multiValueQueryStringParameters'] if multiValue_qargs else event['queryStringParameters']
     if args is None:
         args = {}
-    body = json.loads(event['body']) if event['body'] else {}
+    body = event['body']
+    if body and event.get('isBase64Encoded'):
+        # API Gateway encodes request bodies when binary media types are enabled
+        body = base64.b64decode(body).decode('utf-8')
+    body = json.loads(body) if body else {}
     if body_key:
         args[body_key] = body
     else:
@@ -32,23 +43,89 @@ def _lambda_args(event, body_key=None, multiValue_qargs=False, normalize_keys=Tr
             logger.setLevel(logging.INFO)
     return args
 
+def _response(event, body, content_type):
+    '''Proxy integration response with an ETag, 304 when the client copy is current, else the
+       body gzip/brotli encoded per Accept-Encoding (base64 encoded for API Gateway)'''
+    request_headers = dict([(k.lower(), v) for k, v in (event.get('headers') or {}).items()])
+    status, headers, body = compression.respond(body, request_headers, content_type)
+    headers.update(cors_headers)
+    request_timing = timing.current()
+    if request_timing is not None:
+        headers['Server-Timing'] = request_timing.header()
+    if isinstance(body, bytes):
+        return {'statusCode': status, 'headers': headers, 'body': base64.b64encode(body).decode('ascii'), 'isBase64Encoded': True}
+    return {'statusCode': status, 'headers': headers, 'body': body}
+
+def _error(status, message, retry_after=None):
+    '''Proxy integration error response, 503 responses for unreachable upstream services carry a Retry-After'''
+    headers = dict(cors_headers, **{'Content-Type': 'application/json'})
+    if retry_after is not None:
+        headers['Retry-After'] = str(int(retry_after) + 1)
+    request_timing = timing.current()
+    if request_timing is not None:
+        headers['Server-Timing'] = request_timing.header()
+    return {'statusCode': status, 'headers': headers, 'body': json.dumps({'error': message})}
+
+def _upstream_error(e):
+    logger.warning(f'upstream error: {e}')
+    return _error(503, 'upstream service unavailable', retry_after=getattr(e, 'retry_after', transport.RETRY_BACKOFF_MAX))
+
 def get_entity(event, context):
     args = _lambda_args(event)
     qid = event['pathParameters'].get('qid')
     logger.info('get_entity: qid=%s args=%s', qid, args)
-    entity = KnowledgeGraph(**args).entity(qid, **args)
-    return {'statusCode': 200, 'headers': cors_headers, 'body': json.dumps(entity)}
+    from entity import KnowledgeGraph
+    transport.reset_stats()
+    caching.reset_stats()
+    with timing.request('get_entity', qid=qid):
+        try:
+            entity = KnowledgeGraph(**args).entity(qid, **args)
+        except requests.RequestException as e:
+            return _upstream_error(e)
+        if not entity:
+            return _error(404, f'entity not found: {qid}')
+        logger.info('get_entity: qid=%s upstream=%s cache=%s', qid, json.dumps(transport.stats()), json.dumps(caching.stats()))
+        return _response(event, json.dumps(entity), 'application/json')
+
+def post_entities(event, context):
+    args = _lambda_args(event)
+    qids = args.pop('qids', [])
+    # returns the entities keyed by QID, {} when not found and null when the lookup failed; with a
+    # budget (seconds) only the entities fetched in time are returned (an essay's prefetch sidecar)
+    budget = args.pop('budget', None)
+    logger.info('post_entities: qids=%s budget=%s args=%s', len(qids), budget, args)
+    from entity import KnowledgeGraph
+    transport.reset_stats()
+    caching.reset_stats()
+    with timing.request('post_entities', qids=len(qids)):
+        try:
+            budget = float(budget) if budget is not None else None
+        except ValueError:
+            return _error(400, f'invalid budget: {budget}')
+        kg = KnowledgeGraph(**args)
+        try:
+            if budget is not None:
+                entities = kg.prefetch(qids, budget, language=args.get('language'), entity_type=args.get('entity_type'))
+            else:
+                entities = kg.entities(qids, language=args.get('language'), entity_type=args.get('entity_type'))
+        except requests.RequestException as e:
+            return _upstream_error(e)
+        logger.info('post_entities: qids=%s upstream=%s cache=%s', len(qids), json.dumps(transport.stats()), json.dumps(caching.stats()))
+        return _response(event, json.dumps(entities), 'application/json')
 
 def get_essay(event, context):
     args = _lambda_args(event)
     title = event['pathParameters'].get('title')
     logger.info(f'get_essay: title="{title}" args={args}')
-    client = EssayUtils(**args)
-    page_data = client.page(title, **args)
-    page_data['html'] = mw_to_html5(page_data['html'])
-    essay = Essay(**page_data)
-    essay = add_vue_app(essay.html)
-    logger.error(essay)
-    headers = {'Content-Type': 'text/html'}
-    headers.update(cors_headers)
-    return {'statusCode': 200, 'headers': headers, 'body': essay}
+    from essay_utils import EssayUtils, PageNotFound
+    transport.reset_stats()
+    caching.reset_stats()
+    with timing.request('get_essay', title=title):
+        try:
+            essay = EssayUtils(**args).render(title, **args)
+        except PageNotFound as e:
+            return _error(404, f'page not found: {e}')
+        except requests.RequestException as e:
+            return _upstream_error(e)
+        logger.info(f'get_essay: title="{title}" upstream={json.dumps(transport.stats())} cache={json.dumps(caching.stats())}')
+        return _response(event, essay, 'text/html')
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Pre-renders every essay on a site (or in a fixture directory) to static HTML/JSON files.
+
+   Pages are listed with the MediaWiki allpages API and processed in batches.  For each batch
+   the page HTML is fetched concurrently, the entity data for all QIDs in the batch is fetched
+   once (deduplicated, into the shared per-QID cache), then the essays are rendered in a
+   process pool.  Outputs are written to the output directory with a manifest.json recording
+   the revision, files, timings and errors of each page.  Re-running resumes from the manifest,
+   skipping rendered pages and retrying failed ones.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os
+import getopt
+import hashlib
+import json
+import sys
+import concurrent.futures
+import itertools
+from time import time as now
+from urllib.parse import quote
+
+import transport
+from essay_utils import Essay, EssayUtils, DEFAULT_SITE, page_html
+from static_essay import QID_RE, StaticEssayUtils
+
+# Number of pages fetched, entity prefetched and rendered together
+BATCH_SIZE = 50
+MANIFEST = 'manifest.json'
+
+def allpages(site, apcontinue=None, namespace=0):
+    '''Yields (titles, continuation) for each allpages API response, continuation is None after the last'''
+    while True:
+        url = f'https://{site}/w/api.php?action=query&list=allpages&apnamespace={namespace}&aplimit=max&format=json&formatversion=2'
+        if apcontinue:
+            url += f'&apcontinue={quote(apcontinue)}'
+        resp = transport.get(url, headers={'Accept': 'application/json'})
+        resp.raise_for_status()
+        resp = resp.json()
+        apcontinue = resp.get('continue', {}).get('apcontinue')
+        yield [page['title'] for page in resp['query']['allpages']], apcontinue
+        if not apcontinue:
+            break
+
+def fixture_pages(fixture_dir):
+    '''Yields (titles, None) for the MediaWiki parser output files (<title>.html) in a directory'''
+    titles = sorted(fname[:-5] for fname in os.listdir(fixture_dir) if fname.endswith('.html'))
+    yield titles, None
+
+def fixture_site(fixture_dir):
+    '''The site fixture pages are rendered for, keeping their cached renders apart from the real site's'''
+    return f'fixtures:{os.path.abspath(fixture_dir)}'
+
+def fetch_page(title, site, fixture_dir=None):
+    '''Returns (revid, page_data) for a title, from the fixture directory if given'''
+    if fixture_dir:
+        with open(os.path.join(fixture_dir, f'{title}.html'), 'r') as fp:
+            parser_output = fp.read()
+        return hashlib.sha1(parser_output.encode('utf-8')).hexdigest()[:12], {'html': page_html(title, parser_output)}
+    client = EssayUtils(site=site)
+    revid = client.revision(title, site=site)
+    return revid, client.page(title, site=site, revid=revid)
+
+def output_path(output_dir, title, fmt):
+    return os.path.join(output_dir, f'{quote(title, safe="")}.{fmt}')
+
+def render_page(title, site, revid, page_data, formats, output_dir):
+    '''Renders one essay in each format (in a pool process), returns its manifest entry'''
+    start = now()
+    client = StaticEssayUtils({title: (revid, page_data)}, site=site)
+    files = []
+    size = 0
+    for fmt in formats:
+        rendered = client.render(title, site=site, fmt=fmt)
+        path = output_path(output_dir, title, fmt)
+        with open(path, 'w') as fp:
+            fp.write(rendered)
+        files.append(os.path.basename(path))
+        size += len(rendered)
+    return {'status': 'ok', 'revid': revid, 'files': files, 'bytes': size, 'render_s': round(now() - start, 3)}
+
+def load_manifest(output_dir, site):
+    path = os.path.join(output_dir, MANIFEST)
+    if os.path.exists(path):
+        with open(path, 'r') as fp:
+            manifest = json.load(fp)
+        if manifest.get('site') == site:
+            return manifest
+        logger.warning(f'Ignoring manifest for site {manifest.get("site")}')
+    return {'site': site, 'apcontinue': None, 'pages': {}}
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST)
+    with open(f'{path}.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
+def prerender_batch(titles, site, formats, output_dir, executor, fixture_dir=None):
+    '''Fetches, prefetches entity data for and renders a batch of titles, returns their manifest entries'''
+    entries = {}
+    fetched = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=transport.POOL_SIZE) as fetch_executor:
+        futures = dict([(fetch_executor.submit(fetch_page, title, site, fixture_dir), (title, now())) for title in titles])
+        for future in concurrent.futures.as_completed(futures):
+            title, start = futures[future]
+            try:
+                fetched[title] = future.result() + (round(now() - start, 3),)
+            except Exception as e:
+                entries[title] = {'status': 'error', 'error': f'fetch: {e}'}
+
+    start = now()
+    qids = sorted(set(qid for _, page_data, _ in fetched.values() for qid in QID_RE.findall(page_data['html'])))
+    found = Essay.prefetch_entity_data(qids) if qids else 0
+    logger.info(f'Prefetched entity data for {found}/{len(qids)} QIDs in {round(now() - start, 3)}s')
+
+    futures = dict([(executor.submit(render_page, title, site, revid, page_data, formats, output_dir), (title, revid, fetch_s))
+                    for title, (revid, page_data, fetch_s) in fetched.items()])
+    for future in concurrent.futures.as_completed(futures):
+        title, revid, fetch_s = futures[future]
+        try:
+            entries[title] = future.result()
+        except Exception as e:
+            entries[title] = {'status': 'error', 'revid': revid, 'error': f'render: {e}'}
+        entries[title]['fetch_s'] = fetch_s
+        logger.info(f'{title}: {json.dumps(entries[title])}')
+    return entries
+
+def prerender(site=DEFAULT_SITE, output_dir='prerendered', formats=('html',), workers=None, fixture_dir=None, restart=False, limit=None):
+    '''Pre-renders all pages of site (or fixture_dir) into output_dir, returns the manifest'''
+    if fixture_dir:
+        site = fixture_site(fixture_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir, site)
+    if restart:
+        manifest = {'site': site, 'apcontinue': None, 'pages': {}}
+    pages = manifest['pages']
+    done = lambda title: title in pages and pages[title]['status'] == 'ok' and all(
+        os.path.exists(output_path(output_dir, title, fmt)) for fmt in formats)
+
+    # pages that failed in a previous run are retried first
+    retry = [title for title in pages if pages[title]['status'] != 'ok']
+    listing = fixture_pages(fixture_dir) if fixture_dir else allpages(site, apcontinue=manifest['apcontinue'])
+    attempted = set()
+    start = now()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for titles, apcontinue in itertools.chain([(retry, manifest['apcontinue'])] if retry else [], listing):
+            todo = [title for title in dict.fromkeys(titles) if title not in attempted and not done(title)]
+            if limit is not None:
+                todo = todo[:max(limit - len(attempted), 0)]
+            attempted.update(todo)
+            for batch_start in range(0, len(todo), BATCH_SIZE):
+                pages.update(prerender_batch(todo[batch_start:batch_start+BATCH_SIZE], site, formats, output_dir, executor, fixture_dir))
+                save_manifest(output_dir, manifest)
+            if not fixture_dir:
+                manifest['apcontinue'] = apcontinue
+            save_manifest(output_dir, manifest)
+            if limit is not None and len(attempted) >= limit:
+                break
+    manifest['elapsed_s'] = round(now() - start, 3)
+    save_manifest(output_dir, manifest)
+    return manifest
+
+def report(manifest):
+    '''Prints render time percentiles, the slowest pages and the failures'''
+    pages = manifest['pages']
+    ok = sorted([(entry['render_s'], title) for title, entry in pages.items() if entry['status'] == 'ok'], reverse=True)
+    failed = [(title, entry['error']) for title, entry in pages.items() if entry['status'] != 'ok']
+    print(f'{len(ok)} rendered, {len(failed)} failed, {manifest.get("elapsed_s")}s elapsed')
+    if ok:
+        times = sorted(render_s for render_s, _ in ok)
+        pct = lambda p: times[min(int(p * len(times)), len(times) - 1)]
+        print(f'render time: p50 {pct(0.5)}s  p95 {pct(0.95)}s  max {times[-1]}s')
+        for render_s, title in ok[:10]:
+            print(f'   {render_s:7.3f}s  fetch {pages[title].get("fetch_s", 0):6.3f}s  {title}')
+    for title, error in failed:
+        print(f'   FAILED {title}: {error}')
+
+def usage():
+    print(f'{sys.argv[0]} [hl:s:o:f:j:d:n:r]')
+    print('   -h --help          Print help message')
+    print('   -l --loglevel      Logging level (default=warning)')
+    print(f'   -s --site          Site to pre-render (default="{DEFAULT_SITE}")')
+    print('   -o --output        Output directory (default=prerendered)')
+    print('   -f --format        Comma separated formats (html, json) (default=html)')
+    print('   -j --workers       Number of render processes (default=number of cores)')
+    print('   -d --fixtures      Directory of MediaWiki parser output files (<title>.html) used instead of the site')
+    print('   -n --limit         Max number of pages to render')
+    print('   -r --restart       Ignore the manifest of a previous run')
+
+if __name__ == '__main__':
+    kwargs = {}
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:], 'hl:s:o:f:j:d:n:r', ['help', 'loglevel', 'site', 'output', 'format', 'workers', 'fixtures', 'limit', 'restart'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-l', '--loglevel'):
+            loglevel = a.lower()
+            if loglevel in ('error',): logger.setLevel(logging.ERROR)
+            elif loglevel in ('warn','warning'): logger.setLevel(logging.WARNING)
+            elif loglevel in ('info',): logger.setLevel(logging.INFO)
+            elif loglevel in ('debug',): logger.setLevel(logging.DEBUG)
+        elif o in ('-s', '--site'):
+            kwargs['site'] = a
+        elif o in ('-o', '--output'):
+            kwargs['output_dir'] = a
+        elif o in ('-f', '--format'):
+            kwargs['formats'] = tuple(fmt.strip() for fmt in a.split(','))
+        elif o in ('-j', '--workers'):
+            kwargs['workers'] = int(a)
+        elif o in ('-d', '--fixtures'):
+            kwargs['fixture_dir'] = a
+        elif o in ('-n', '--limit'):
+            kwargs['limit'] = int(a)
+        elif o in ('-r', '--restart'):
+            kwargs['restart'] = True
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    report(prerender(**kwargs))
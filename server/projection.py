@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Projects SPARQL CONSTRUCT results (N-Triples) directly onto entity dicts.
+
+   KnowledgeGraph._frame gets the same result by loading the N-Triples into rdflib, serializing
+   them to JSON-LD and framing that with pyld.  For the flat, single level entity frames used
+   here this reduces to compacting each subject's predicate/object pairs with the context term
+   map, which is what the Projector does, following the term selection and value compaction
+   rules of the JSON-LD compaction algorithm (as implemented by pyld) for the subset of context
+   features used by the sparql/*_context.json files.  Blank node labels are renumbered per
+   entity (_:b0, _:b1, ...) like pyld does, though not necessarily in the same order.
+
+   The iter_* functions work on streamed responses, handling one subject's triples at a time.'''
+
+import logging
+logger = logging.getLogger()
+
+import json
+import re
+from datetime import datetime, date
+from decimal import Decimal, InvalidOperation
+from functools import cmp_to_key
+
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+_IRI = r'<([^>]*)>'
+_BNODE = r'(_:[^\s]+)'
+_LITERAL = r'"((?:[^"\\]|\\.)*)"(?:@([a-zA-Z]+(?:-[a-zA-Z0-9]+)*)|\^\^<([^>]*)>)?'
+_TRIPLE = re.compile(r'\s*(?:%s|%s)\s*%s\s*(?:%s|%s|%s)\s*\.\s*$' % (_IRI, _BNODE, _IRI, _IRI, _BNODE, _LITERAL))
+_ESCAPE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+_ESCAPES = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+def _unescape(s):
+    if '\\' not in s:
+        return s
+    return _ESCAPE.sub(lambda m: chr(int(m.group(1) or m.group(2), 16)) if (m.group(1) or m.group(2)) else _ESCAPES.get(m.group(3), m.group(3)), s)
+
+def parse_ntriples(lines):
+    '''Yields (subject, predicate, object) tuples from N-Triples lines.  Subjects and predicates
+       are IRIs or blank node labels, objects are expanded JSON-LD values:
+       {'@id': iri} or {'@value': ..., ['@language': ...], ['@type': ...]}'''
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        m = _TRIPLE.match(line)
+        if not m:
+            logger.warning(f'parse_ntriples: skipping unparseable line {line[:200]}')
+            continue
+        s_iri, s_bnode, p, o_iri, o_bnode, lex, language, datatype = m.groups()
+        subject = _unescape(s_iri) if s_iri is not None else s_bnode
+        if o_iri is not None:
+            obj = {'@id': _unescape(o_iri)}
+        elif o_bnode is not None:
+            obj = {'@id': o_bnode}
+        else:
+            obj = _literal(_unescape(lex), language, datatype)
+        yield subject, _unescape(p), obj
+
+def iter_subject_lines(lines):
+    '''Groups N-Triples lines by subject, yielding (subject, lines) for each run of consecutive
+       lines with the same subject.  A subject is yielded more than once only if the endpoint
+       did not return its triples together (queries should ORDER BY the subject).'''
+    subject, group = None, []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        _subject = line.split(None, 1)[0]
+        if _subject != subject:
+            if group:
+                yield subject, group
+            subject, group = _subject, []
+        group.append(line)
+    if group:
+        yield subject, group
+
+def _subject(token):
+    '''The subject (as in parse_ntriples) of a subject token of iter_subject_lines'''
+    return _unescape(token[1:-1]) if token.startswith('<') and token.endswith('>') else token
+
+def iter_jsonld_nodes(lines, context):
+    '''Streaming equivalent of loading N-Triples into an rdflib graph and serializing it to JSON-LD,
+       yields the compacted node for each subject as its lines complete'''
+    from rdflib import ConjunctiveGraph as Graph
+    for _, group in iter_subject_lines(lines):
+        graph = Graph()
+        graph.parse(data='\n'.join(group), format='nt')
+        _jsonld = json.loads(str(graph.serialize(format='json-ld', context=context, indent=None), 'utf-8'))
+        _jsonld.pop('@context', None)
+        for node in _jsonld.get('@graph', [_jsonld]):
+            yield node
+
+def merge_nodes(node, other, id_key='id', type_key='@type'):
+    '''Merges the properties of two compacted nodes for the same subject, made from disjoint triples'''
+    merged = dict(node)
+    for k, v in other.items():
+        current = merged.get(k)
+        if k == type_key and v:
+            merged[k] = v
+        elif k == id_key or v is None or v == []:
+            merged.setdefault(k, v)
+        elif current is None or current == []:
+            merged[k] = v
+        else:
+            merged[k] = (current if isinstance(current, list) else [current]) + (v if isinstance(v, list) else [v])
+    return merged
+
+def _literal(lex, language=None, datatype=None):
+    '''Expanded value for a literal, with the lexical normalization and native (JSON) types
+       used by rdflib when serializing to JSON-LD'''
+    if language:
+        return {'@value': lex, '@language': language.lower()}
+    if not datatype or datatype == XSD + 'string':
+        return {'@value': lex}
+    normalizer = _NORMALIZERS.get(datatype[len(XSD):]) if datatype.startswith(XSD) else None
+    if normalizer:
+        try:
+            value = normalizer(lex)
+        except (ValueError, InvalidOperation):
+            value = None
+        if value is not None:
+            if isinstance(value, (bool, int, float)):
+                return {'@value': value}
+            lex = value
+    return {'@value': lex, '@type': datatype}
+
+def _datetime(lex):
+    if lex.startswith('-') or lex.startswith('0000'):
+        return None
+    return datetime.fromisoformat(lex[:-1] + '+00:00' if lex.endswith('Z') else lex).isoformat()
+
+def _date(lex):
+    return date.fromisoformat(lex).isoformat() if len(lex) == 10 and not lex.startswith('0000') else None
+
+def _boolean(lex):
+    return {'true': True, '1': True, 'false': False, '0': False}.get(lex)
+
+_NORMALIZERS = {
+    'dateTime': _datetime,
+    'date': _date,
+    'decimal': lambda lex: str(Decimal(lex)),
+    'integer': int,
+    'double': float,
+    'boolean': _boolean
+}
+
+def _add_unique(props, predicate, obj):
+    # an RDF graph holds each triple once
+    values = props.setdefault(predicate, [])
+    if not any(v == obj and type(v.get('@value')) is type(obj.get('@value')) for v in values):
+        values.append(obj)
+
+def _compare_shortest_least(a, b):
+    if len(a) != len(b):
+        return len(a) - len(b)
+    return (a > b) - (a < b)
+
+class Projector(object):
+
+    def __init__(self, context, exclude=()):
+        self.context = context
+        self.aliases = {}
+        self.terms = {}
+        for term in context:
+            self._define(term)
+        self.inverse = self._inverse()
+        self.frame = [self.terms[term]['@id'] for term in context if term not in exclude and term in self.terms]
+        self.id_key = self.compact_iri('@id')
+        self.type_key = self.compact_iri('@type')
+
+    def _define(self, term):
+        definition = self.context[term]
+        if isinstance(definition, str) and definition.startswith('@'):
+            self.aliases[definition] = term
+            return
+        mapping = {'@id': definition} if isinstance(definition, str) else dict(definition)
+        mapping['@id'] = self.expand(mapping.get('@id', term), local=term)
+        if mapping.get('@type') not in (None, '@id', '@vocab'):
+            mapping['@type'] = self.expand(mapping['@type'])
+        if mapping.get('@language'):
+            mapping['@language'] = mapping['@language'].lower()
+        mapping['_prefix'] = isinstance(definition, str) and ':' not in term and re.match(r'.*[:/\?#\[\]@]$', mapping['@id']) is not None
+        self.terms[term] = mapping
+
+    def expand(self, value, local=None):
+        '''Expands a term or compact IRI to an absolute IRI'''
+        if value in self.terms and value != local:
+            return self.terms[value]['@id']
+        if value in self.context and value != local and isinstance(self.context[value], str) and not self.context[value].startswith('@'):
+            return self.expand(self.context[value], local=value)
+        if ':' in value:
+            prefix, suffix = value.split(':', 1)
+            if not suffix.startswith('//') and prefix != '_' and prefix in self.context and prefix != local:
+                return self.expand(prefix, local=local) + suffix
+        return value
+
+    def _inverse(self):
+        inverse = {}
+        for term in sorted(self.terms, key=cmp_to_key(_compare_shortest_least)):
+            mapping = self.terms[term]
+            container = mapping.get('@container', '@none')
+            entry = inverse.setdefault(mapping['@id'], {}).setdefault(container, {'@language': {}, '@type': {}})
+            if '@type' in mapping:
+                entry['@type'].setdefault(mapping['@type'], term)
+            elif '@language' in mapping:
+                entry['@language'].setdefault(mapping['@language'] if mapping['@language'] is not None else '@null', term)
+            else:
+                entry['@language'].setdefault('@none', term)
+                entry['@type'].setdefault('@none', term)
+        return inverse
+
+    def compact_iri(self, iri, value=None, vocab=False):
+        if iri.startswith('@'):
+            if iri in self.aliases:
+                return self.aliases[iri]
+            vocab = True
+        if vocab and iri in self.inverse:
+            term = self._select_term(iri, value)
+            if term is not None:
+                return term
+        candidate = None
+        for term, mapping in self.terms.items():
+            if ':' in term or mapping['@id'] == iri or not iri.startswith(mapping['@id']):
+                continue
+            curie = f'{term}:{iri[len(mapping["@id"]):]}'
+            usable = (mapping['_prefix'] and curie not in self.terms) or (value is None and self.terms.get(curie, {}).get('@id') == iri)
+            if usable and (candidate is None or _compare_shortest_least(curie, candidate) < 0):
+                candidate = curie
+        return candidate if candidate is not None else iri
+
+    def _select_term(self, iri, value):
+        containers = []
+        if isinstance(value, dict) and '@value' not in value:
+            containers.extend(['@id', '@id@set', '@type', '@set@type'])
+        type_or_language, preferred = '@language', '@null'
+        if isinstance(value, dict) and '@value' in value:
+            if '@language' in value:
+                containers.extend(['@language', '@language@set'])
+                preferred = value['@language']
+            elif '@type' in value:
+                type_or_language, preferred = '@type', value['@type']
+        else:
+            type_or_language, preferred = '@type', '@id'
+        containers.extend(['@set', '@none'])
+        if isinstance(value, dict) and '@value' in value and len(value) == 1:
+            containers.extend(['@language', '@language@set'])
+
+        if preferred == '@id' and isinstance(value, dict) and '@value' not in value:
+            term = self.compact_iri(value['@id'], vocab=True)
+            if term in self.terms and self.terms[term]['@id'] == value['@id']:
+                prefs = ['@vocab', '@id', '@none']
+            else:
+                prefs = ['@id', '@vocab', '@none']
+        else:
+            prefs = [preferred, '@none']
+
+        container_map = self.inverse[iri]
+        for container in containers:
+            if container not in container_map:
+                continue
+            for pref in prefs:
+                if pref in container_map[container][type_or_language]:
+                    return container_map[container][type_or_language][pref]
+        return None
+
+    def compact_value(self, term, value):
+        mapping = self.terms.get(term, {})
+        if '@value' in value:
+            if ('@type' in value and value['@type'] == mapping.get('@type')) or \
+                    ('@language' in value and value['@language'] == mapping.get('@language')):
+                return value['@value']
+            if len(value) == 1:
+                return value['@value']
+            if '@type' in value:
+                return {self.type_key: self.compact_iri(value['@type'], vocab=True), self.compact_iri('@value'): value['@value']}
+            return {self.compact_iri('@language'): value['@language'], self.compact_iri('@value'): value['@value']}
+        compacted = self.compact_iri(value['@id'], vocab=mapping.get('@type') == '@vocab')
+        if mapping.get('@type') in ('@id', '@vocab'):
+            return compacted
+        return {self.id_key: compacted}
+
+    def _add(self, node, term, value):
+        as_list = self.terms.get(term, {}).get('@container') == '@set'
+        if term in node:
+            if not isinstance(node[term], list):
+                node[term] = [node[term]]
+            node[term].append(value)
+        else:
+            node[term] = [value] if as_list else value
+
+    def project(self, triples, entity_type='entity'):
+        '''Returns projected nodes of the given entity type, keyed by subject IRI'''
+        by_subject = {}
+        for subject, predicate, obj in triples:
+            _add_unique(by_subject.setdefault(subject, {}), predicate, obj)
+        entity_type_iri = self.expand(entity_type)
+        projected = {}
+        for subject, props in by_subject.items():
+            types = self._types(props)
+            if entity_type_iri not in types:
+                continue
+            projected[subject] = self._project_node(subject, props, types)
+        return projected
+
+    def iter_project(self, lines, entity_type='entity'):
+        '''Streaming project(), yields (subject, node) for each subject of the given entity type as
+           soon as its lines are read.  Nodes yielded again for the same subject (see
+           iter_subject_lines) are to be combined with merge().'''
+        entity_type_iri = self.expand(entity_type)
+        # types and blank node labels of the subjects read so far
+        types_by_subject = {}
+        # triples of subjects read before their type
+        pending = {}
+        for token, group in iter_subject_lines(lines):
+            subject = _subject(token)
+            props = pending.pop(subject, {})
+            for _, predicate, obj in parse_ntriples(group):
+                _add_unique(props, predicate, obj)
+            types, blank_nodes = types_by_subject.setdefault(subject, ([], {}))
+            types += [t for t in self._types(props) if t not in types]
+            if entity_type_iri in types:
+                yield subject, self._project_node(subject, props, types, blank_nodes)
+            elif props:
+                pending[subject] = props
+
+    def _types(self, props):
+        return [self.expand(obj['@id']) if '@id' in obj else self.expand(obj['@value']) for obj in props.get(RDF_TYPE, [])]
+
+    def merge(self, node, other):
+        '''merge_nodes for two projected (or framed) nodes of the same subject, dropping the null
+           defaults of properties that have values under another term'''
+        merged = merge_nodes(node, other, id_key=self.id_key, type_key=self.type_key)
+        with_values = set([self.expand(k) for k, v in merged.items() if v is not None and v != []])
+        return dict([(k, v) for k, v in merged.items() if not ((v is None or v == []) and self.expand(k) in with_values)])
+
+    def _project_node(self, subject, props, types, blank_nodes=None):
+        blank_nodes = {} if blank_nodes is None else blank_nodes
+        node = {self.id_key: blank_nodes.setdefault(subject, '_:b0') if subject.startswith('_:') else self.compact_iri(subject)}
+        _types = [self.compact_iri(t, vocab=True) for t in types]
+        node[self.type_key] = _types[0] if len(_types) == 1 else _types
+        for iri in sorted(set(self.frame)):
+            if iri.startswith('@'):
+                continue
+            values = props.get(iri)
+            if values:
+                for value in values:
+                    term = self.compact_iri(iri, value, vocab=True)
+                    if value.get('@id', '').startswith('_:'):
+                        # framing relabels blank nodes and prunes their @id unless the term is @id coerced
+                        label = blank_nodes.setdefault(value['@id'], f'_:b{len(blank_nodes)}')
+                        self._add(node, term, label if self.terms.get(term, {}).get('@type') in ('@id', '@vocab') else {})
+                    else:
+                        self._add(node, term, self.compact_value(term, value))
+            else:
+                # framing adds a null default for frame properties the subject does not have
+                term = self.compact_iri(iri, None, vocab=True)
+                if term not in node:
+                    node[term] = [] if self.terms.get(term, {}).get('@container') == '@set' else None
+        return node
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Rendering of essays from page data fetched ahead, shared by the ASGI app render processes
+   (asgi.py) and the batch pre-renderer (prerender.py).'''
+
+import re
+
+from essay_utils import EssayUtils
+
+# QIDs of entity spans in MediaWiki parser output, a superset of those Essay finds
+QID_RE = re.compile(r'data-qid=["\']?(Q\d+)')
+
+class StaticEssayUtils(EssayUtils):
+    '''EssayUtils serving page revisions and HTML fetched ahead of rendering'''
+
+    def __init__(self, pages, **kwargs):
+        super().__init__(**kwargs)
+        self.pages = pages
+
+    def revision(self, title, site=None):
+        return self.pages[title][0]
+
+    def page(self, title, site=None, wikitext=False, revid=None, **kwargs):
+        return dict(self.pages[title][1])
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Batched Wikipedia page summaries for entity infoboxes.
+
+   Summaries are fetched for up to SUMMARY_BATCH_SIZE titles per call with the MediaWiki query
+   API (prop=extracts|pageimages|description|info) of the page's language wiki, rather than one
+   REST summary call per page, and cached per (language, title).  They have the fields of the
+   REST page summary the client renders (displaytitle, description, extract_html, thumbnail).'''
+
+import logging
+logger = logging.getLogger()
+
+import os
+import concurrent.futures
+from urllib.parse import unquote, urlparse
+
+import requests
+
+from caching import cache, DAY, MISSING, NOT_FOUND_TTL
+
+import timing
+import transport
+
+# Max number of titles per query API call (the API limit for titles)
+SUMMARY_BATCH_SIZE = 50
+# Max concurrent summary calls
+SUMMARY_CONCURRENCY = 4
+# Max age (seconds) of cached summaries, SUMMARY_TTL_<LANGUAGE> overrides it for a language
+SUMMARY_TTL = int(os.environ.get('SUMMARY_TTL', DAY))
+# Width (pixels) of the summary thumbnails
+THUMBNAIL_SIZE = 320
+
+def summary_ttl(language):
+    return int(os.environ.get(f'SUMMARY_TTL_{language.upper()}', SUMMARY_TTL))
+
+def page_title(page):
+    '''Returns (language, title) of a Wikipedia page URL'''
+    url = urlparse(page)
+    return url.netloc.split('.')[0], unquote(url.path.split('/wiki/', 1)[-1]).replace('_', ' ')
+
+def _key(language, title):
+    return ('summaries.summary', language, title)
+
+def summary(page):
+    '''Returns the summary of a Wikipedia page URL, None if not found or on an error'''
+    return summaries([page]).get(page)
+
+def summaries(pages):
+    '''Returns summaries for Wikipedia page URLs keyed by URL, cached ones from the cache and
+       the rest with batched calls per language.  Pages without a summary map to None; pages in
+       a failed call are left out (and not cached).'''
+    found = {}
+    missing = {}
+    for page in dict.fromkeys(pages):
+        language, title = page_title(page)
+        value = cache.get(_key(language, title), MISSING)
+        if value is MISSING:
+            missing.setdefault(language, {}).setdefault(title, []).append(page)
+        else:
+            found[page] = value
+    batches = [(language, sorted(titles)[start:start+SUMMARY_BATCH_SIZE])
+               for language, titles in missing.items() for start in range(0, len(titles), SUMMARY_BATCH_SIZE)]
+    if len(batches) == 1:
+        results = [_fetch_summaries(*batches[0])]
+    elif batches:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(SUMMARY_CONCURRENCY, len(batches))) as executor:
+            futures = [executor.submit(timing.bind(_fetch_summaries), *batch) for batch in batches]
+            results = [future.result() for future in futures]
+    else:
+        results = []
+    for (language, _), fetched in zip(batches, results):
+        for title, value in fetched.items():
+            for page in missing[language][title]:
+                found[page] = value
+    return found
+
+@timing.timed('summaries')
+def _fetch_summaries(language, titles):
+    '''Queries and caches the summaries of up to SUMMARY_BATCH_SIZE titles of a language wiki,
+       returns them keyed by title, {} on an error'''
+    params = {
+        'action': 'query', 'format': 'json', 'formatversion': 2, 'redirects': 1,
+        'prop': 'extracts|pageimages|description|info', 'inprop': 'displaytitle',
+        'exintro': 1, 'exlimit': 'max', 'piprop': 'thumbnail', 'pithumbsize': THUMBNAIL_SIZE, 'pilimit': 'max',
+        'titles': '|'.join(titles)
+    }
+    pages = {}
+    aliases = {}
+    try:
+        # intro extracts are returned for at most 20 pages per response, the rest follow as continuations
+        _continue = {'continue': ''}
+        while _continue:
+            resp = transport.get(f'https://{language}.wikipedia.org/w/api.php', params=dict(params, **_continue),
+                                 headers={'Accept': 'application/json'})
+            resp.raise_for_status()
+            resp = resp.json()
+            query = resp.get('query', {})
+            for alias in query.get('normalized', []) + query.get('redirects', []):
+                aliases[alias['from']] = alias['to']
+            for page in query.get('pages', []):
+                pages.setdefault(page['title'], {}).update(dict([(k, v) for k, v in page.items() if v is not None]))
+            _continue = resp.get('continue')
+    except (requests.RequestException, ValueError) as e:
+        logger.warning(f'_fetch_summaries: language={language} titles={len(titles)} error={e}')
+        return {}
+
+    fetched = {}
+    for title in titles:
+        # a title may be normalized, then redirected
+        _title = aliases.get(title, title)
+        page = pages.get(aliases.get(_title, _title))
+        value = _summary(language, page) if page and not page.get('missing') and not page.get('invalid') else None
+        cache.set(_key(language, title), value, ttl=summary_ttl(language) if value else NOT_FOUND_TTL)
+        fetched[title] = value
+    return fetched
+
+def _summary(language, page):
+    '''Maps a query API page to the fields of a REST page summary'''
+    value = {
+        'title': page['title'],
+        'displaytitle': page.get('displaytitle', page['title']),
+        'pageid': page.get('pageid'),
+        'lang': language,
+        'description': page.get('description'),
+        'extract_html': page.get('extract', ''),
+        'content_urls': {'desktop': {'page': f'https://{language}.wikipedia.org/wiki/{page["title"].replace(" ", "_")}'}}
+    }
+    if 'thumbnail' in page:
+        value['thumbnail'] = page['thumbnail']
+    return dict([(k, v) for k, v in value.items() if v is not None])
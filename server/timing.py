@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Per-request timing spans and counters for the entity and essay handlers.
+
+   A handler opens a request() and the stages it runs record spans (wall time and call count
+   per stage name) and counters (upstream requests and bytes, cache hits and misses) into it
+   through a context variable.  The results are returned as a Server-Timing header and logged
+   as one JSON line when the request ends.  Outside a request, or with TIMING_ENABLED off,
+   spans and counters cost a context variable lookup.'''
+
+import logging
+logger = logging.getLogger()
+
+import os
+import contextvars
+import functools
+import json
+import threading
+from time import perf_counter
+
+TIMING_ENABLED = os.environ.get('TIMING_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# The per-request JSON lines are logged at INFO whatever the root logger level
+timing_logger = logging.getLogger('timing')
+timing_logger.setLevel(logging.INFO)
+
+_current = contextvars.ContextVar('timing', default=None)
+
+class RequestTiming(object):
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.started = perf_counter()
+        self.spans = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        return perf_counter() - self.started
+
+    def add_span(self, name, elapsed):
+        with self._lock:
+            span = self.spans.setdefault(name, [0.0, 0])
+            span[0] += elapsed
+            span[1] += 1
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def header(self):
+        '''Server-Timing header value, spans are totals over all calls (overlapping when concurrent)'''
+        with self._lock:
+            metrics = [f'total;dur={self.elapsed * 1000:.1f}']
+            metrics += [f'{name};dur={elapsed * 1000:.1f};desc="{calls}x"' for name, (elapsed, calls) in self.spans.items()]
+            metrics += [f'{name};desc="{value}"' for name, value in sorted(self.counters.items())]
+        return ', '.join(metrics)
+
+    def json(self):
+        with self._lock:
+            return dict(self.fields,
+                request=self.name,
+                total_ms=round(self.elapsed * 1000, 1),
+                spans=dict([(name, {'ms': round(elapsed * 1000, 1), 'calls': calls}) for name, (elapsed, calls) in self.spans.items()]),
+                counters=dict(self.counters))
+
+class request(object):
+    '''Context manager timing a handler invocation, yields the RequestTiming (None when disabled)'''
+
+    def __init__(self, name, **fields):
+        self.timing = RequestTiming(name, **fields) if TIMING_ENABLED else None
+        self._token = None
+
+    def __enter__(self):
+        if self.timing is not None:
+            self._token = _current.set(self.timing)
+        return self.timing
+
+    def __exit__(self, *exc):
+        if self.timing is not None:
+            _current.reset(self._token)
+            timing_logger.info(json.dumps(self.timing.json()))
+        return False
+
+class span(object):
+    '''Context manager adding the wall time of a block to the current request'''
+    __slots__ = ('name', 'timing', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timing = _current.get()
+        if self.timing is not None:
+            self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timing is not None:
+            self.timing.add_span(self.name, perf_counter() - self.started)
+        return False
+
+def timed(name):
+    '''Decorator recording each call of a function as a span'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timing = _current.get()
+            if timing is None:
+                return func(*args, **kwargs)
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timing.add_span(name, perf_counter() - started)
+        return wrapper
+    return decorator
+
+def current():
+    return _current.get()
+
+def count(name, n=1):
+    timing = _current.get()
+    if timing is not None:
+        timing.count(name, n)
+
+def add_span(name, elapsed):
+    timing = _current.get()
+    if timing is not None:
+        timing.add_span(name, elapsed)
+
+def bind(func):
+    '''Returns func bound to a copy of the current context, for running in a worker thread'''
+    return functools.partial(contextvars.copy_context().run, func)
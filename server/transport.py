@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Shared HTTP transport for all outbound calls made by entity.py and essay_utils.py.
+
+   A single requests.Session with per-host keep-alive connection pools is created per process.
+   In a warm Lambda container the module (and so the session) survives between invocations,
+   so calls to the SPARQL endpoints, the WB service and Wikipedia reuse open connections
+   instead of paying a new TCP+TLS handshake each time.
+
+   Each host gets its own timeouts and circuit breaker.  Idempotent requests failing to connect
+   or with a retryable status are retried a bounded number of times with jittered backoff, and
+   after repeated failures a host's circuit opens, failing its requests fast (CircuitOpenError)
+   until a trial request succeeds, so callers return partial results instead of waiting on it.'''
+
+import logging
+logger = logging.getLogger()
+
+import os
+import hashlib
+import io
+import json
+import random
+import threading
+from time import sleep, time as now
+from urllib.parse import urlparse, unquote_plus
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+import timing
+logging.getLogger('requests').setLevel(logging.INFO)
+
+# Max concurrent upstream calls per process; each host pool keeps this many connections.  The thread
+# pools and semaphores making upstream calls (entity.ASYNC_CONCURRENCY, asgi.ASGI_IO_THREADS) are
+# sized from it, so no call waits on or discards a pooled connection
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+# Number of distinct host pools kept open
+POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 10))
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 25))
+# Per-host (connect, read) timeouts, hosts not listed use CONNECT_TIMEOUT and READ_TIMEOUT.
+# HTTP_TIMEOUTS (a JSON object of host: [connect, read]) adds to or overrides these.
+HOST_TIMEOUTS = {
+    'query.wikidata.org': (CONNECT_TIMEOUT, 20),
+    'kg-query.jstor.org': (CONNECT_TIMEOUT, 20),
+    'lo7kh865s6.execute-api.us-east-1.amazonaws.com': (3, 8),
+    'en.wikipedia.org': (3, 5),
+    'kg.jstor.org': (3, 10)
+}
+HOST_TIMEOUTS.update(dict([(host, tuple(timeout)) for host, timeout in json.loads(os.environ.get('HTTP_TIMEOUTS', '{}')).items()]))
+# Max retries of an idempotent request failing to connect or with a RETRY_STATUSES status
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+RETRY_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Retry n waits a random time up to min(RETRY_BACKOFF * 2**n, RETRY_BACKOFF_MAX) seconds, or
+# the Retry-After of the failed response when longer (up to RETRY_BACKOFF_MAX)
+RETRY_BACKOFF = 0.25
+RETRY_BACKOFF_MAX = 2.0
+# Consecutive failures (connection errors, timeouts, 5xx and 429 responses) opening a host's
+# circuit, and the seconds it stays open before a trial request is let through
+CIRCUIT_FAILURES = int(os.environ.get('HTTP_CIRCUIT_FAILURES', 5))
+CIRCUIT_COOLDOWN = float(os.environ.get('HTTP_CIRCUIT_COOLDOWN', 30))
+# Bytes read per chunk from streamed responses
+STREAM_CHUNK_SIZE = 64 * 1024
+# Directory of recorded responses served instead of the upstream services (see ReplayAdapter)
+HTTP_REPLAY_DIR = os.environ.get('HTTP_REPLAY_DIR')
+# Record upstream responses into HTTP_REPLAY_DIR instead of replaying them
+HTTP_RECORD = os.environ.get('HTTP_RECORD', '').lower() in ('1', 'true', 'yes')
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    '''Raised, without sending the request, while the circuit of its host is open'''
+
+    def __init__(self, host, retry_after):
+        super().__init__(f'Circuit open for {host}, retry in {retry_after:.1f}s')
+        self.host = host
+        self.retry_after = retry_after
+
+class NoRecording(requests.exceptions.RequestException):
+    '''Raised by ReplayAdapter for a request without a recorded response'''
+
+class Circuit(object):
+    '''Circuit breaker of one host.  Opens after CIRCUIT_FAILURES consecutive failures, requests
+       then fail fast for CIRCUIT_COOLDOWN seconds, after which one trial request is let through,
+       closing the circuit on success and re-opening it on failure.'''
+
+    def __init__(self, host, failures=CIRCUIT_FAILURES, cooldown=CIRCUIT_COOLDOWN):
+        self.host = host
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        '''Raises CircuitOpenError unless a request may be sent'''
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.cooldown - now()
+            if remaining > 0 or self._trial:
+                raise CircuitOpenError(self.host, max(remaining, 0))
+            self._trial = True
+
+    def end_trial(self):
+        '''Lets the next request after the cooldown through, when a trial request ended without
+           success or failure (an unexpected exception)'''
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.warning(f'Circuit closed for {self.host}')
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.max_failures:
+                if self.opened_at is None:
+                    logger.warning(f'Circuit opened for {self.host} after {self.failures} failures')
+                self.opened_at = now()
+
+class ReplayAdapter(BaseAdapter):
+    '''Serves responses recorded in a directory, one JSON file per request.  In record mode
+       requests are sent with the wrapped adapter and their responses saved.  Requests are
+       matched on method, host, path and the sorted tokens of the query string and body, so
+       recordings do not depend on the order of IDs in VALUES clauses.'''
+
+    def __init__(self, directory, record=False, adapter=None):
+        super().__init__()
+        self.directory = directory
+        self.record = record
+        self.adapter = adapter if adapter else HTTPAdapter()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(method, url, body=None):
+        parsed = urlparse(url)
+        body = body.decode('utf-8') if isinstance(body, bytes) else (body or '')
+        tokens = sorted(unquote_plus(f'{parsed.query}&{body}').replace('&', ' ').split())
+        return hashlib.sha1('\n'.join([method, parsed.netloc, parsed.path] + tokens).encode('utf-8')).hexdigest()
+
+    def path(self, request):
+        return os.path.join(self.directory, f'{urlparse(request.url).netloc}_{self.key(request.method, request.url, request.body)[:16]}.json')
+
+    def send(self, request, **kwargs):
+        path = self.path(request)
+        if self.record:
+            kwargs['stream'] = False
+            resp = self.adapter.send(request, **kwargs)
+            body = request.body.decode('utf-8') if isinstance(request.body, bytes) else request.body
+            with open(path, 'w') as fp:
+                json.dump({'request': {'method': request.method, 'url': request.url, 'body': body},
+                           'status': resp.status_code, 'reason': resp.reason,
+                           'headers': {'Content-Type': resp.headers.get('Content-Type', '')},
+                           'body': resp.content.decode('utf-8')}, fp, indent=2)
+            return resp
+        if not os.path.exists(path):
+            raise NoRecording(f'No recording for {request.method} {request.url}', request=request)
+        with open(path, 'r') as fp:
+            recorded = json.load(fp)
+        resp = requests.Response()
+        resp.status_code = recorded['status']
+        resp.reason = recorded.get('reason')
+        resp.headers = CaseInsensitiveDict(recorded['headers'])
+        resp.raw = io.BytesIO(recorded['body'].encode('utf-8'))
+        resp.encoding = 'utf-8'
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        return resp
+
+    def close(self):
+        self.adapter.close()
+
+class Transport(object):
+
+    def __init__(self, pool_size=POOL_SIZE, pool_hosts=POOL_HOSTS, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 host_timeouts=HOST_TIMEOUTS, retries=HTTP_RETRIES, replay_dir=HTTP_REPLAY_DIR, record=HTTP_RECORD):
+        self.timeout = (connect_timeout, read_timeout)
+        self.host_timeouts = host_timeouts
+        self.retries = retries
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        if replay_dir:
+            self.replay(replay_dir, record=record)
+        self._stats = {}
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def replay(self, directory, record=False):
+        '''Serves (or with record=True, records) responses from a directory instead of the upstream services'''
+        adapter = ReplayAdapter(directory, record=record, adapter=self._adapter)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        return adapter
+
+    def circuit(self, host):
+        with self._lock:
+            if host not in self._circuits:
+                self._circuits[host] = Circuit(host)
+            return self._circuits[host]
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        '''Sends a request with the timeouts of its host.  Idempotent requests (by default those with
+           an IDEMPOTENT_METHODS method, pass idempotent=True for a POSTed query) are retried on
+           connection errors and RETRY_STATUSES responses.  Raises CircuitOpenError while the host
+           circuit is open.'''
+        host = urlparse(url).netloc
+        kwargs.setdefault('timeout', self.host_timeouts.get(host, self.timeout))
+        retries = self.retries if (method in IDEMPOTENT_METHODS if idempotent is None else idempotent) else 0
+        circuit = self.circuit(host)
+        resp = None
+        for attempt in range(retries + 1):
+            if attempt:
+                self._backoff(attempt, resp)
+                timing.count('upstream_retries')
+            try:
+                circuit.allow()
+            except CircuitOpenError:
+                timing.count('upstream_rejected')
+                raise
+            start = now()
+            resp = None
+            try:
+                resp = self.session.request(method, url, **kwargs)
+                if resp.status_code >= 500 or resp.status_code == 429:
+                    circuit.failure()
+                else:
+                    circuit.success()
+            except requests.RequestException as e:
+                circuit.failure()
+                timing.count('upstream_errors')
+                # not a read timeout, the server may still be working on a request that timed out
+                if attempt < retries and isinstance(e, requests.exceptions.ConnectionError):
+                    logger.info(f'Retrying {method} {host}: {e}')
+                    continue
+                raise
+            finally:
+                # whatever was raised, a trial request is over
+                circuit.end_trial()
+                self._record(host, now() - start, resp is None)
+                timing.add_span(f'upstream.{host}', now() - start)
+            if attempt < retries and resp.status_code in RETRY_STATUSES:
+                logger.info(f'Retrying {method} {host}: status={resp.status_code}')
+                resp.close()
+                continue
+            if not kwargs.get('stream'):
+                timing.count('upstream_bytes', len(resp.content))
+            return resp
+
+    def _backoff(self, attempt, resp=None):
+        '''Sleeps before a retry, full jitter exponential backoff'''
+        delay = random.uniform(0, min(RETRY_BACKOFF * 2 ** attempt, RETRY_BACKOFF_MAX))
+        retry_after = resp.headers.get('Retry-After', '') if resp is not None else ''
+        if retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), RETRY_BACKOFF_MAX))
+        sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _record(self, host, elapsed, error):
+        with self._lock:
+            stats = self._stats.setdefault(host, {'requests': 0, 'errors': 0, 'latency': 0.0, 'max_latency': 0.0})
+            stats['requests'] += 1
+            stats['errors'] += 1 if error else 0
+            stats['latency'] += elapsed
+            stats['max_latency'] = max(stats['max_latency'], elapsed)
+
+    def stats(self):
+        '''Returns per-host request counts, latencies (seconds) since the last reset and circuit states'''
+        with self._lock:
+            return dict([(host, dict(stats, avg_latency=stats['latency']/stats['requests'],
+                                     circuit_open=host in self._circuits and self._circuits[host].open))
+                         for host, stats in self._stats.items()])
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def default_transport():
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = Transport()
+    return _transport
+
+def get(url, **kwargs):
+    return default_transport().get(url, **kwargs)
+
+def post(url, **kwargs):
+    return default_transport().post(url, **kwargs)
+
+def iter_lines(resp, chunk_size=STREAM_CHUNK_SIZE):
+    '''Yields the lines of a streamed (stream=True) response as they arrive, releasing the
+       connection back to the pool when done'''
+    size = 0
+    try:
+        for line in resp.iter_lines(chunk_size=chunk_size):
+            size += len(line) + 1
+            yield line
+    finally:
+        resp.close()
+        timing.count('upstream_bytes', size)
+
+def stats():
+    return default_transport().stats()
+
+def reset_stats():
+    default_transport().reset_stats()